@@ -0,0 +1,846 @@
+#:coding=utf-8:
+"""
+Benchmarks for redis_mock.
+
+Run every benchmark with ``python benchmarks.py`` or pick some by name:
+
+    python benchmarks.py lock_contention
+
+``--json results.json`` writes the results to a file and ``--compare
+results.json`` compares them with an earlier run, e.g. of another commit.
+"""
+
+import json
+import optparse
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import redis_mock
+
+def _run_threads(target, thread_count):
+    """
+    Runs ``target(thread_index)`` in ``thread_count`` threads at once and
+    returns the wall clock time it took for all of them to finish.
+    """
+    start_event = threading.Event()
+    def run(index):
+        start_event.wait()
+        target(index)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(thread_count)]
+    for t in threads:
+        t.start()
+    start = time.time()
+    start_event.set()
+    for t in threads:
+        t.join()
+    return time.time() - start
+
+# The results of the benchmarks run by main(), for --json.
+_results = []
+_benchmark = None
+
+def _report(name, ops, elapsed, histogram=None):
+    """
+    Prints and records the result of a benchmark step, with the latency
+    percentiles of ``histogram`` (a redis_mock.LatencyHistogram of
+    microseconds) when given.
+    """
+    result = {
+        'benchmark': _benchmark,
+        'name': name,
+        'ops': ops,
+        'seconds': elapsed,
+        'ops_per_sec': ops / elapsed if elapsed else 0.0,
+    }
+    line = "%-40s %10d ops %8.3fs %12.0f ops/sec" % (name, ops, elapsed, result['ops_per_sec'])
+    if histogram is not None:
+        p50, p99, p999 = histogram.percentiles((50, 99, 99.9))
+        result.update(p50_usec=p50, p99_usec=p99, p999_usec=p999)
+        line += "  p50=%dus p99=%dus p99.9=%dus" % (p50, p99, p999)
+    _results.append(result)
+    print line
+
+def bench_lock_contention(ops=20000, thread_counts=(1, 2, 4, 8), stripes=(None, 16)):
+    """
+    Threads doing GET/SET on their own keys, with a single lock per
+    database versus a striped lock.
+    """
+    for stripe_count in stripes:
+        db = 'bench-stripes-%s' % stripe_count
+        r = redis_mock.Redis(db=db, lock_stripes=stripe_count)
+        r.flushdb()
+        for thread_count in thread_counts:
+            def work(index):
+                key = 'key-%d' % index
+                for i in xrange(ops):
+                    r.set(key, i)
+                    r.get(key)
+            elapsed = _run_threads(work, thread_count)
+            _report("stripes=%s threads=%d" % (stripe_count or 1, thread_count),
+                    ops * 2 * thread_count, elapsed)
+
+def bench_get_set(ops=100000):
+    """
+    Single threaded GET and SET with each locking mode.
+    """
+    modes = [
+        ('rwlock', {}),
+        ('striped', {'lock_stripes': 16}),
+        ('threadsafe=False', {'threadsafe': False}),
+    ]
+    for mode, options in modes:
+        r = redis_mock.Redis(db='bench-get-set-%s' % mode, **options)
+        r.flushdb()
+        start = time.time()
+        for i in xrange(ops):
+            r.set('key', i)
+        _report("set %s" % mode, ops, time.time() - start)
+        start = time.time()
+        for i in xrange(ops):
+            r.get('key')
+        _report("get %s" % mode, ops, time.time() - start)
+
+def bench_lists(items=100000):
+    """
+    Building a list from the head and reading its tail, comparing the
+    deque storage with the plain Python list the mock used to store.
+    """
+    for storage in (list, deque):
+        val = storage()
+        push = val.appendleft if storage is deque else lambda x: val.insert(0, x)
+        start = time.time()
+        for i in xrange(items):
+            push(i)
+        _report("%s head push" % storage.__name__, items, time.time() - start)
+
+    r = redis_mock.Redis(db='bench-lists')
+    r.flushdb()
+    start = time.time()
+    for i in xrange(items):
+        r.lpush('queue', i)
+    _report("lpush", items, time.time() - start)
+
+    start = time.time()
+    for i in xrange(1000):
+        r.lrange('queue', -10, -1)
+    _report("lrange last 10 of %d" % items, 1000, time.time() - start)
+
+    start = time.time()
+    for i in xrange(items):
+        r.rpop('queue')
+    _report("rpop", items, time.time() - start)
+
+def bench_read_scaling(ops=20000, thread_counts=(1, 2, 4, 8)):
+    """
+    Threads doing HGET, which takes the reader lock, versus HSET, which
+    takes the writer lock. "overlap" is the largest number of threads seen
+    inside the lock at the same time, so readers share it and writers
+    don't.
+    """
+    r = redis_mock.Redis(db='bench-read-scaling')
+    r.flushdb()
+    r.hset('hash', 'field', 'value')
+    lock = r._lock
+    for name, func, args in [('hget', r.hget, ('hash', 'field')),
+                             ('hset', r.hset, ('hash', 'field', 'value'))]:
+        for thread_count in thread_counts:
+            overlap = [0]
+            done = threading.Event()
+            def sample():
+                while not done.is_set():
+                    overlap[0] = max(overlap[0], lock.active_readers, lock.active_writers)
+            sampler = threading.Thread(target=sample)
+            sampler.start()
+            def work(index):
+                for i in xrange(ops):
+                    func(*args)
+            elapsed = _run_threads(work, thread_count)
+            done.set()
+            sampler.join()
+            _report("%s threads=%d overlap=%d" % (name, thread_count, overlap[0]),
+                    ops * thread_count, elapsed)
+
+def bench_pipeline(ops=100000, batch_sizes=(10, 100, 1000)):
+    """
+    SET through pipelines of different sizes, which take the lock once per
+    batch, against calling SET directly.
+    """
+    r = redis_mock.Redis(db='bench-pipeline')
+    r.flushdb()
+    start = time.time()
+    for i in xrange(ops):
+        r.set('key-%d' % (i % 1000), i)
+    _report("direct", ops, time.time() - start)
+    for batch_size in batch_sizes:
+        for transaction in (True, False):
+            start = time.time()
+            for batch in xrange(ops // batch_size):
+                pipe = r.pipeline(transaction=transaction)
+                for i in xrange(batch_size):
+                    pipe.set('key-%d' % i, i)
+                pipe.execute()
+            _report("batch=%d transaction=%s" % (batch_size, transaction),
+                    ops, time.time() - start)
+
+def bench_zsets(members=1000000, queries=10000):
+    """
+    ZADD, ZRANK, ZRANGE and ZRANGEBYSCORE on a sorted set with ``members``
+    members, compared with sorting the scores on every read.
+    """
+    rand = random.Random(0)
+    r = redis_mock.Redis(db='bench-zsets')
+    r.flushdb()
+    scores = [rand.random() * members for i in xrange(members)]
+
+    start = time.time()
+    for i in xrange(0, members, 1000):
+        args = []
+        for j in xrange(i, min(i + 1000, members)):
+            args.extend(('member-%d' % j, scores[j]))
+        r.zadd('zset', *args)
+    _report("zadd %d members" % members, members, time.time() - start)
+
+    start = time.time()
+    for i in xrange(queries):
+        r.zadd('zset', 'member-%d' % rand.randrange(members), rand.random() * members)
+    _report("zadd update", queries, time.time() - start)
+
+    start = time.time()
+    for i in xrange(queries):
+        r.zrank('zset', 'member-%d' % rand.randrange(members))
+    _report("zrank", queries, time.time() - start)
+
+    start = time.time()
+    for i in xrange(queries):
+        rank = rand.randrange(members)
+        r.zrange('zset', rank, rank + 9, withscores=True)
+    _report("zrange 10 by rank", queries, time.time() - start)
+
+    start = time.time()
+    for i in xrange(queries):
+        low = rand.random() * members
+        r.zrangebyscore('zset', low, low + 10)
+    _report("zrangebyscore width 10", queries, time.time() - start)
+
+    start = time.time()
+    for i in xrange(queries):
+        low = rand.random() * members
+        r.zcount('zset', low, low + members / 10)
+    _report("zcount 10% of members", queries, time.time() - start)
+
+    member_scores = r._cache['zset'].scores
+    start = time.time()
+    ordered = sorted((score, member) for member, score in member_scores.iteritems())
+    _report("sort on read (one query)", 1, time.time() - start)
+
+def bench_eviction(ops=100000, policies=('allkeys-lru', 'allkeys-lfu',
+                                          'allkeys-random', 'volatile-ttl')):
+    """
+    SET of new keys with a maxmemory limit that keeps only a fraction of
+    them, so that nearly every write evicts a key, against no limit.
+    """
+    value = 'x' * 100
+    for policy in (None,) + policies:
+        if policy is None:
+            r = redis_mock.Redis(db='bench-eviction-none')
+        else:
+            r = redis_mock.Redis(db='bench-eviction-%s' % policy,
+                                 maxmemory=1000000, maxmemory_policy=policy)
+        r.flushdb()
+        start = time.time()
+        for i in xrange(ops):
+            r.setex('key-%d' % i, value, 1000 + i)
+        _report("setex maxmemory-policy=%s" % policy, ops, time.time() - start)
+        if policy is not None:
+            print "%40s %d keys, %d evicted" % ('', len(r._cache),
+                                                r.info('stats')['evicted_keys'])
+
+def bench_snapshot(keys=200000):
+    """
+    Saving and loading a snapshot of string, hash and sorted set keys,
+    against seeding the same data with individual commands.
+    """
+    path = tempfile.mktemp(suffix='.rdb')
+    server = 'bench-snapshot'
+    def forget():
+        for name in list(redis_mock._caches):
+            if name.startswith(server + ':'):
+                del redis_mock._caches[name]
+    try:
+        forget()
+        r = redis_mock.Redis(host=server, dbfilename=path)
+        start = time.time()
+        for i in xrange(keys):
+            r.set('key-%d' % i, 'x' * 20)
+            r.hset('hash-%d' % (i % 1000), 'field-%d' % i, 'value')
+            r.zadd('zset', 'member-%d' % i, i)
+        _report("seed with commands", keys * 3, time.time() - start)
+
+        start = time.time()
+        r.save()
+        _report("save (%d bytes)" % os.path.getsize(path), 1, time.time() - start)
+
+        start = time.time()
+        r.bgsave()
+        _report("bgsave (time writers are blocked)", 1, time.time() - start)
+        thread = redis_mock._bgsaves.get(server + ':6379')
+        if thread is not None:
+            thread.join()
+
+        forget()
+        start = time.time()
+        r = redis_mock.Redis(host=server, dbfilename=path)
+        _report("load at construction", keys * 3, time.time() - start)
+    finally:
+        forget()
+        if os.path.exists(path):
+            os.unlink(path)
+
+def bench_aof(ops=50000, thread_counts=(1, 4)):
+    """
+    SET with the append-only file under each fsync policy, against no log.
+    With "always" the threads' records are fsynced together.
+    """
+    path = tempfile.mktemp(suffix='.aof')
+    for fsync in (None, 'no', 'everysec', 'always'):
+        for thread_count in thread_counts:
+            server = 'bench-aof-%s-%d' % (fsync, thread_count)
+            if fsync is None:
+                r = redis_mock.Redis(host=server)
+            else:
+                r = redis_mock.Redis(host=server, appendonly=True,
+                                     appendfilename=path, appendfsync=fsync)
+            count = ops // thread_count if fsync != 'always' else ops // 10 // thread_count
+            def work(index):
+                for i in xrange(count):
+                    r.set('key-%d-%d' % (index, i), i)
+            elapsed = _run_threads(work, thread_count)
+            _report("set appendfsync=%s threads=%d" % (fsync, thread_count),
+                    count * thread_count, elapsed)
+            aof = redis_mock._aofs.pop(server + ':6379', None)
+            if aof is not None:
+                aof.close()
+                os.unlink(path)
+
+def bench_server(ops=20000, thread_counts=(1, 4, 16), batch_size=100):
+    """
+    SET and GET through redis.StrictRedis clients connected to the RESP
+    server over TCP, one request at a time and in pipelines.
+    """
+    import redis
+    server = redis_mock.RespServer(('127.0.0.1', 0))
+    server_thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    server_thread.daemon = True
+    server_thread.start()
+    port = server.server_address[1]
+    try:
+        for thread_count in thread_counts:
+            count = ops // thread_count
+            def work(index):
+                client = redis.StrictRedis(port=port)
+                key = 'key-%d' % index
+                for i in xrange(count // 2):
+                    client.set(key, i)
+                    client.get(key)
+                client.connection_pool.disconnect()
+            elapsed = _run_threads(work, thread_count)
+            _report("set/get clients=%d" % thread_count, count * thread_count, elapsed)
+
+            def pipelined(index):
+                client = redis.StrictRedis(port=port)
+                pipe = client.pipeline(transaction=False)
+                key = 'key-%d' % index
+                for batch in xrange(count // batch_size):
+                    for i in xrange(batch_size // 2):
+                        pipe.set(key, i)
+                        pipe.get(key)
+                    pipe.execute()
+                client.connection_pool.disconnect()
+            elapsed = _run_threads(pipelined, thread_count)
+            _report("set/get clients=%d pipeline=%d" % (thread_count, batch_size),
+                    count * thread_count, elapsed)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def bench_shared(ops=20000, process_counts=(1, 2, 4)):
+    """
+    SET and GET of each process's own keys on a shared keyspace, from
+    several processes at once, against the same work on a private
+    keyspace in one process.
+    """
+    r = redis_mock.Redis(db='bench-shared-private')
+    r.flushdb()
+    start = time.time()
+    for i in xrange(ops):
+        r.set('key-%d' % (i % 1000), i)
+        r.get('key-%d' % (i % 1000))
+    _report("set/get private", ops * 2, time.time() - start)
+
+    path = tempfile.mktemp(suffix='.shm')
+    try:
+        for process_count in process_counts:
+            db = 'bench-shared-%d' % process_count
+            r = redis_mock.Redis(db=db, shared_file=path)
+            r.flushdb()
+            start = time.time()
+            pids = []
+            for index in xrange(process_count):
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        r = redis_mock.Redis(db=db, shared_file=path)
+                        for i in xrange(ops):
+                            key = 'key-%d-%d' % (index, i % 1000)
+                            r.set(key, i)
+                            r.get(key)
+                    finally:
+                        os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                os.waitpid(pid, 0)
+            _report("set/get shared processes=%d" % process_count,
+                    ops * 2 * process_count, time.time() - start)
+            redis_mock._caches.pop('localhost:6379:%s' % db).close()
+            del redis_mock._locks['localhost:6379:%s' % db]
+            os.unlink(path)
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+def bench_scan(sizes=(10000, 100000, 1000000), steps=1000):
+    """
+    SCAN steps of COUNT 10 with a MATCH pattern, which only hold the lock
+    for one batch whatever the number of keys, against KEYS, which holds
+    it for a pass over all of them.
+    """
+    for size in sizes:
+        r = redis_mock.Redis(db='bench-scan-%d' % size)
+        r.flushdb()
+        pipe = r.pipeline(transaction=False)
+        for i in xrange(size):
+            pipe.set('key-%d' % i, 'x')
+        pipe.execute()
+        r.scan(count=1)  # builds the index the first SCAN needs
+
+        start = time.time()
+        cursor = 0
+        for i in xrange(steps):
+            cursor, keys = r.scan(cursor, match='key-1*', count=10)
+        _report("scan step keys=%d" % size, steps, time.time() - start)
+
+        start = time.time()
+        r.keys('key-1*')
+        _report("keys keys=%d" % size, 1, time.time() - start)
+
+def bench_keyspace_info(sizes=(10000, 100000, 1000000), calls=1000):
+    """
+    DBSIZE, TYPE and INFO keyspace, which read counters kept up to date
+    by the writes, against counting the keys of each type by walking the
+    keyspace.
+    """
+    for size in sizes:
+        r = redis_mock.Redis(host='bench-keyspace-info-%d' % size)
+        r.flushdb()
+        pipe = r.pipeline(transaction=False)
+        for i in xrange(size):
+            if i % 2:
+                pipe.set('key-%d' % i, 'x')
+            else:
+                pipe.sadd('key-%d' % i, 'x')
+        pipe.execute()
+
+        start = time.time()
+        for i in xrange(calls):
+            r.dbsize()
+            r.type('key-1')
+            r.info('keyspace')
+        _report("dbsize+type+info keys=%d" % size, calls, time.time() - start)
+
+        start = time.time()
+        counts = {}
+        for value in r._cache.itervalues():
+            name = 'string' if isinstance(value, str) else 'set'
+            counts[name] = counts.get(name, 0) + 1
+        _report("walk keyspace keys=%d" % size, 1, time.time() - start)
+
+def bench_command_stats(ops=100000, thread_counts=(1, 4)):
+    """
+    GET/SET with latency tracking off, which costs one attribute check per
+    command, against tracking on, which takes two clock readings and the
+    statistics mutex per command.
+    """
+    for tracking in (False, True):
+        host = 'bench-command-stats-%s' % tracking
+        r = redis_mock.Redis(host=host, lock_stripes=16)
+        r.config_set('latency-tracking', 'yes' if tracking else 'no')
+        r.flushdb()
+        for thread_count in thread_counts:
+            def work(index):
+                key = 'key-%d' % index
+                for i in xrange(ops // thread_count):
+                    r.set(key, i)
+                    r.get(key)
+            elapsed = _run_threads(work, thread_count)
+            _report("tracking=%s threads=%d" % (tracking, thread_count),
+                    ops // thread_count * thread_count * 2, elapsed)
+        if tracking:
+            for name, latency in sorted(r.info('latencystats').iteritems()):
+                print "  %s %s" % (name, latency)
+
+def bench_trace(ops=20000, thread_counts=(1, 4), stripes=(None, 16)):
+    """
+    GET/SET/INCR/LPUSH from four threads with and without a trace running,
+    then the trace replayed as fast as possible over a number of threads,
+    with a single lock versus a striped lock.
+    """
+    path = tempfile.mktemp(suffix='.trace')
+    try:
+        for tracing in (False, True):
+            r = redis_mock.Redis(host='bench-trace-%s' % tracing)
+            r.flushdb()
+            if tracing:
+                r.trace_start(path)
+            def work(index):
+                key = 'key-%d' % index
+                for i in xrange(ops // 4):
+                    r.set(key, i)
+                    r.get(key)
+                    r.incr('counter')
+                    r.lpush('list-%d' % index, i)
+            elapsed = _run_threads(work, 4)
+            if tracing:
+                r.trace_stop()
+            _report("record tracing=%s" % tracing, ops // 4 * 16, elapsed)
+        print "  trace: %d bytes" % os.path.getsize(path)
+        for stripe_count in stripes:
+            for thread_count in thread_counts:
+                host = 'bench-replay-%s-%d' % (stripe_count, thread_count)
+                count, elapsed = redis_mock.replay_trace(path, host, threads=thread_count,
+                                                         lock_stripes=stripe_count)
+                _report("replay stripes=%s threads=%d" % (stripe_count or 1, thread_count),
+                        count, elapsed)
+    finally:
+        os.unlink(path)
+
+def bench_bulk(items=100000, batch_sizes=(100, 10000)):
+    """
+    Loading ``items`` strings, list elements, set members and hash fields
+    one command per item against the variadic and multi-key commands,
+    which validate a batch and apply it under a single lock acquisition.
+    """
+    r = redis_mock.Redis(db='bench-bulk')
+    values = [str(i) for i in xrange(items)]
+    loads = [
+        ('set', lambda batch: [r.set(value, value) for value in batch],
+         lambda batch: r.mset(dict(zip(batch, batch)))),
+        ('rpush', lambda batch: [r.rpush('list', value) for value in batch],
+         lambda batch: r.rpush('list', *batch)),
+        ('sadd', lambda batch: [r.sadd('set', value) for value in batch],
+         lambda batch: r.sadd('set', *batch)),
+        ('hset', lambda batch: [r.hset('hash', value, value) for value in batch],
+         lambda batch: r.hmset('hash', dict(zip(batch, batch)))),
+    ]
+    for name, single, bulk in loads:
+        r.flushdb()
+        start = time.time()
+        single(values)
+        _report("%s x%d" % (name, items), items, time.time() - start)
+        for batch_size in batch_sizes:
+            r.flushdb()
+            start = time.time()
+            for i in xrange(0, items, batch_size):
+                bulk(values[i:i + batch_size])
+            _report("%s batches of %d" % (name, batch_size), items, time.time() - start)
+
+    r.flushdb()
+    r.mset(dict(zip(values, values)))
+    start = time.time()
+    for i in xrange(0, items, 100):
+        r.mget(values[i:i + 100])
+    _report("mget batches of 100", items, time.time() - start)
+
+def bench_set_algebra(size=100000, calls=100):
+    """
+    SINTER of two large sets and a small one, named largest first,
+    against intersecting in argument order as the mock used to, then
+    SINTERCARD with a LIMIT, SUNION, SDIFF and the *STORE variants.
+    """
+    r = redis_mock.Redis(db='bench-set-algebra')
+    r.flushdb()
+    for name, start in (('large-1', 0), ('large-2', size // 2)):
+        members = map(str, xrange(start, start + size))
+        for i in xrange(0, size, 10000):
+            r.sadd(name, *members[i:i + 10000])
+    r.sadd('small', *map(str, xrange(size // 2, size // 2 + 100)))
+    keys = ['large-1', 'large-2', 'small']
+
+    sets = [r.smembers(key) for key in keys]
+    start = time.time()
+    for i in xrange(calls):
+        result = sets[0]
+        for other in sets[1:]:
+            result = result.intersection(other)
+    _report("argument order intersection", calls, time.time() - start)
+
+    for name, run in [
+            ('sinter', lambda: r.sinter(keys)),
+            ('sintercard', lambda: r.sintercard(3, keys)),
+            ('sintercard limit 10', lambda: r.sintercard(3, keys, limit=10)),
+            ('sinterstore', lambda: r.sinterstore('dest', keys)),
+            ('sunion', lambda: r.sunion(keys)),
+            ('sunionstore', lambda: r.sunionstore('dest', keys)),
+            ('sdiff', lambda: r.sdiff(keys)),
+            ('sdiffstore', lambda: r.sdiffstore('dest', keys))]:
+        start = time.time()
+        for i in xrange(calls):
+            run()
+        _report("%s sizes=%d,%d,100" % (name, size, size), calls, time.time() - start)
+
+def bench_read_views(size=10000, calls=2000):
+    """
+    SMEMBERS, HGETALL and LRANGE of whole values of ``size`` elements
+    returning copies against read-only views, and a read followed by a
+    write, where the write copies the viewed value.
+    """
+    for read_views in (False, True):
+        r = redis_mock.Redis(db='bench-read-views', read_views=read_views)
+        r.flushdb()
+        members = map(str, xrange(size))
+        r.sadd('set', *members)
+        r.hmset('hash', dict(zip(members, members)))
+        r.rpush('list', *members)
+        for name, read, write in [
+                ('smembers', lambda: r.smembers('set'), lambda: r.sadd('set', 'x')),
+                ('hgetall', lambda: r.hgetall('hash'), lambda: r.hset('hash', 'x', 'x')),
+                ('lrange', lambda: r.lrange('list', 0, -1), lambda: r.lset('list', 0, 'x'))]:
+            start = time.time()
+            for i in xrange(calls):
+                read()
+            _report("%s size=%d views=%s" % (name, size, read_views), calls,
+                    time.time() - start)
+            start = time.time()
+            for i in xrange(calls):
+                read()
+                write()
+            _report("%s+write size=%d views=%s" % (name, size, read_views), calls,
+                    time.time() - start)
+
+def _value_size(value):
+    """
+    The bytes taken by ``value`` and the objects it holds, by sys.getsizeof.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for field, field_value in value.iteritems():
+            size += sys.getsizeof(field) + sys.getsizeof(field_value)
+    elif isinstance(value, (set, deque)):
+        size += sum(sys.getsizeof(element) for element in value)
+    elif hasattr(value, '_data'):
+        size += sys.getsizeof(value._data)
+    elif hasattr(value, '_ints'):
+        size += sys.getsizeof(value._ints)
+    return size
+
+def bench_compact_encodings(keys=20000, fields=5, calls=100000):
+    """
+    Many tiny hashes, integer sets and lists in their full encoding
+    against the compact ones: the bytes they take, then HGET, SISMEMBER
+    and LINDEX reads and HSET, SADD and RPUSH writes on them.
+    """
+    for compact in (False, True):
+        r = redis_mock.Redis(db='bench-compact-%s' % compact, compact_encodings=compact)
+        r.flushdb()
+        members = [str(i * 1000) for i in xrange(fields)]
+        for i in xrange(keys):
+            r.hmset('hash:%d' % i, dict(('field%d' % j, member)
+                                        for j, member in enumerate(members)))
+            r.sadd('set:%d' % i, *members)
+            r.rpush('list:%d' % i, *members)
+        for prefix in ('hash', 'set', 'list'):
+            size = sum(_value_size(r._cache['%s:%d' % (prefix, i)]) for i in xrange(keys))
+            print "%-40s %10d bytes/key (%s)" % (
+                "%s compact=%s" % (prefix, compact), size / keys,
+                r.object_encoding('%s:0' % prefix))
+        for name, command in [
+                ('hget', lambda key: r.hget('hash:%d' % key, 'field1')),
+                ('sismember', lambda key: r.sismember('set:%d' % key, '1000')),
+                ('lindex', lambda key: r.lindex('list:%d' % key, 1)),
+                ('hset', lambda key: r.hset('hash:%d' % key, 'field1', 'x')),
+                ('sadd', lambda key: r.sadd('set:%d' % key, '1000')),
+                ('rpush+rpop', lambda key: (r.rpush('list:%d' % key, 'x'),
+                                            r.rpop('list:%d' % key)))]:
+            start = time.time()
+            for i in xrange(calls):
+                command(i % keys)
+            _report("%s compact=%s" % (name, compact), calls, time.time() - start)
+
+def bench_counters(ops=200000, keys=1000, thread_counts=(1, 4)):
+    """
+    Counter workloads: INCR, INCRBY, DECR and HINCRBY on ``keys`` hot
+    counters, INCRBYFLOAT, INCR mixed with GET, and threads incrementing
+    their own counters.
+    """
+    r = redis_mock.Redis(db='bench-counters')
+    r.flushdb()
+    names = ['counter:%d' % i for i in xrange(keys)]
+    for name, command in [
+            ('incr', lambda key: r.incr(key)),
+            ('incrby', lambda key: r.incrby(key, 5)),
+            ('decr', lambda key: r.decr(key)),
+            ('hincrby', lambda key: r.hincrby('hash', key, 1)),
+            ('incrbyfloat', lambda key: r.incrbyfloat('float:' + key, 0.5)),
+            ('incr+get', lambda key: (r.incr(key), r.get(key)))]:
+        start = time.time()
+        for i in xrange(ops):
+            command(names[i % keys])
+        _report("%s %d keys" % (name, keys), ops, time.time() - start)
+
+    for thread_count in thread_counts:
+        def target(index):
+            key = 'thread-counter:%d' % index
+            for i in xrange(ops // thread_count):
+                r.incr(key)
+        elapsed = _run_threads(target, thread_count)
+        _report("incr threads=%d" % thread_count, ops, elapsed)
+
+def _suite_tests(pipeline_size):
+    """
+    The commands of bench_suite by family, in the order they run. Each
+    test is ``(family, name, run)`` where ``run(r, key, value)`` runs one
+    command, or a pipeline of ``pipeline_size`` commands.
+    """
+    def pipelined(name, with_value):
+        def run(r, key, value):
+            pipe = r.pipeline(transaction=False)
+            command = getattr(pipe, name)
+            args = (key, value) if with_value else (key,)
+            for i in xrange(pipeline_size):
+                command(*args)
+            pipe.execute()
+        return run
+    return [
+        ('strings', 'set', lambda r, key, value: r.set(key, value)),
+        ('strings', 'get', lambda r, key, value: r.get(key)),
+        ('strings', 'incr', lambda r, key, value: r.incr('counter:' + key)),
+        ('lists', 'lpush', lambda r, key, value: r.lpush('list:' + key, value)),
+        ('lists', 'rpush', lambda r, key, value: r.rpush('list:' + key, value)),
+        ('lists', 'lindex', lambda r, key, value: r.lindex('list:' + key, 0)),
+        ('lists', 'lrange_100', lambda r, key, value: r.lrange('list:' + key, 0, 99)),
+        ('lists', 'lpop', lambda r, key, value: r.lpop('list:' + key)),
+        ('lists', 'rpop', lambda r, key, value: r.rpop('list:' + key)),
+        ('hashes', 'hset', lambda r, key, value: r.hset('hash:' + key[-2:], key, value)),
+        ('hashes', 'hget', lambda r, key, value: r.hget('hash:' + key[-2:], key)),
+        ('hashes', 'hgetall', lambda r, key, value: r.hgetall('hash:' + key[-2:])),
+        ('sets', 'sadd', lambda r, key, value: r.sadd('set:' + key[-2:], key)),
+        ('sets', 'sismember', lambda r, key, value: r.sismember('set:' + key[-2:], key)),
+        ('sets', 'smembers', lambda r, key, value: r.smembers('set:' + key[-2:])),
+        ('sets', 'srem', lambda r, key, value: r.srem('set:' + key[-2:], key)),
+        ('zsets', 'zadd', lambda r, key, value: r.zadd('zset:' + key[-2:], key, len(key))),
+        ('zsets', 'zscore', lambda r, key, value: r.zscore('zset:' + key[-2:], key)),
+        ('zsets', 'zrange_100', lambda r, key, value: r.zrange('zset:' + key[-2:], 0, 99)),
+        ('pipelines', 'set_p%d' % pipeline_size, pipelined('set', True)),
+        ('pipelines', 'get_p%d' % pipeline_size, pipelined('get', False)),
+    ]
+
+def bench_suite(ops=20000, value_sizes=(3, 1024), key_counts=(1000, 100000),
+                thread_counts=(1, 4), pipeline_size=100, families=None):
+    """
+    A redis-benchmark style run of the commands of each family (strings,
+    lists, hashes, sets, zsets and pipelines) over random keys, for each
+    value size, number of keys and number of threads. Reports the ops/sec
+    and the latency percentiles of each command; a pipeline counts as
+    ``pipeline_size`` ops and its latency is that of the whole batch.
+    """
+    tests = [test for test in _suite_tests(pipeline_size)
+             if families is None or test[0] in families]
+    for value_size in value_sizes:
+        value = 'x' * value_size
+        for key_count in key_counts:
+            for thread_count in thread_counts:
+                r = redis_mock.Redis(host='bench-suite', lock_stripes=16)
+                r.flushdb()
+                per_thread = ops // thread_count
+                keys = []
+                for index in xrange(thread_count):
+                    rand = random.Random(index)
+                    keys.append(['key:%012d' % rand.randrange(key_count)
+                                 for i in xrange(per_thread)])
+                for family, name, run in tests:
+                    batch = pipeline_size if family == 'pipelines' else 1
+                    calls = max(1, per_thread // batch)
+                    histograms = [redis_mock.LatencyHistogram()
+                                  for index in xrange(thread_count)]
+                    def work(index):
+                        add = histograms[index].add
+                        for key in keys[index][:calls]:
+                            start = time.time()
+                            run(r, key, value)
+                            add(int((time.time() - start) * 1000000))
+                    elapsed = _run_threads(work, thread_count)
+                    for histogram in histograms[1:]:
+                        histograms[0].merge(histogram)
+                    _report("%s size=%d keys=%d threads=%d" % (name, value_size, key_count,
+                                                               thread_count),
+                            calls * batch * thread_count, elapsed, histograms[0])
+
+def _commit():
+    """
+    Returns the git commit of the working tree, or None.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _compare(path):
+    """
+    Prints the ops/sec of the results next to those of an earlier run.
+    """
+    with open(path) as fp:
+        before = json.load(fp)
+    old = dict(((result['benchmark'], result['name']), result['ops_per_sec'])
+               for result in before['results'])
+    print "== compared with %s ==" % (before.get('commit') or path)
+    for result in _results:
+        old_ops = old.get((result['benchmark'], result['name']))
+        if old_ops:
+            print "%-40s %12.0f %12.0f %+7.1f%%" % (
+                result['name'], old_ops, result['ops_per_sec'],
+                (result['ops_per_sec'] / old_ops - 1) * 100)
+
+def main(argv):
+    global _benchmark
+    parser = optparse.OptionParser(usage="python benchmarks.py [options] [name ...]")
+    parser.add_option('--json', help="write the results to a JSON file")
+    parser.add_option('--compare', metavar='JSON',
+                      help="compare the results with those of an earlier --json")
+    options, names = parser.parse_args(argv)
+    names = names or sorted(name[len('bench_'):] for name in globals()
+                            if name.startswith('bench_'))
+    for name in names:
+        print "== %s ==" % name
+        _benchmark = name
+        globals()['bench_' + name]()
+    if options.json:
+        with open(options.json, 'w') as fp:
+            json.dump({
+                'commit': _commit(),
+                'python': platform.python_version(),
+                'time': time.time(),
+                'results': _results,
+            }, fp, indent=2, sort_keys=True)
+    if options.compare:
+        _compare(options.compare)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
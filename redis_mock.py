@@ -1,23 +1,52 @@
 #:coding=utf-8:
 
-import contextlib
+import bisect
+import copy
+import datetime
+import fnmatch
+import heapq
+import marshal
+import math
+import mmap
+import optparse
+import os
+import random
+import re
+import socket
+import SocketServer
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import Mapping, Sequence, Set, defaultdict, deque
+from itertools import imap, islice
 try:
     import threading
 except ImportError:
     import dummy_threading as threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from redis import (
     Redis as BaseRedis,
+    DataError,
     RedisError,
     ResponseError,
+    WatchError,
 )
 from redis.client import list_or_args
 
 __all__ = (
     'Redis',
     'Pipeline',
+    'RespServer',
+    'replay_trace',
     'RedisError',
     'ResponseError',
+    'WatchError',
 )
 
 # Global in memory caches of data and
@@ -25,6 +54,36 @@ __all__ = (
 _caches = {}
 _locks = {}
 
+# Version counters of the keys that are being WATCHed, for each redis
+# connection. Maps each key to [number of watching pipelines, version].
+_watches = {}
+
+# The time of the last successful snapshot of each server and the threads
+# waiting for background snapshots, by "host:port".
+_lastsave = {}
+_bgsaves = {}
+_bgsaves_lock = threading.Lock()
+
+# The AppendOnlyFile of each server with appendonly enabled.
+_aofs = {}
+
+class _LockContext(object):
+    """
+    A reusable context manager that calls ``enter`` and ``leave``.
+    Unlike a contextlib generator nothing is allocated when it's used.
+    """
+    __slots__ = ('enter', 'leave')
+
+    def __init__(self, enter, leave):
+        self.enter = enter
+        self.leave = leave
+
+    def __enter__(self):
+        self.enter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.leave()
+
 class RWLock(object):
     """
     Classic implementation of reader-writer lock with preference to writers.
@@ -37,23 +96,32 @@ class RWLock(object):
         reader_leaves()
         writer_enters()
         writer_leaves()
+
+    reader() and writer() accept the keys a command touches so that
+    RWLock and StripedRWLock are interchangeable. They are ignored here.
+
+    When the lock is uncontended entering and leaving only take the
+    internal mutex; the semaphores are used only to park waiting threads.
     """
+    stripe_count = 1
+
     def __init__(self):
-        self.mutex     = threading.RLock()
+        self.mutex     = threading.Lock()
         self.can_read  = threading.Semaphore(0)
         self.can_write = threading.Semaphore(0)
         self.active_readers  = 0
         self.active_writers  = 0
         self.waiting_readers = 0
         self.waiting_writers = 0
+        self._reader = _LockContext(self.reader_enters, self.reader_leaves)
+        self._writer = _LockContext(self.writer_enters, self.writer_leaves)
 
     def reader_enters(self):
         with self.mutex:
             if self.active_writers == 0 and self.waiting_writers == 0:
                 self.active_readers += 1
-                self.can_read.release()
-            else:
-                self.waiting_readers += 1
+                return
+            self.waiting_readers += 1
         self.can_read.acquire()
 
     def reader_leaves(self):
@@ -64,21 +132,15 @@ class RWLock(object):
                 self.waiting_writers -= 1
                 self.can_write.release()
 
-    @contextlib.contextmanager
-    def reader(self):
-        self.reader_enters()
-        try:
-            yield
-        finally:
-            self.reader_leaves()
+    def reader(self, *keys):
+        return self._reader
 
     def writer_enters(self):
         with self.mutex:
             if self.active_writers == 0 and self.waiting_writers == 0 and self.active_readers == 0:
                 self.active_writers += 1
-                self.can_write.release()
-            else:
-                self.waiting_writers += 1
+                return
+            self.waiting_writers += 1
         self.can_write.acquire()
 
     def writer_leaves(self):
@@ -96,13 +158,4787 @@ class RWLock(object):
                     self.can_read.release()
                     t -= 1
 
-    @contextlib.contextmanager
-    def writer(self):
-        self.writer_enters()
-        try:
-            yield
-        finally:
-            self.writer_leaves()
+    def writer(self, *keys):
+        return self._writer
+
+class _NullContext(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+class NullLock(object):
+    """
+    Used instead of RWLock by connections created with ``threadsafe=False``.
+    Entering it does nothing at all.
+    """
+    stripe_count = 1
+    _context = _NullContext()
+
+    def reader(self, *keys):
+        return self._context
+
+    def writer(self, *keys):
+        return self._context
+
+class StripedRWLock(object):
+    """
+    A fixed number of RWLocks ("stripes") guarding a single keyspace.
+
+    Each key hashes to one stripe so commands on unrelated keys don't
+    contend with each other. Multi-key commands take their stripes in
+    ascending order, which keeps two commands from ever waiting on each
+    other in a cycle. Commands that pass no keys (FLUSHDB etc.) take every
+    stripe.
+    """
+    def __init__(self, stripe_count):
+        if stripe_count < 1:
+            raise ValueError("stripe_count must be a positive integer")
+        self.stripe_count = stripe_count
+        self.stripes = [RWLock() for i in xrange(stripe_count)]
+        self._all = range(stripe_count)
+
+    def _indexes(self, keys):
+        if not keys:
+            return self._all
+        return sorted(set(hash(key) % self.stripe_count for key in keys))
+
+    def reader(self, *keys):
+        if len(keys) == 1:
+            return self.stripes[hash(keys[0]) % self.stripe_count]._reader
+        return self._reader(keys)
+
+    def writer(self, *keys):
+        if len(keys) == 1:
+            return self.stripes[hash(keys[0]) % self.stripe_count]._writer
+        return self._writer(keys)
+
+    def _reader(self, keys):
+        return _StripesContext([self.stripes[i] for i in self._indexes(keys)],
+                               RWLock.reader_enters, RWLock.reader_leaves)
+
+    def _writer(self, keys):
+        return _StripesContext([self.stripes[i] for i in self._indexes(keys)],
+                               RWLock.writer_enters, RWLock.writer_leaves)
+
+class _StripesContext(object):
+    """
+    Like _LockContext, but enters each of ``stripes`` in turn and leaves
+    them in reverse order.
+    """
+    __slots__ = ('stripes', 'enter', 'leave')
+
+    def __init__(self, stripes, enter, leave):
+        self.stripes = stripes
+        self.enter = enter
+        self.leave = leave
+
+    def __enter__(self):
+        entered = []
+        try:
+            for stripe in self.stripes:
+                self.enter(stripe)
+                entered.append(stripe)
+        except:
+            for stripe in reversed(entered):
+                self.leave(stripe)
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for stripe in reversed(self.stripes):
+            self.leave(stripe)
+
+def _get_lock(name, stripe_count=None):
+    """
+    Returns the lock shared by every connection to the database ``name``.
+
+    All connections to a database must agree on the locking mode, otherwise
+    they would not exclude each other.
+    """
+    lock = _locks.get(name)
+    if lock is None:
+        if stripe_count:
+            new_lock = StripedRWLock(stripe_count)
+        else:
+            new_lock = RWLock()
+        lock = _locks.setdefault(name, new_lock)
+    if stripe_count and lock.stripe_count != stripe_count:
+        raise RedisError("%s is already locked with %d stripe(s)"
+                         % (name, lock.stripe_count))
+    return lock
+
+def _first_key(client, args):
+    return (client._to_str(args[0]),)
+
+def _all_keys(client, args):
+    return [client._to_str(arg) for arg in args]
+
+def _list_or_args_keys(client, args):
+    return [client._to_str(key) for key in list_or_args(args[0], args[1:])]
+
+def _no_keys(client, args):
+    return ()
+
+def _first_arg_keys(client, args):
+    return [client._to_str(key) for key in args[0]]
+
+def _store_keys(client, args):
+    return [client._to_str(key) for key in [args[0]] + list_or_args(args[1], args[2:])]
+
+def _two_keys(client, args):
+    return [client._to_str(key) for key in args[:2]]
+
+class _KeySampler(object):
+    """
+    A set of keys that can hand out random members in O(1).
+    """
+    def __init__(self):
+        self.keys = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        if key not in self.positions:
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+
+    def discard(self, key):
+        i = self.positions.pop(key, None)
+        if i is None:
+            return
+        last = self.keys.pop()
+        if i < len(self.keys):
+            self.keys[i] = last
+            self.positions[last] = i
+
+    def sample(self, count):
+        keys = self.keys
+        indexes = random.sample(xrange(len(keys)), min(count, len(keys)))
+        return [keys[i] for i in indexes]
+
+class MemoryLimit(object):
+    """
+    maxmemory accounting and eviction for one Keyspace.
+
+    The size of each key is estimated from its length and, for
+    collections, the number of elements times the size of one of them, so
+    updating it after a write is O(1). Like the Redis server, eviction
+    looks at ``samples`` random keys and evicts the best candidate for the
+    policy instead of keeping the keys ordered, so it's O(1) per evicted
+    key too.
+
+    Writers holding different lock stripes and readers recording their
+    accesses update the accounting at once, so it's guarded by ``mutex``.
+    """
+    POLICIES = (
+        'noeviction',
+        'allkeys-lru',
+        'allkeys-lfu',
+        'allkeys-random',
+        'volatile-lru',
+        'volatile-lfu',
+        'volatile-random',
+        'volatile-ttl',
+    )
+
+    # Rough per-key cost of the dict entries and object headers.
+    KEY_OVERHEAD = 64
+    ELEMENT_OVERHEAD = 48
+
+    # The LFU counter works as in the Redis server: it starts at
+    # LFU_INIT_VAL, grows logarithmically with the number of accesses and
+    # is decremented for every LFU_DECAY_TIME seconds a key goes unused.
+    LFU_INIT_VAL = 5
+    LFU_LOG_FACTOR = 10
+    LFU_DECAY_TIME = 60
+
+    def __init__(self, keyspace, maxmemory, policy='noeviction', samples=5,
+                 clock=time.time):
+        self.keyspace = keyspace
+        self.clock = clock
+        self.mutex = threading.Lock()
+        self.configure(maxmemory, policy, samples)
+        self.used_memory = 0
+        self.evicted_keys = 0
+        self.sizes = {}
+        # key -> [LRU tick, LFU counter, time of the last LFU decrement]
+        self.access = {}
+        self.tick = 0
+        self.all_keys = _KeySampler()
+        self.volatile_keys = _KeySampler()
+        self.update(list(keyspace))
+        for key in keyspace.expires:
+            self.volatile_keys.add(key)
+
+    def configure(self, maxmemory, policy, samples):
+        if policy not in self.POLICIES:
+            raise ResponseError("Invalid maxmemory-policy: %s" % policy)
+        self.maxmemory = int(maxmemory)
+        self.policy = policy
+        self.samples = max(int(samples), 1)
+
+    @classmethod
+    def size_of(cls, key, value):
+        size = cls.KEY_OVERHEAD + len(key)
+        if isinstance(value, str):
+            return size + len(value)
+        if isinstance(value, int):
+            return size + 8
+        if not value:
+            return size
+        if type(value) in _COMPACT_TYPES:
+            return size + value.packed_size()
+        if isinstance(value, dict):
+            k, v = next(value.iteritems())
+            element = len(k) + len(v)
+        elif isinstance(value, deque):
+            element = len(value[0])
+        elif isinstance(value, SortedSet):
+            element = len(next(iter(value.scores))) + 8
+        else:
+            element = len(next(iter(value)))
+        return size + len(value) * (cls.ELEMENT_OVERHEAD + element)
+
+    def update(self, keys):
+        """
+        Recomputes the size of ``keys`` after a command wrote them.
+        """
+        keyspace = self.keyspace
+        with self.mutex:
+            for key in keys:
+                value = dict.get(keyspace, key)
+                if value is None:
+                    self._forget(key)
+                    continue
+                size = self.size_of(key, value)
+                old = self.sizes.get(key)
+                if old is None:
+                    old = 0
+                    self.all_keys.add(key)
+                    self.access[key] = [self.tick, self.LFU_INIT_VAL, self.clock()]
+                self.sizes[key] = size
+                self.used_memory += size - old
+
+    def forget(self, key):
+        with self.mutex:
+            self._forget(key)
+
+    def _forget(self, key):
+        size = self.sizes.pop(key, None)
+        if size is None:
+            return
+        self.used_memory -= size
+        self.all_keys.discard(key)
+        self.volatile_keys.discard(key)
+        self.access.pop(key, None)
+
+    def clear(self):
+        with self.mutex:
+            self.used_memory = 0
+            self.sizes.clear()
+            self.access.clear()
+            self.all_keys = _KeySampler()
+            self.volatile_keys = _KeySampler()
+
+    def set_volatile(self, key, volatile):
+        """
+        Adds ``key`` to or removes it from the keys the volatile-* policies
+        may evict.
+        """
+        with self.mutex:
+            if volatile:
+                self.volatile_keys.add(key)
+            else:
+                self.volatile_keys.discard(key)
+
+    def touch(self, keys):
+        """
+        Records an access to ``keys`` for the LRU and LFU policies.
+        """
+        lfu = self.policy.endswith('lfu')
+        with self.mutex:
+            self.tick += 1
+            for key in keys:
+                entry = self.access.get(key)
+                if entry is None:
+                    continue
+                entry[0] = self.tick
+                if lfu:
+                    counter = self._decayed(entry)
+                    if counter < 255:
+                        base = max(counter - self.LFU_INIT_VAL, 0)
+                        if random.random() < 1.0 / (base * self.LFU_LOG_FACTOR + 1):
+                            counter += 1
+                    entry[1] = counter
+
+    def _decayed(self, entry):
+        now = self.clock()
+        periods = int((now - entry[2]) // self.LFU_DECAY_TIME)
+        if periods:
+            entry[1] = max(entry[1] - periods, 0)
+            entry[2] = now
+        return entry[1]
+
+    def over_limit(self):
+        return self.maxmemory and self.used_memory > self.maxmemory
+
+    def evict(self, watched):
+        """
+        Evicts keys until the used memory is within maxmemory. Returns
+        False if the policy leaves nothing that could be evicted.
+        """
+        while self.over_limit():
+            with self.mutex:
+                key = self._pick()
+            if key is None:
+                return False
+            # Deleting the key takes the mutex again to forget it.
+            del self.keyspace[key]
+            self.evicted_keys += 1
+            if self.keyspace.aof is not None:
+                self.keyspace.aof.log(self.keyspace.db, None, _commands['delete'], (key,), 1)
+            if watched:
+                _touch(watched, [key])
+        return True
+
+    def _pick(self):
+        policy = self.policy
+        if policy == 'noeviction':
+            return None
+        if policy.startswith('volatile'):
+            sampler = self.volatile_keys
+        else:
+            sampler = self.all_keys
+        if not sampler:
+            return None
+        candidates = sampler.sample(self.samples)
+        if policy.endswith('random'):
+            return candidates[0]
+        if policy.endswith('lru'):
+            return min(candidates, key=lambda key: self.access[key][0])
+        if policy.endswith('lfu'):
+            return min(candidates, key=lambda key: self._decayed(self.access[key]))
+        expires = self.keyspace.expires
+        return min(candidates, key=lambda key: expires[key])
+
+def _next_cursor(cursor, bits):
+    """
+    Increments the low ``bits`` bits of ``cursor`` with the bit order
+    reversed, and returns 0 once every bucket has been visited.
+    """
+    if not bits:
+        return 0
+    digits = '0%db' % bits
+    cursor = int(format(cursor & ((1 << bits) - 1), digits)[::-1], 2) + 1
+    if cursor >> bits:
+        return 0
+    return int(format(cursor, digits)[::-1], 2)
+
+class _ScanIndex(object):
+    """
+    The keys of a database or the members of a collection, bucketed by
+    hash so that a SCAN step only looks at the buckets it returns.
+
+    Like the Redis server's, cursors visit the buckets in reverse binary
+    order. When the number of buckets doubles, each visited bucket splits
+    into buckets that are before the cursor in that order, so members
+    present during the whole scan are returned at least once however the
+    index grows between steps.
+    """
+    LOAD = 4
+
+    def __init__(self, members=()):
+        self.bits = 0
+        self.buckets = {}
+        self.size = 0
+        for member in members:
+            self.add(member)
+
+    def add(self, member):
+        bucket_id = hash(member) & ((1 << self.bits) - 1)
+        bucket = self.buckets.get(bucket_id)
+        if bucket is None:
+            bucket = self.buckets[bucket_id] = set()
+        elif member in bucket:
+            return
+        bucket.add(member)
+        self.size += 1
+        if self.size > self.LOAD << self.bits:
+            self._grow()
+
+    def discard(self, member):
+        bucket_id = hash(member) & ((1 << self.bits) - 1)
+        bucket = self.buckets.get(bucket_id)
+        if bucket is not None and member in bucket:
+            bucket.remove(member)
+            self.size -= 1
+            if not bucket:
+                del self.buckets[bucket_id]
+
+    def _grow(self):
+        self.bits += 1
+        mask = (1 << self.bits) - 1
+        buckets = {}
+        for bucket in self.buckets.itervalues():
+            for member in bucket:
+                buckets.setdefault(hash(member) & mask, set()).add(member)
+        self.buckets = buckets
+
+    def scan(self, cursor, count):
+        """
+        Returns the next cursor and the members of the buckets from
+        ``cursor`` on, stopping once there are at least ``count``.
+        """
+        bits = self.bits
+        mask = (1 << bits) - 1
+        buckets = self.buckets
+        found = []
+        while True:
+            bucket = buckets.get(cursor & mask)
+            if bucket:
+                found.extend(bucket)
+            cursor = _next_cursor(cursor, bits)
+            if not cursor or len(found) >= count:
+                return cursor, found
+
+class _ScanIndexes(object):
+    """
+    The _ScanIndex of the keys of a Keyspace, created by its first SCAN
+    and kept up to date after each write, and those of the collections
+    being scanned, which are dropped when the collection is written to
+    and rebuilt by the next step.
+    """
+    def __init__(self, keyspace):
+        self.keyspace = keyspace
+        self.mutex = threading.Lock()
+        self.keys = _ScanIndex(keyspace)
+        self.members = {}
+
+    def update(self, keys):
+        keyspace = self.keyspace
+        with self.mutex:
+            for key in keys:
+                if key in keyspace:
+                    self.keys.add(key)
+                else:
+                    self.keys.discard(key)
+                if self.members:
+                    self.members.pop(key, None)
+
+    def forget(self, key):
+        with self.mutex:
+            self.keys.discard(key)
+            self.members.pop(key, None)
+
+    def clear(self):
+        with self.mutex:
+            self.keys = _ScanIndex()
+            self.members.clear()
+
+    def scan_keys(self, cursor, count):
+        with self.mutex:
+            return self.keys.scan(cursor, count)
+
+    def scan_members(self, key, members, cursor, count):
+        with self.mutex:
+            index = self.members.get(key)
+            if index is None:
+                index = self.members[key] = _ScanIndex(members)
+            cursor, found = index.scan(cursor, count)
+            if not cursor:
+                del self.members[key]
+            return cursor, found
+
+# The default of Keyspace.pop(), told apart from any stored value.
+_missing = object()
+
+class Keyspace(dict):
+    """
+    The keys and values of one database.
+
+    Expiry deadlines (in milliseconds of the connection's clock) are kept
+    apart from the values in ``expires`` and are dropped together with
+    their keys. Once an ExpirySweeper is attached the deadlines are also
+    pushed onto ``heap`` so the sweeper only looks at keys that are due.
+    ``limit`` is the MemoryLimit of the database when maxmemory is set and
+    ``aof`` the AppendOnlyFile of its server, which logs writes under the
+    database's name ``db``. ``scans`` holds the _ScanIndexes once the
+    database has been scanned, ``stats`` the CommandStats of its server
+    while latency tracking is on and ``trace`` its CommandTrace while it's
+    being traced. ``views`` maps the keys whose values were handed out as
+    read-only views to those values, which the next write to the key
+    replaces with a copy. ``encodings`` holds the Encodings thresholds
+    while small values are kept compact.
+
+    ``types`` counts the keys holding each type of value and is updated
+    as keys are set and deleted, so type_counts() doesn't look at them.
+    Writers holding different lock stripes may update it at once, hence
+    ``types_lock``.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.types = defaultdict(int)
+        self.types_lock = threading.Lock()
+        self.expires = {}
+        self.heap = None
+        self.sweeper = None
+        self.limit = None
+        self.aof = None
+        self.db = None
+        self.scans = None
+        self.stats = None
+        self.trace = None
+        self.views = {}
+        self.encodings = None
+
+    def __setitem__(self, key, value):
+        old = dict.get(self, key)
+        if old is None:
+            with self.types_lock:
+                self.types[type(value)] += 1
+        elif type(old) is not type(value):
+            with self.types_lock:
+                self.types[type(old)] -= 1
+                self.types[type(value)] += 1
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        value = dict.pop(self, key)
+        with self.types_lock:
+            self.types[type(value)] -= 1
+        self.expires.pop(key, None)
+        self.views.pop(key, None)
+        if self.limit is not None:
+            self.limit.forget(key)
+        if self.scans is not None:
+            self.scans.forget(key)
+
+    def pop(self, key, *default):
+        value = dict.pop(self, key, _missing)
+        if value is _missing:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        with self.types_lock:
+            self.types[type(value)] -= 1
+        self.expires.pop(key, None)
+        self.views.pop(key, None)
+        if self.limit is not None:
+            self.limit.forget(key)
+        if self.scans is not None:
+            self.scans.forget(key)
+        return value
+
+    def clear(self):
+        dict.clear(self)
+        with self.types_lock:
+            self.types.clear()
+        self.expires.clear()
+        self.views.clear()
+        if self.heap is not None:
+            del self.heap[:]
+        if self.limit is not None:
+            self.limit.clear()
+        if self.scans is not None:
+            self.scans.clear()
+
+    def type_counts(self):
+        """
+        Returns the number of keys of each type, by type name.
+        """
+        counts = dict.fromkeys(_TYPE_NAMES.itervalues(), 0)
+        for value_type, count in self.types.items():
+            counts[_TYPE_NAMES[value_type]] += count
+        return counts
+
+    def scan(self, cursor, count):
+        """
+        Returns the next cursor and about ``count`` keys from ``cursor``.
+        """
+        if self.scans is None:
+            self.scans = _ScanIndexes(self)
+        return self.scans.scan_keys(cursor, count)
+
+    def scan_members(self, key, members, cursor, count):
+        """
+        Returns the next cursor and about ``count`` of ``members``, the
+        collection stored at ``key``, from ``cursor``.
+        """
+        if self.scans is None:
+            self.scans = _ScanIndexes(self)
+        return self.scans.scan_members(key, members, cursor, count)
+
+    def expire_at(self, key, deadline):
+        self.expires[key] = deadline
+        if self.heap is not None:
+            heapq.heappush(self.heap, (deadline, key))
+        if self.limit is not None:
+            self.limit.set_volatile(key, True)
+
+    def persist(self, key):
+        if self.limit is not None:
+            self.limit.set_volatile(key, False)
+        return self.expires.pop(key, None) is not None
+
+class ExpirySweeper(threading.Thread):
+    """
+    Deletes expired keys of one database in the background, the way the
+    Redis server's active expire cycle does, so keys that are never read
+    again don't linger. Expired keys that are accessed are removed lazily
+    by the command that touches them either way.
+
+    Each sweep pops at most ``limit`` due deadlines off the keyspace's heap;
+    entries for deadlines that have since changed are skipped.
+    """
+    def __init__(self, client, interval=0.1, limit=1000):
+        threading.Thread.__init__(self, name='redis_mock-expire-%s' % client._name)
+        self.daemon = True
+        self.keyspace = client._cache
+        self.lock = client._lock
+        self.watched = client._watched
+        self.clock = client._clock
+        self.interval = interval
+        self.limit = limit
+        self._stopped = threading.Event()
+
+        # Called with the writer lock held by Redis._start_sweeper.
+        self.keyspace.heap = [(deadline, key) for key, deadline
+                              in self.keyspace.expires.iteritems()]
+        heapq.heapify(self.keyspace.heap)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.sweep()
+
+    def stop(self):
+        self._stopped.set()
+
+    def sweep(self):
+        """
+        Deletes keys whose deadline has passed and returns how many.
+        """
+        keyspace = self.keyspace
+        with self.lock.writer():
+            heap = keyspace.heap
+            expires = keyspace.expires
+            now = int(self.clock() * 1000)
+            expired = 0
+            while heap and heap[0][0] <= now and expired < self.limit:
+                deadline, key = heapq.heappop(heap)
+                if expires.get(key) == deadline:
+                    del keyspace[key]
+                    expired += 1
+                    if self.watched:
+                        _touch(self.watched, [key])
+            # Drop stale entries left by keys that were re-expired or
+            # persisted once they make up most of the heap.
+            if len(heap) > 2 * len(expires) + 64:
+                keyspace.heap = [(d, k) for k, d in expires.iteritems()]
+                heapq.heapify(keyspace.heap)
+            return expired
+
+class _Max(object):
+    """
+    Compares greater than any other object, so (score, _MAX) sorts after
+    every (score, member) pair with the same score.
+    """
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return other is not self
+
+_MAX = _Max()
+
+class SortedSet(object):
+    """
+    The value of a sorted set key.
+
+    Scores are kept in a member -> score dict. The (score, member) pairs
+    are kept in order in a list of sorted blocks of at most 2 * LOAD pairs
+    each, together with the last pair of each block and a Fenwick tree over
+    the block lengths. Finding a member's rank, the pairs at a rank or the
+    first pair in a score range takes two bisections and a walk over the
+    tree, so it's O(log n) and nothing is sorted on read.
+    """
+    LOAD = 512
+
+    def __init__(self):
+        self.scores = {}
+        self._blocks = []
+        self._maxes = []
+        # Rebuilt lazily when blocks are split, merged or dropped.
+        self._tree = None
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        Builds a sorted set from (score, member) pairs that are already in
+        order, in O(n).
+        """
+        zset = cls()
+        pairs = list(pairs)
+        zset.scores = dict((member, score) for score, member in pairs)
+        zset._blocks = [pairs[i:i + cls.LOAD] for i in xrange(0, len(pairs), cls.LOAD)]
+        zset._maxes = [block[-1] for block in zset._blocks]
+        return zset
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, member):
+        return member in self.scores
+
+    def __iter__(self):
+        for block in self._blocks:
+            for score, member in block:
+                yield member
+
+    def score(self, member):
+        return self.scores.get(member)
+
+    def add(self, member, score):
+        """
+        Sets the score of ``member`` and returns whether it's new.
+        """
+        old = self.scores.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            self._remove_pair((old, member))
+        self.scores[member] = score
+        self._insert_pair((score, member))
+        return old is None
+
+    def discard(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        self._remove_pair((score, member))
+        return True
+
+    def rank(self, member):
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        return self._bisect((score, member))
+
+    def score_rank(self, score, exclusive=False):
+        """
+        Returns the rank of the first pair with a score of at least
+        ``score``, or greater than ``score`` if ``exclusive``.
+        """
+        if exclusive:
+            return self._bisect((score, _MAX))
+        return self._bisect((score,))
+
+    def pairs(self, start, stop):
+        """
+        Yields the (score, member) pairs with ranks in [start, stop).
+        """
+        if start >= stop:
+            return
+        i, j = self._locate(start)
+        count = stop - start
+        blocks = self._blocks
+        while count > 0 and i < len(blocks):
+            block = blocks[i]
+            for pair in islice(block, j, j + count):
+                yield pair
+            count -= len(block) - j
+            i += 1
+            j = 0
+
+    def _bisect(self, pair):
+        i = bisect.bisect_left(self._maxes, pair)
+        if i == len(self._maxes):
+            return len(self.scores)
+        return self._prefix(i) + bisect.bisect_left(self._blocks[i], pair)
+
+    def _insert_pair(self, pair):
+        blocks = self._blocks
+        maxes = self._maxes
+        if not blocks:
+            blocks.append([pair])
+            maxes.append(pair)
+            self._tree = None
+            return
+        i = bisect.bisect_left(maxes, pair)
+        if i == len(maxes):
+            i -= 1
+            block = blocks[i]
+            block.append(pair)
+            maxes[i] = pair
+        else:
+            block = blocks[i]
+            bisect.insort(block, pair)
+        if len(block) > 2 * self.LOAD:
+            blocks[i:i + 1] = [block[:self.LOAD], block[self.LOAD:]]
+            maxes[i:i + 1] = [block[self.LOAD - 1], block[-1]]
+            self._tree = None
+        elif self._tree is not None:
+            self._update(i, 1)
+
+    def _remove_pair(self, pair):
+        blocks = self._blocks
+        maxes = self._maxes
+        i = bisect.bisect_left(maxes, pair)
+        block = blocks[i]
+        del block[bisect.bisect_left(block, pair)]
+        if len(block) < self.LOAD // 2 and len(blocks) > 1:
+            # Merge small blocks into a neighbour to keep the number of
+            # blocks proportional to the number of pairs.
+            if i == len(blocks) - 1:
+                i -= 1
+            merged = blocks[i] + blocks[i + 1]
+            if len(merged) > 2 * self.LOAD:
+                half = len(merged) // 2
+                blocks[i:i + 2] = [merged[:half], merged[half:]]
+                maxes[i:i + 2] = [merged[half - 1], merged[-1]]
+            else:
+                blocks[i:i + 2] = [merged]
+                maxes[i:i + 2] = [merged[-1]]
+            self._tree = None
+        elif not block:
+            del blocks[i]
+            del maxes[i]
+            self._tree = None
+        else:
+            maxes[i] = block[-1]
+            if self._tree is not None:
+                self._update(i, -1)
+
+    def _get_tree(self):
+        tree = self._tree
+        if tree is None:
+            n = len(self._blocks)
+            tree = [0] * (n + 1)
+            for i in xrange(1, n + 1):
+                tree[i] += len(self._blocks[i - 1])
+                parent = i + (i & -i)
+                if parent <= n:
+                    tree[parent] += tree[i]
+            self._tree = tree
+        return tree
+
+    def _update(self, i, delta):
+        tree = self._tree
+        i += 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, i):
+        """
+        Returns the number of pairs in the blocks before block ``i``.
+        """
+        tree = self._get_tree()
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, rank):
+        """
+        Returns the block holding the pair at ``rank`` and its position
+        within that block.
+        """
+        tree = self._get_tree()
+        n = len(tree) - 1
+        i = 0
+        step = 1
+        while step * 2 <= n:
+            step *= 2
+        while step:
+            if i + step <= n and tree[i + step] <= rank:
+                i += step
+                rank -= tree[i]
+            step //= 2
+        return i, rank
+
+def _touch(watched, keys):
+    """
+    Bumps the versions of the watched ``keys``, or of every watched key
+    when ``keys`` is empty, so that transactions WATCHing them abort.
+    """
+    if not keys:
+        keys = watched.keys()
+    for key in keys:
+        entry = watched.get(key)
+        if entry is not None:
+            entry[1] += 1
+
+class Command(object):
+    """
+    A registered command implementation.
+
+    ``write`` says whether the command modifies the keyspace, which decides
+    whether it runs under the reader or the writer lock. ``keys`` returns
+    the keys touched by a call given the connection and the arguments, so
+    that only their lock stripes are taken. ``denyoom`` says whether the
+    command is refused when the database is over maxmemory and nothing can
+    be evicted; it defaults to ``write`` and is turned off for commands
+    that only remove data. ``propagate`` returns the (name, args) commands
+    to log to the append-only file after a call, given the call's result,
+    for commands whose effect can't be logged as the call itself.
+    ``watch`` is turned off for writes that change no key, such as CONFIG
+    SET, so that they don't abort WATCHing transactions even though they
+    take the whole lock.
+    """
+    __slots__ = ('name', 'func', 'write', 'keys', 'denyoom', 'propagate', 'watch')
+
+    def __init__(self, name, func, write=False, keys=_first_key, denyoom=None,
+                 propagate=None, watch=True):
+        self.name = name
+        self.func = func
+        self.write = write
+        self.keys = keys
+        self.denyoom = write if denyoom is None else denyoom
+        self.propagate = propagate
+        self.watch = watch
+
+# Command implementations keyed by command name. Each implementation takes
+# the connection it runs on as its first argument and is called by
+# Redis._execute_command, or later by Pipeline.execute, with the lock
+# already held.
+_commands = {}
+
+def command(*names, **options):
+    """
+    Registers the decorated function as the implementation of ``names``.
+    Accepts the ``write``, ``keys``, ``denyoom``, ``propagate`` and ``watch``
+    options of Command.
+    """
+    def decorator(func):
+        for name in names:
+            _commands[name] = Command(name, func, **options)
+        return func
+    return decorator
+
+def _propagate_expiry(client, args, result):
+    # Relative expire times are logged as absolute deadlines, so replaying
+    # the log later doesn't extend them.
+    name = client._to_str(args[0])
+    deadline = client._cache.expires.get(name)
+    if deadline is not None:
+        return [('pexpireat', (name, deadline))]
+    if name not in client._cache:
+        return [('delete', (name,))]
+    return []
+
+def _propagate_string(client, args, result):
+    name = client._to_str(args[0])
+    value = client._cache.get(name)
+    if value is None:
+        return [('delete', (name,))]
+    records = [('set', (name, _full_value(value)))]
+    deadline = client._cache.expires.get(name)
+    if deadline is not None:
+        records.append(('pexpireat', (name, deadline)))
+    return records
+
+def _no_propagate(client, args, result):
+    return []
+
+def _check_values(command_name, values):
+    if not values:
+        raise ResponseError("wrong number of arguments for '%s' command" % command_name)
+
+#### READ VIEWS ####
+
+class SetView(Set):
+    """
+    A read-only view of a stored set, returned by smembers() on
+    connections created with ``read_views=True``. Set operations return
+    new sets and copy() a set of the members.
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __contains__(self, value):
+        return value in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def copy(self):
+        return set(self._data)
+
+    def __repr__(self):
+        return 'SetView(%r)' % (self._data,)
+
+class HashView(Mapping):
+    """
+    A read-only view of a stored hash, returned by hgetall() on
+    connections created with ``read_views=True``. copy() returns a dict.
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def copy(self):
+        return dict(self._data)
+
+    def __repr__(self):
+        return 'HashView(%r)' % (self._data,)
+
+class ListView(Sequence):
+    """
+    A read-only view of the elements ``start`` to ``stop`` of a stored
+    list, returned by lrange() on connections created with
+    ``read_views=True``. It compares equal to a list of the same elements.
+    """
+    __slots__ = ('_data', '_start', '_stop')
+
+    def __init__(self, data, start, stop):
+        self._data = data
+        self._start = start
+        self._stop = max(start, stop)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("list index out of range")
+        return self._data[self._start + index]
+
+    def __iter__(self):
+        return islice(self._data, self._start, self._stop)
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, ListView)):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ListView(%r)' % (list(self),)
+
+def _viewed(client, name, value):
+    """
+    Marks ``value``, stored under ``name``, as having a view, so that the
+    next write to the key copies it first.
+    """
+    if name in client._cache:
+        client._cache.views[name] = value
+    return value
+
+def _unshare(keyspace, keys):
+    """
+    Replaces the viewed values of ``keys`` with copies before a write
+    changes them in place, so the views keep showing what they did.
+    """
+    views = keyspace.views
+    for key in keys:
+        value = views.pop(key, None)
+        if value is not None and keyspace.get(key) is value:
+            keyspace[key] = copy.copy(value)
+
+#### COMPACT ENCODINGS ####
+
+def _canonical_int(value):
+    """
+    Returns the integer ``value`` spells in canonical decimal form, as
+    Redis would store it in an intset, or None.
+    """
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if str(number) == value else None
+
+class IntSet(Set):
+    """
+    A set of integers kept in a sorted array of the smallest item size
+    that holds them all, like the Redis intset encoding. Its members are
+    the decimal strings of the integers, and it's never changed in place:
+    a write to the key expands it to a set first.
+    """
+    __slots__ = ('_ints',)
+
+    # The array typecodes tried in turn, with the range each one holds.
+    TYPECODES = [(typecode, -(1 << (8 * array(typecode).itemsize - 1)),
+                  (1 << (8 * array(typecode).itemsize - 1)) - 1)
+                 for typecode in 'hil']
+
+    def __init__(self, ints):
+        ints = sorted(ints)
+        for typecode, low, high in self.TYPECODES:
+            if not ints or low <= ints[0] and ints[-1] <= high:
+                break
+        else:
+            raise ValueError("integer out of range")
+        self._ints = array(typecode, ints)
+
+    @classmethod
+    def from_members(cls, members):
+        """
+        Returns an IntSet of ``members``, or None unless they are all
+        integers that fit in 64 bits.
+        """
+        ints = []
+        for member in members:
+            number = _canonical_int(member)
+            if number is None:
+                return None
+            ints.append(number)
+        try:
+            return cls(ints)
+        except ValueError:
+            return None
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __contains__(self, value):
+        number = _canonical_int(value)
+        if number is None:
+            return False
+        ints = self._ints
+        index = bisect.bisect_left(ints, number)
+        return index < len(ints) and ints[index] == number
+
+    def __iter__(self):
+        return imap(str, self._ints)
+
+    def __len__(self):
+        return len(self._ints)
+
+    def intersection(self, *others):
+        return self.expand().intersection(*others)
+
+    def difference(self, *others):
+        return self.expand().difference(*others)
+
+    def copy(self):
+        return self.expand()
+
+    def expand(self):
+        return set(imap(str, self._ints))
+
+    def packed_size(self):
+        return len(self._ints) * self._ints.itemsize
+
+    def encoding(self):
+        return 'intset'
+
+    def __repr__(self):
+        return 'IntSet(%r)' % (self._ints.tolist(),)
+
+class PackedHash(Mapping):
+    """
+    A small hash kept marshalled into a single string, standing in for
+    the Redis listpack encoding. Lookups decode the whole string, which
+    is done in C and is cheap at the sizes the encoding is used for, but
+    commands reading several fields decode it once with get_many() or
+    expand(). It's never changed in place: a write to the key expands it
+    to a dict first.
+    """
+    __slots__ = ('_data', '_len')
+
+    def __init__(self, mapping):
+        self._data = marshal.dumps(mapping)
+        self._len = len(mapping)
+
+    def __getitem__(self, key):
+        return self.expand()[key]
+
+    def __contains__(self, key):
+        return key in self.expand()
+
+    def __iter__(self):
+        return iter(self.expand())
+
+    def __len__(self):
+        return self._len
+
+    def get(self, key, default=None):
+        return self.expand().get(key, default)
+
+    def get_many(self, keys):
+        """
+        Returns the values of ``keys``, None for the missing ones.
+        """
+        get = self.expand().get
+        return [get(key) for key in keys]
+
+    def keys(self):
+        return self.expand().keys()
+
+    def values(self):
+        return self.expand().values()
+
+    def items(self):
+        return self.expand().items()
+
+    def iteritems(self):
+        return self.expand().iteritems()
+
+    def copy(self):
+        return self.expand()
+
+    def expand(self):
+        return marshal.loads(self._data)
+
+    def packed_size(self):
+        return len(self._data)
+
+    def encoding(self):
+        return 'listpack'
+
+    def __repr__(self):
+        return 'PackedHash(%r)' % (self.expand(),)
+
+class PackedList(Sequence):
+    """
+    A short list kept marshalled into a single string, standing in for
+    the Redis listpack encoding. Like PackedHash it's decoded whole by
+    each read, so ranges are read with get_range(), and expanded to a
+    deque before a write.
+    """
+    __slots__ = ('_data', '_len')
+
+    def __init__(self, elements):
+        self._data = marshal.dumps(tuple(elements))
+        self._len = len(elements)
+
+    def __getitem__(self, index):
+        return marshal.loads(self._data)[index]
+
+    def __iter__(self):
+        return iter(marshal.loads(self._data))
+
+    def __reversed__(self):
+        return reversed(marshal.loads(self._data))
+
+    def __contains__(self, value):
+        return value in marshal.loads(self._data)
+
+    def __len__(self):
+        return self._len
+
+    def get_range(self, start, stop):
+        return list(marshal.loads(self._data)[start:stop])
+
+    def expand(self):
+        return deque(marshal.loads(self._data))
+
+    def packed_size(self):
+        return len(self._data)
+
+    def encoding(self):
+        return 'listpack'
+
+    def __repr__(self):
+        return 'PackedList(%r)' % (list(self),)
+
+_COMPACT_TYPES = frozenset([IntSet, PackedHash, PackedList])
+
+class Encodings(object):
+    """
+    The size thresholds under which the hashes, sets and lists of a
+    database are kept in a compact encoding, set with the Redis config
+    parameters named in ``PARAMS``. A threshold of 0 turns the encoding
+    off.
+    """
+    PARAMS = {
+        'hash-max-listpack-entries': ('hash_max_entries', 128),
+        'hash-max-listpack-value': ('hash_max_value', 64),
+        'set-max-intset-entries': ('set_max_entries', 512),
+        'list-max-listpack-size': ('list_max_entries', 128),
+    }
+
+    def __init__(self):
+        for attr, default in self.PARAMS.itervalues():
+            setattr(self, attr, default)
+
+    def get(self, param):
+        return getattr(self, self.PARAMS[param][0])
+
+    def configure(self, param, value):
+        value = int(value)
+        if value < 0:
+            raise ValueError(value)
+        setattr(self, self.PARAMS[param][0], value)
+
+    def compact(self, value):
+        """
+        Returns ``value`` in its compact encoding, or None when it's empty
+        or over the thresholds. Only looks at every element of values that
+        are under the entry thresholds.
+        """
+        if not value:
+            return None
+        value_type = type(value)
+        if value_type is dict:
+            if len(value) > self.hash_max_entries:
+                return None
+            limit = self.hash_max_value
+            for field, field_value in value.iteritems():
+                if len(field) > limit or len(field_value) > limit:
+                    return None
+            return PackedHash(value)
+        if value_type is set:
+            if len(value) > self.set_max_entries:
+                return None
+            return IntSet.from_members(value)
+        if value_type is deque:
+            if len(value) > self.list_max_entries:
+                return None
+            return PackedList(value)
+        return None
+
+def _expand(keyspace, keys):
+    """
+    Replaces the compact values of ``keys`` with their full encoding
+    before a write changes them in place.
+    """
+    for key in keys:
+        value = dict.get(keyspace, key)
+        if value is not None and type(value) in _COMPACT_TYPES:
+            keyspace[key] = value.expand()
+
+def _compact(keyspace, keys):
+    """
+    Replaces the values of ``keys`` with their compact encoding after a
+    write when they're under the thresholds of ``keyspace.encodings``.
+    """
+    encodings = keyspace.encodings
+    for key in keys:
+        packed = encodings.compact(dict.get(keyspace, key))
+        if packed is not None:
+            keyspace[key] = packed
+
+def _full_value(value):
+    """
+    Returns ``value`` the way snapshots and rewritten logs store it, with
+    compact values expanded and integers formatted.
+    """
+    if type(value) in _COMPACT_TYPES:
+        return value.expand()
+    if isinstance(value, int):
+        return str(value)
+    return value
+
+#### BASIC KEY COMMANDS ####
+
+@command('exists')
+def _exists(client, name):
+    name = client._to_str(name)
+    return name in client._cache
+
+@command('get')
+def _get(client, name):
+    name = client._to_str(name)
+    return client._assert_str(client._cache.get(name, None))
+
+# The range of the integers INCR and friends work on, as in the server.
+_INT_MIN = -(1 << 63)
+_INT_MAX = (1 << 63) - 1
+
+def _add_int(client, name, amount):
+    """
+    Adds ``amount`` to the integer at ``name``, which is stored as an int
+    so that the next increment doesn't parse it again. GET and the other
+    string commands format it when they read it.
+    """
+    value = client._cache.get(name)
+    if type(value) is not int:
+        value = client._assert_int(client._assert_str(value))
+    value += amount
+    if not _INT_MIN <= value <= _INT_MAX:
+        raise ResponseError("increment or decrement would overflow")
+    client._cache[name] = value
+    return value
+
+@command('incr', 'incrby', write=True)
+def _incr(client, name, amount=1):
+    name = client._to_str(name)
+    return str(_add_int(client, name, client._assert_int(amount)))
+
+@command('decr', 'decrby', write=True)
+def _decr(client, name, amount=1):
+    name = client._to_str(name)
+    return str(_add_int(client, name, -client._assert_int(amount)))
+
+def _add_float(value, amount):
+    """
+    Returns the sum of the number ``value`` (or 0 when it's None) and
+    ``amount``, as INCRBYFLOAT computes it.
+    """
+    try:
+        result = float(0 if value is None else value) + float(amount)
+    except ValueError:
+        raise ResponseError("value is not a valid float")
+    if math.isnan(result) or math.isinf(result):
+        raise ResponseError("increment would produce NaN or Infinity")
+    return result
+
+@command('incrbyfloat', write=True)
+def _incrbyfloat(client, name, amount=1.0):
+    name = client._to_str(name)
+    value = _add_float(client._assert_str(client._cache.get(name)), amount)
+    # The server keeps the result as a string, so the float is only
+    # formatted here and parsed again by the next call.
+    client._cache[name] = _format_score(value)
+    return value
+
+@command('append', write=True)
+def _append(client, name, value):
+    name = client._to_str(name)
+    value = (client._assert_str(client._cache.get(name)) or '') + client._to_str(value)
+    client._cache[name] = value
+    return len(value)
+
+@command('strlen')
+def _strlen(client, name):
+    name = client._to_str(name)
+    return len(client._assert_str(client._cache.get(name)) or '')
+
+@command('getrange')
+def _getrange(client, name, start, end):
+    name = client._to_str(name)
+    value = client._assert_str(client._cache.get(name)) or ''
+    start, end = int(start), int(end)
+    # Unlike LRANGE, an end before the start of the string is clamped to
+    # its first character.
+    if start < 0:
+        start = max(len(value) + start, 0)
+    if end < 0:
+        end = max(len(value) + end, 0)
+    return value[start:end + 1]
+
+# The largest string SETRANGE may create, proto-max-bulk-len in the server.
+_MAX_STRING_SIZE = 512 << 20
+
+@command('setrange', write=True)
+def _setrange(client, name, offset, value):
+    name = client._to_str(name)
+    offset = int(offset)
+    value = client._to_str(value)
+    if offset < 0:
+        raise ResponseError("offset is out of range")
+    current = client._assert_str(client._cache.get(name)) or ''
+    if not value:
+        return len(current)
+    if offset + len(value) > _MAX_STRING_SIZE:
+        raise ResponseError("string exceeds maximum allowed size (proto-max-bulk-len)")
+    if len(current) < offset:
+        current += '\0' * (offset - len(current))
+    current = current[:offset] + value + current[offset + len(value):]
+    client._cache[name] = current
+    return len(current)
+
+def _to_ms(value, unit):
+    """
+    Converts an expire time given as a number of ``unit`` milliseconds or
+    as a timedelta to milliseconds.
+    """
+    if isinstance(value, datetime.timedelta):
+        return int(value.total_seconds() * 1000)
+    try:
+        return int(value) * unit
+    except ValueError:
+        raise ResponseError("value is not an integer or out of range")
+
+def _now_ms(client):
+    return int(client._clock() * 1000)
+
+def _set(client, name, value, nx=False, xx=False, get=False, ttl_ms=None):
+    name = client._to_str(name)
+    value = client._to_str(value)
+    prev_value = client._cache.get(name, None)
+    if isinstance(prev_value, int):
+        prev_value = str(prev_value)
+    exists = name in client._cache
+    if (nx and exists) or (xx and not exists):
+        return prev_value if get else False
+    client._cache[name] = value
+    if ttl_ms is None:
+        client._cache.persist(name)
+    else:
+        client._cache.expire_at(name, _now_ms(client) + ttl_ms)
+    return prev_value if get else True
+
+@command('set', write=True, propagate=_propagate_string)
+def _set_command(client, name, value, ex=None, px=None, nx=False, xx=False):
+    ttl_ms = None
+    if ex is not None:
+        ttl_ms = _to_ms(ex, 1000)
+    if px is not None:
+        ttl_ms = _to_ms(px, 1)
+    if ttl_ms is not None and ttl_ms <= 0:
+        raise ResponseError("invalid expire time in set")
+    return _set(client, name, value, nx=nx, xx=xx, ttl_ms=ttl_ms) or None
+
+@command('setnx', write=True, propagate=_propagate_string)
+def _setnx(client, name, value):
+    return _set(client, name, value, nx=True)
+
+@command('setex', write=True, propagate=_propagate_string)
+def _setex(client, name, value, time):
+    ttl_ms = _to_ms(time, 1000)
+    if ttl_ms <= 0:
+        raise ResponseError("invalid expire time in setex")
+    return _set(client, name, value, ttl_ms=ttl_ms)
+
+@command('psetex', write=True, propagate=_propagate_string)
+def _psetex(client, name, time_ms, value):
+    ttl_ms = _to_ms(time_ms, 1)
+    if ttl_ms <= 0:
+        raise ResponseError("invalid expire time in psetex")
+    return _set(client, name, value, ttl_ms=ttl_ms)
+
+@command('mget', keys=_list_or_args_keys)
+def _mget(client, keys, *args):
+    cache = client._cache
+    values = []
+    for key in list_or_args(keys, args):
+        value = cache.get(client._to_str(key))
+        # MGET answers nil for keys that don't hold a string.
+        if isinstance(value, int):
+            value = str(value)
+        values.append(value if isinstance(value, str) else None)
+    return values
+
+def _mset_items(client, command_name, mapping):
+    _check_values(command_name, mapping)
+    return [(client._to_str(name), client._to_str(value))
+            for name, value in mapping.iteritems()]
+
+@command('mset', write=True, keys=_first_arg_keys)
+def _mset(client, mapping):
+    cache = client._cache
+    volatile = bool(cache.expires)
+    for name, value in _mset_items(client, 'mset', mapping):
+        cache[name] = value
+        if volatile:
+            cache.persist(name)
+    return True
+
+@command('msetnx', write=True, keys=_first_arg_keys)
+def _msetnx(client, mapping):
+    items = _mset_items(client, 'msetnx', mapping)
+    cache = client._cache
+    for name, value in items:
+        if name in cache:
+            return False
+    for name, value in items:
+        cache[name] = value
+    return True
+
+@command('getset', write=True, propagate=_propagate_string)
+def _getset(client, name, value):
+    return _set(client, name, value, get=True)
+
+@command('delete', write=True, keys=_all_keys, denyoom=False)
+def _delete(client, *names):
+    names = [client._to_str(name) for name in names]
+    deleted = 0
+    for name in names:
+        if name in client._cache:
+            del client._cache[name]
+            deleted += 1
+    return deleted
+
+# The name TYPE replies with for each type of value. Lists that were set
+# directly in the keyspace are converted to deques by the list commands,
+# and ints are the values of INCR and DECR.
+_TYPE_NAMES = {
+    str: 'string',
+    int: 'string',
+    deque: 'list',
+    list: 'list',
+    set: 'set',
+    dict: 'hash',
+    SortedSet: 'zset',
+    PackedList: 'list',
+    IntSet: 'set',
+    PackedHash: 'hash',
+}
+
+def _type_name(value):
+    if value is None:
+        return 'none'
+    return _TYPE_NAMES[type(value)]
+
+@command('type')
+def _type(client, name):
+    return _type_name(client._cache.get(client._to_str(name)))
+
+def _encoding_name(value):
+    """
+    Returns the name of the Redis encoding that corresponds to how
+    ``value`` is stored.
+    """
+    if type(value) in _COMPACT_TYPES:
+        return value.encoding()
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, str):
+        number = _canonical_int(value)
+        if number is not None and -(1 << 63) <= number < (1 << 63):
+            return 'int'
+        return 'embstr' if len(value) <= 44 else 'raw'
+    if isinstance(value, SortedSet):
+        return 'skiplist'
+    if isinstance(value, (deque, list)):
+        return 'quicklist'
+    return 'hashtable'
+
+@command('object_encoding')
+def _object_encoding(client, name):
+    value = client._cache.get(client._to_str(name))
+    return None if value is None else _encoding_name(value)
+
+@command('dbsize', keys=_no_keys)
+def _dbsize(client):
+    return len(client._cache)
+
+#### EXPIRY COMMANDS ####
+
+def _expire_at(client, name, deadline):
+    name = client._to_str(name)
+    if name not in client._cache:
+        return False
+    if deadline <= _now_ms(client):
+        del client._cache[name]
+    else:
+        client._cache.expire_at(name, deadline)
+    return True
+
+@command('expire', write=True, denyoom=False, propagate=_propagate_expiry)
+def _expire(client, name, time):
+    return _expire_at(client, name, _now_ms(client) + _to_ms(time, 1000))
+
+@command('pexpire', write=True, denyoom=False, propagate=_propagate_expiry)
+def _pexpire(client, name, time):
+    return _expire_at(client, name, _now_ms(client) + _to_ms(time, 1))
+
+@command('expireat', write=True, denyoom=False, propagate=_propagate_expiry)
+def _expireat(client, name, when):
+    if isinstance(when, datetime.datetime):
+        when = time.mktime(when.timetuple()) + when.microsecond / 1000000.0
+        return _expire_at(client, name, int(when * 1000))
+    return _expire_at(client, name, _to_ms(when, 1000))
+
+@command('pexpireat', write=True, denyoom=False, propagate=_propagate_expiry)
+def _pexpireat(client, name, when):
+    if isinstance(when, datetime.datetime):
+        when = time.mktime(when.timetuple()) + when.microsecond / 1000000.0
+        return _expire_at(client, name, int(when * 1000))
+    return _expire_at(client, name, _to_ms(when, 1))
+
+@command('pttl')
+def _pttl(client, name):
+    name = client._to_str(name)
+    if name not in client._cache:
+        return -2
+    deadline = client._cache.expires.get(name)
+    if deadline is None:
+        return -1
+    return max(deadline - _now_ms(client), 0)
+
+@command('ttl')
+def _ttl(client, name):
+    ttl = _pttl(client, name)
+    if ttl < 0:
+        return ttl
+    return (ttl + 500) // 1000
+
+@command('persist', write=True, denyoom=False)
+def _persist(client, name):
+    return client._cache.persist(client._to_str(name))
+
+#### LIST COMMANDS ####
+
+# Lists are stored as deques so that pushing and popping at either end is
+# O(1). Lists assigned to the cache directly are converted on first use.
+
+def _list_range(length, start, end):
+    """
+    Converts the inclusive, possibly negative LRANGE/LTRIM indexes to a
+    Python [start:stop) range within a list of ``length`` elements.
+    """
+    if start < 0:
+        start = max(length + start, 0)
+    if end < 0:
+        end += length
+    stop = min(end + 1, length)
+    if start >= stop:
+        return 0, 0
+    return start, stop
+
+def _list_index(length, index):
+    """
+    Returns the non-negative position of ``index`` or None when it's out
+    of range.
+    """
+    if index < 0:
+        index += length
+    if 0 <= index < length:
+        return index
+    return None
+
+def _list_insert(val, index, value):
+    """
+    deque.insert() only exists from Python 3.5 so rotate the insert
+    position to the nearer end instead. Costs O(min(index, len - index)).
+    """
+    if index <= len(val) // 2:
+        val.rotate(-index)
+        val.appendleft(value)
+        val.rotate(index)
+    else:
+        index = len(val) - index
+        val.rotate(index)
+        val.append(value)
+        val.rotate(-index)
+
+@command('llen')
+def _llen(client, name):
+    name = client._to_str(name)
+    value = client._assert_list(client._cache.get(name, None))
+    if value is None:
+        return 0
+    return len(value)
+
+@command('lpush', write=True)
+def _lpush(client, name, *values):
+    _check_values('lpush', values)
+    name = client._to_str(name)
+    values = map(client._to_str, values)
+    val = client._assert_list(client._cache.get(name, None))
+    val.extendleft(values)
+    client._cache[name] = val
+    return len(val)
+
+@command('rpush', write=True)
+def _rpush(client, name, *values):
+    _check_values('rpush', values)
+    name = client._to_str(name)
+    values = map(client._to_str, values)
+    val = client._assert_list(client._cache.get(name, None))
+    val.extend(values)
+    client._cache[name] = val
+    return len(val)
+
+def _pop(client, name, left):
+    val = client._cache.get(name, None)
+    if val is None:
+        return None
+    val = client._assert_list(val)
+    value = val.popleft() if left else val.pop()
+    if val:
+        client._cache[name] = val
+    else:
+        del client._cache[name]
+    return value
+
+@command('lpop', write=True, denyoom=False)
+def _lpop(client, name):
+    name = client._to_str(name)
+    return _pop(client, name, True)
+
+@command('rpop', write=True, denyoom=False)
+def _rpop(client, name):
+    name = client._to_str(name)
+    return _pop(client, name, False)
+
+@command('rpoplpush', write=True, keys=_all_keys)
+def _rpoplpush(client, src, dst):
+    src = client._to_str(src)
+    dst = client._to_str(dst)
+    # Check the destination first so a wrong type fails before
+    # anything is popped.
+    dst_val = client._assert_list(client._cache.get(dst, None))
+    value = _pop(client, src, False)
+    if value is not None:
+        if src == dst:
+            dst_val = client._assert_list(client._cache.get(dst, None))
+        dst_val.appendleft(value)
+        client._cache[dst] = dst_val
+    return value
+
+@command('lindex')
+def _lindex(client, name, index):
+    name = client._to_str(name)
+    val = client._assert_list(client._cache.get(name, None))
+    index = _list_index(len(val), int(index))
+    if index is None:
+        return None
+    return val[index]
+
+@command('lset', write=True)
+def _lset(client, name, index, value):
+    name = client._to_str(name)
+    value = client._to_str(value)
+    if name not in client._cache:
+        raise ResponseError("no such key")
+    val = client._assert_list(client._cache[name])
+    index = _list_index(len(val), int(index))
+    if index is None:
+        raise ResponseError("index out of range")
+    val[index] = value
+    client._cache[name] = val
+    return True
+
+@command('linsert', write=True)
+def _linsert(client, name, where, refvalue, value):
+    name = client._to_str(name)
+    where = client._to_str(where).upper()
+    if where not in ('BEFORE', 'AFTER'):
+        raise ResponseError("syntax error")
+    refvalue = client._to_str(refvalue)
+    value = client._to_str(value)
+    if name not in client._cache:
+        return 0
+    val = client._assert_list(client._cache[name])
+    for index, x in enumerate(val):
+        if x == refvalue:
+            break
+    else:
+        return -1
+    if where == 'AFTER':
+        index += 1
+    _list_insert(val, index, value)
+    client._cache[name] = val
+    return len(val)
+
+def _list_slice(val, start, stop):
+    """
+    Returns val[start:stop] as a list, walking from whichever end of the
+    list is closer instead of copying the whole list first.
+    """
+    if start >= stop:
+        return []
+    if start > len(val) - stop:
+        tail = list(islice(reversed(val), len(val) - stop, len(val) - start))
+        tail.reverse()
+        return tail
+    return list(islice(val, start, stop))
+
+@command('lrange')
+def _lrange_command(client, name, start, end):
+    name = client._to_str(name)
+    val = client._assert_list(client._cache.get(name, None))
+    start, stop = _list_range(len(val), int(start), int(end))
+    if isinstance(val, PackedList):
+        # A view would decode the list for each element it's asked for.
+        return val.get_range(start, stop)
+    if client._read_views:
+        return ListView(_viewed(client, name, val), start, stop)
+    return _list_slice(val, start, stop)
+
+@command('ltrim', write=True, denyoom=False)
+def _ltrim(client, name, start, end):
+    name = client._to_str(name)
+    if name not in client._cache:
+        # name が存在しない場合は何もしない
+        return True
+
+    val = client._assert_list(client._cache[name])
+    start, stop = _list_range(len(val), int(start), int(end))
+    if stop - start < len(val) - (stop - start):
+        # Keeping fewer elements than are dropped; copy the kept ones.
+        val = deque(_list_slice(val, start, stop))
+    else:
+        for i in xrange(len(val) - stop):
+            val.pop()
+        for i in xrange(start):
+            val.popleft()
+
+    if val:
+        client._cache[name] = val
+    else:
+        del client._cache[name]
+    return True
+
+@command('lrem', write=True, denyoom=False)
+def _lrem(client, name, value, num=0):
+    name = client._to_str(name)
+    value = client._to_str(value)
+
+    if name not in client._cache:
+        # Non-existing keys are treated like empty lists,
+        # so when key does not exist, the command will always return 0.
+        return 0
+
+    val = client._assert_list(client._cache.get(name, None))
+
+    _num = num if num != 0 else None
+    if num is not None and num < 0:
+        val = reversed(val)
+        _num *= -1
+
+    new_val = deque()
+    rem_count = 0
+    for x in val:
+        if x == value and (_num is None or _num > 0):
+            if _num is not None:
+                _num -= 1
+            rem_count += 1
+        else:
+            new_val.append(x)
+
+    if num < 0:
+        new_val.reverse()
+
+    if new_val:
+        client._cache[name] = new_val
+    else:
+        del client._cache[name]
+    return rem_count
+
+#### HASH COMMANDS ####
+
+@command('hdel', write=True, denyoom=False)
+def _hdel(client, name, *keys):
+    _check_values('hdel', keys)
+    name = client._to_str(name)
+    keys = map(client._to_str, keys)
+    val = client._assert_dict(client._cache.get(name, None))
+
+    deleted_count = 0
+    for k in keys:
+        if k in val:
+            deleted_count+=1
+            del val[k]
+    if not val:
+        client._cache.pop(name, None)
+    return deleted_count
+
+@command('hexists')
+def _hexists(client, name, key):
+    name = client._to_str(name)
+    val = client._assert_dict(client._cache.get(name, None))
+    return key in val
+
+@command('hget')
+def _hget(client, name, key):
+    name = client._to_str(name)
+    key = client._to_str(key)
+
+    return client._assert_dict(client._cache.get(name, None)).get(key)
+
+@command('hgetall')
+def _hgetall(client, name):
+    name = client._to_str(name)
+    val = client._assert_dict(client._cache.get(name, None))
+    if client._read_views:
+        return HashView(_viewed(client, name, val))
+    # Redis only stores strings in hashes
+    # which are immutable in Python so a shallow copy is adequate.
+    return val.copy()
+
+@command('hset', write=True)
+def _hset(client, name, key, value):
+    name = client._to_str(name)
+    key = client._to_str(key)
+    value = client._to_str(value)
+
+    val = client._assert_dict(client._cache.get(name, None))
+    rtn_val = 0 if key in val else 1
+    val[key] = value
+    client._cache[name] = val
+    return rtn_val
+
+@command('hincrby', write=True)
+def _hincrby(client, name, key, amount=1):
+    name = client._to_str(name)
+    key = client._to_str(key)
+    amount = client._assert_int(amount)
+    val = client._assert_dict(client._cache.get(name, None))
+    try:
+        value = int(val.get(key, 0)) + amount
+    except ValueError:
+        raise ResponseError("hash value is not an integer")
+    if not _INT_MIN <= value <= _INT_MAX:
+        raise ResponseError("increment or decrement would overflow")
+    # Hash values stay strings, as the compact encodings expect.
+    val[key] = str(value)
+    client._cache[name] = val
+    return value
+
+@command('hincrbyfloat', write=True)
+def _hincrbyfloat(client, name, key, amount=1.0):
+    name = client._to_str(name)
+    key = client._to_str(key)
+    val = client._assert_dict(client._cache.get(name, None))
+    value = _add_float(val.get(key), amount)
+    val[key] = _format_score(value)
+    client._cache[name] = val
+    return value
+
+@command('hmset', write=True)
+def _hmset(client, name, mapping):
+    _check_values('hmset', mapping)
+    name = client._to_str(name)
+    items = [(client._to_str(key), client._to_str(value))
+             for key, value in mapping.iteritems()]
+    val = client._assert_dict(client._cache.get(name, None))
+    val.update(items)
+    client._cache[name] = val
+    return True
+
+@command('hmget')
+def _hmget(client, name, keys, *args):
+    name = client._to_str(name)
+    val = client._assert_dict(client._cache.get(name, None))
+    keys = [client._to_str(key) for key in list_or_args(keys, args)]
+    if isinstance(val, PackedHash):
+        return val.get_many(keys)
+    return [val.get(key) for key in keys]
+
+@command('hlen')
+def _hlen(client, name):
+    name = client._to_str(name)
+    return len(client._assert_dict(client._cache.get(name, None)))
+
+#### SET COMMANDS ####
+
+@command('sadd', write=True)
+def _sadd(client, name, *values):
+    _check_values('sadd', values)
+    name = client._to_str(name)
+    values = map(client._to_str, values)
+
+    val = client._assert_set(client._cache.get(name, None))
+    size = len(val)
+    val.update(values)
+    client._cache[name] = val
+    return len(val) - size
+
+@command('scard')
+def _scard(client, name):
+    name = client._to_str(name)
+    val = client._assert_set(client._cache.get(name, None))
+    return len(val)
+
+@command('srem', write=True, denyoom=False)
+def _srem(client, name, *values):
+    _check_values('srem', values)
+    name = client._to_str(name)
+    values = map(client._to_str, values)
+    val = client._assert_set(client._cache.get(name, None))
+    size = len(val)
+    val.difference_update(values)
+    if not val:
+        client._cache.pop(name, None)
+    return size - len(val)
+
+def _sets(client, keys):
+    return [client._assert_set(client._cache.get(client._to_str(key), None))
+            for key in keys]
+
+def _intersection(sets):
+    """
+    Intersects ``sets`` from the smallest one up, stopping as soon as the
+    result is empty. Always returns a new set.
+    """
+    sets = sorted(sets, key=len)
+    if not sets or not sets[0]:
+        return set()
+    if len(sets) == 1:
+        return set(sets[0])
+    result = sets[0].intersection(sets[1])
+    for other in sets[2:]:
+        if not result:
+            break
+        result.intersection_update(other)
+    return result
+
+def _union(sets):
+    return set().union(*sets)
+
+def _difference(sets):
+    first = sets[0]
+    others = [other for other in sets[1:] if other]
+    return first.difference(*others) if first else set()
+
+def _store(client, dest, result):
+    dest = client._to_str(dest)
+    if result:
+        client._cache[dest] = result
+    else:
+        client._cache.pop(dest, None)
+    return len(result)
+
+@command('sinter', keys=_list_or_args_keys)
+def _sinter(client, keys, *args):
+    return _intersection(_sets(client, list_or_args(keys, args)))
+
+@command('sinterstore', write=True, keys=_store_keys)
+def _sinterstore(client, dest, keys, *args):
+    return _store(client, dest, _intersection(_sets(client, list_or_args(keys, args))))
+
+@command('sintercard', keys=_first_arg_keys)
+def _sintercard(client, keys, limit=0):
+    if limit < 0:
+        raise ResponseError("LIMIT can't be negative")
+    sets = sorted(_sets(client, keys), key=len)
+    if not limit or not sets or not sets[0]:
+        return len(_intersection(sets))
+    # Only count the members of the smallest set until the limit.
+    smallest, others = sets[0], sets[1:]
+    count = 0
+    for member in smallest:
+        for other in others:
+            if member not in other:
+                break
+        else:
+            count += 1
+            if count == limit:
+                break
+    return count
+
+@command('sunion', keys=_list_or_args_keys)
+def _sunion(client, keys, *args):
+    return _union(_sets(client, list_or_args(keys, args)))
+
+@command('sunionstore', write=True, keys=_store_keys)
+def _sunionstore(client, dest, keys, *args):
+    return _store(client, dest, _union(_sets(client, list_or_args(keys, args))))
+
+@command('sdiff', keys=_list_or_args_keys)
+def _sdiff(client, keys, *args):
+    return _difference(_sets(client, list_or_args(keys, args)))
+
+@command('sdiffstore', write=True, keys=_store_keys)
+def _sdiffstore(client, dest, keys, *args):
+    return _store(client, dest, _difference(_sets(client, list_or_args(keys, args))))
+
+@command('smove', write=True, keys=_two_keys)
+def _smove(client, src, dst, value):
+    src = client._to_str(src)
+    dst = client._to_str(dst)
+    value = client._to_str(value)
+    src_val = client._assert_set(client._cache.get(src, None))
+    dst_val = client._assert_set(client._cache.get(dst, None))
+    if value not in src_val:
+        return False
+    if src == dst:
+        return True
+    src_val.remove(value)
+    if src_val:
+        client._cache[src] = src_val
+    else:
+        del client._cache[src]
+    dst_val.add(value)
+    client._cache[dst] = dst_val
+    return True
+
+def _propagate_spop(client, args, result):
+    # The popped members are random, so log their removal instead.
+    if result is None:
+        return []
+    members = (result,) if isinstance(result, str) else tuple(result)
+    return [('srem', (client._to_str(args[0]),) + members)] if members else []
+
+@command('spop', write=True, denyoom=False, propagate=_propagate_spop)
+def _spop(client, name, count=None):
+    name = client._to_str(name)
+    if count is not None and count < 0:
+        raise ResponseError("value is out of range, must be positive")
+    val = client._assert_set(client._cache.get(name, None))
+    if count is None:
+        if not val:
+            return None
+        members = [val.pop()]
+    elif count >= len(val):
+        members = list(val)
+        val.clear()
+    else:
+        members = random.sample(val, count)
+        val.difference_update(members)
+    if val:
+        client._cache[name] = val
+    else:
+        client._cache.pop(name, None)
+    return members[0] if count is None else members
+
+@command('srandmember')
+def _srandmember(client, name, number=None):
+    name = client._to_str(name)
+    val = client._assert_set(client._cache.get(name, None))
+    if number is None:
+        return random.sample(val, 1)[0] if val else None
+    if not val or not number:
+        return []
+    if number > 0:
+        return random.sample(val, min(number, len(val)))
+    # A negative count may return the same member more than once.
+    members = tuple(val)
+    return [random.choice(members) for i in xrange(-number)]
+
+@command('sismember')
+def _sismember(client, name, value):
+    name = client._to_str(name)
+    value = client._to_str(value)
+    val = client._assert_set(client._cache.get(name, None))
+    return value in val
+
+@command('smembers')
+def _smembers(client, name):
+    name = client._to_str(name)
+    val = client._assert_set(client._cache.get(name, None))
+    if client._read_views:
+        return SetView(_viewed(client, name, val))
+    return set(val)
+
+#### SORTED SET COMMANDS ####
+
+def _to_score(value):
+    try:
+        score = float(value)
+    except ValueError:
+        raise ResponseError("value is not a valid float")
+    if score != score:
+        raise ResponseError("resulting score is not a number (NaN)")
+    return score
+
+def _score_bound(value):
+    """
+    Parses a ZRANGEBYSCORE bound: a number, -inf, +inf, or a number
+    prefixed with "(" to exclude it. Returns (score, exclusive).
+    """
+    if isinstance(value, basestring) and value.startswith('('):
+        return _to_score(value[1:]), True
+    return _to_score(value), False
+
+def _format_score(score):
+    """
+    Formats a score the way the server replies with it.
+    """
+    if score.is_integer():
+        return '%d' % score
+    return repr(score)
+
+def _zset_reply(pairs, withscores, score_cast_func):
+    if withscores:
+        return [(member, score_cast_func(_format_score(score)))
+                for score, member in pairs]
+    return [member for score, member in pairs]
+
+def _score_range(zset, low, high):
+    """
+    Returns the [start, stop) ranks of the pairs scored between the
+    ZRANGEBYSCORE bounds ``low`` and ``high``.
+    """
+    low, low_exclusive = _score_bound(low)
+    high, high_exclusive = _score_bound(high)
+    start = zset.score_rank(low, low_exclusive)
+    stop = zset.score_rank(high, not high_exclusive)
+    return start, max(start, stop)
+
+@command('zadd', write=True)
+def _zadd(client, name, pairs):
+    name = client._to_str(name)
+    if not pairs:
+        raise ResponseError("wrong number of arguments for 'zadd' command")
+    zset = client._assert_zset(client._cache.get(name, None))
+    # Validate every score before anything is added.
+    pairs = [(client._to_str(member), _to_score(score)) for member, score in pairs]
+    added = 0
+    for member, score in pairs:
+        if zset.add(member, score):
+            added += 1
+    client._cache[name] = zset
+    return added
+
+@command('zincrby', write=True)
+def _zincrby(client, name, value, amount=1):
+    name = client._to_str(name)
+    value = client._to_str(value)
+    amount = _to_score(amount)
+    zset = client._assert_zset(client._cache.get(name, None))
+    score = zset.score(value)
+    score = amount if score is None else score + amount
+    if score != score:
+        raise ResponseError("resulting score is not a number (NaN)")
+    zset.add(value, score)
+    client._cache[name] = zset
+    return score
+
+@command('zrem', write=True, denyoom=False)
+def _zrem(client, name, *values):
+    name = client._to_str(name)
+    if name not in client._cache:
+        return 0
+    zset = client._assert_zset(client._cache[name])
+    removed = 0
+    for value in values:
+        if zset.discard(client._to_str(value)):
+            removed += 1
+    if not zset:
+        del client._cache[name]
+    return removed
+
+@command('zremrangebyscore', write=True, denyoom=False)
+def _zremrangebyscore(client, name, low, high):
+    name = client._to_str(name)
+    if name not in client._cache:
+        return 0
+    zset = client._assert_zset(client._cache[name])
+    start, stop = _score_range(zset, low, high)
+    for score, member in list(zset.pairs(start, stop)):
+        zset.discard(member)
+    if not zset:
+        del client._cache[name]
+    return stop - start
+
+@command('zcard')
+def _zcard(client, name):
+    name = client._to_str(name)
+    return len(client._assert_zset(client._cache.get(name, None)))
+
+@command('zcount')
+def _zcount(client, name, low, high):
+    name = client._to_str(name)
+    zset = client._assert_zset(client._cache.get(name, None))
+    start, stop = _score_range(zset, low, high)
+    return stop - start
+
+@command('zscore')
+def _zscore(client, name, value):
+    name = client._to_str(name)
+    zset = client._assert_zset(client._cache.get(name, None))
+    return zset.score(client._to_str(value))
+
+@command('zrank')
+def _zrank(client, name, value):
+    name = client._to_str(name)
+    zset = client._assert_zset(client._cache.get(name, None))
+    return zset.rank(client._to_str(value))
+
+@command('zrevrank')
+def _zrevrank(client, name, value):
+    name = client._to_str(name)
+    zset = client._assert_zset(client._cache.get(name, None))
+    rank = zset.rank(client._to_str(value))
+    if rank is None:
+        return None
+    return len(zset) - 1 - rank
+
+@command('zrange')
+def _zrange(client, name, start, end, desc=False, withscores=False,
+            score_cast_func=float):
+    name = client._to_str(name)
+    zset = client._assert_zset(client._cache.get(name, None))
+    length = len(zset)
+    start, stop = _list_range(length, int(start), int(end))
+    if desc:
+        pairs = list(zset.pairs(length - stop, length - start))
+        pairs.reverse()
+    else:
+        pairs = zset.pairs(start, stop)
+    return _zset_reply(pairs, withscores, score_cast_func)
+
+@command('zrangebyscore')
+def _zrangebyscore(client, name, low, high, start=None, num=None,
+                   withscores=False, score_cast_func=float, desc=False):
+    name = client._to_str(name)
+    if (start is None) != (num is None):
+        raise RedisError("``start`` and ``num`` must both be specified")
+    zset = client._assert_zset(client._cache.get(name, None))
+    lo, hi = _score_range(zset, low, high)
+    if start is not None:
+        start = int(start)
+        num = int(num)
+        if start < 0:
+            return []
+        count = hi - lo - start if num < 0 else num
+        count = max(0, min(count, hi - lo - start))
+        if desc:
+            lo, hi = hi - start - count, hi - start
+        else:
+            lo, hi = lo + start, lo + start + count
+    if desc:
+        pairs = list(zset.pairs(lo, hi))
+        pairs.reverse()
+    else:
+        pairs = zset.pairs(lo, hi)
+    return _zset_reply(pairs, withscores, score_cast_func)
+
+#### SCAN COMMANDS ####
+
+# Compiled MATCH patterns, so scanning with the same pattern step after
+# step doesn't translate and compile it again.
+_globs = {}
+_GLOB_CACHE_SIZE = 256
+
+def _glob_to_regex(pattern):
+    """
+    Translates a Redis glob pattern, which unlike fnmatch's negates
+    character classes with "^" and escapes characters with "\\".
+    """
+    parts = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            parts.append('.*')
+        elif c == '?':
+            parts.append('.')
+        elif c == '\\' and i < n:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+        elif c == '[':
+            negate = i < n and pattern[i] == '^'
+            if negate:
+                i += 1
+            chars = []
+            # Like the server, an unterminated class ends with the pattern.
+            while i < n and pattern[i] != ']':
+                if pattern[i] == '\\' and i + 1 < n:
+                    chars.append(re.escape(pattern[i + 1]))
+                    i += 2
+                elif i + 2 < n and pattern[i + 1] == '-' and pattern[i + 2] != ']':
+                    low, high = sorted((pattern[i], pattern[i + 2]))
+                    chars.append('%s-%s' % (re.escape(low), re.escape(high)))
+                    i += 3
+                else:
+                    chars.append(re.escape(pattern[i]))
+                    i += 1
+            i += 1
+            if chars:
+                parts.append('[%s%s]' % ('^' if negate else '', ''.join(chars)))
+            else:
+                parts.append('.' if negate else '(?!)')
+        else:
+            parts.append(re.escape(c))
+    return ''.join(parts) + '\\Z'
+
+def _glob_matcher(pattern):
+    matcher = _globs.get(pattern)
+    if matcher is None:
+        if len(_globs) >= _GLOB_CACHE_SIZE:
+            _globs.clear()
+        matcher = _globs[pattern] = re.compile(_glob_to_regex(pattern), re.S).match
+    return matcher
+
+def _scan_args(client, cursor, match, count):
+    try:
+        cursor = int(cursor)
+    except ValueError:
+        raise ResponseError("invalid cursor")
+    if cursor < 0:
+        raise ResponseError("invalid cursor")
+    if count is None:
+        count = 10
+    elif int(count) < 1:
+        raise ResponseError("syntax error")
+    if match is not None:
+        match = _glob_matcher(client._to_str(match))
+    return cursor, match, int(count)
+
+def _live_keys(client, keys):
+    """
+    Drops the keys whose deadline has passed, which are only deleted by
+    the writes that touch them.
+    """
+    expires = client._cache.expires
+    if not expires:
+        return keys
+    now = _now_ms(client)
+    return [key for key in keys if expires.get(key, now + 1) > now]
+
+@command('keys', keys=_no_keys)
+def _keys(client, pattern='*'):
+    keys = _live_keys(client, client._cache.keys())
+    pattern = client._to_str(pattern)
+    if pattern == '*':
+        return keys
+    match = _glob_matcher(pattern)
+    return [key for key in keys if match(key)]
+
+@command('scan', keys=_no_keys)
+def _scan(client, cursor=0, match=None, count=None, type_name=None):
+    cursor, match, count = _scan_args(client, cursor, match, count)
+    cache = client._cache
+    cursor, keys = cache.scan(cursor, count)
+    keys = _live_keys(client, keys)
+    if match is not None:
+        keys = [key for key in keys if match(key)]
+    if type_name is not None:
+        type_name = client._to_str(type_name).lower()
+        keys = [key for key in keys if _type_name(cache.get(key)) == type_name]
+    return cursor, keys
+
+def _scan_members(client, name, members, cursor, match, count):
+    cursor, match, count = _scan_args(client, cursor, match, count)
+    if not members:
+        return 0, []
+    cursor, found = client._cache.scan_members(name, members, cursor, count)
+    if match is not None:
+        found = [member for member in found if match(member)]
+    return cursor, found
+
+@command('sscan')
+def _sscan(client, name, cursor=0, match=None, count=None):
+    name = client._to_str(name)
+    val = client._assert_set(client._cache.get(name, None))
+    cursor, members = _scan_members(client, name, val, cursor, match, count)
+    return cursor, [member for member in members if member in val]
+
+@command('hscan')
+def _hscan(client, name, cursor=0, match=None, count=None):
+    name = client._to_str(name)
+    val = client._assert_dict(client._cache.get(name, None))
+    if isinstance(val, PackedHash):
+        # Decoded once for both the scan index and the values.
+        val = val.expand()
+    cursor, fields = _scan_members(client, name, val, cursor, match, count)
+    return cursor, dict((field, val[field]) for field in fields if field in val)
+
+@command('zscan')
+def _zscan(client, name, cursor=0, match=None, count=None, score_cast_func=float):
+    name = client._to_str(name)
+    zset = client._assert_zset(client._cache.get(name, None))
+    scores = zset.scores
+    cursor, members = _scan_members(client, name, scores, cursor, match, count)
+    return cursor, _zset_reply([(scores[member], member) for member in members
+                                if member in scores], True, score_cast_func)
+
+#### SERVER COMMANDS ####
+
+@command('flushdb', write=True, keys=_no_keys, denyoom=False)
+def _flushdb(client):
+    client._cache.clear()
+
+@command('flushall', write=True, keys=_no_keys, denyoom=False)
+def _flushall(client):
+    global _caches
+
+    for name in _caches.keys():
+        if name.startswith('%s:%s' % (client._host, client._port)):
+            _caches[name].clear()
+            if name in _watches:
+                _touch(_watches[name], ())
+
+def _configure_memory(client, maxmemory=None, policy=None, samples=None):
+    cache = client._cache
+    limit = cache.limit
+    if limit is None:
+        if maxmemory is None:
+            maxmemory = 0
+        limit = MemoryLimit(cache, maxmemory, policy or 'noeviction',
+                            samples or 5, client._clock)
+        cache.limit = limit
+    else:
+        limit.configure(limit.maxmemory if maxmemory is None else maxmemory,
+                        policy or limit.policy, samples or limit.samples)
+    limit.evict(client._watched)
+
+_config_params = ('maxmemory', 'maxmemory-policy', 'maxmemory-samples',
+                  'latency-tracking', 'slowlog-log-slower-than', 'slowlog-max-len',
+                  'hash-max-listpack-entries', 'hash-max-listpack-value',
+                  'set-max-intset-entries', 'list-max-listpack-size')
+
+def _configure_stats(client, name, value):
+    server = '%s:%s' % (client._host, client._port)
+    stats = _server_stats(server)
+    if name == 'latency-tracking':
+        value = client._to_str(value).lower()
+        if value not in ('yes', 'no'):
+            raise ValueError(value)
+        stats.enabled = value == 'yes'
+        _attach_stats(server, stats)
+    elif name == 'slowlog-log-slower-than':
+        stats.slowlog_log_slower_than = int(value)
+    elif int(value) < 0:
+        raise ValueError(value)
+    else:
+        stats.set_slowlog_max_len(int(value))
+
+def _configure_encodings(client, name=None, value=None):
+    """
+    Turns compact encodings on for the database of ``client``, setting the
+    threshold ``name`` to ``value`` when they are passed. Values already
+    stored are compacted by the next write to them.
+    """
+    cache = client._cache
+    if isinstance(cache, SharedKeyspace):
+        raise ResponseError("Compact encodings can't be used with shared_file")
+    if cache.encodings is None:
+        cache.encodings = Encodings()
+    if name is not None:
+        cache.encodings.configure(name, value)
+
+@command('config_get', keys=_no_keys)
+def _config_get(client, pattern):
+    limit = client._cache.limit
+    stats = _stats.get('%s:%s' % (client._host, client._port)) or CommandStats()
+    encodings = client._cache.encodings or Encodings()
+    values = {
+        'maxmemory': limit.maxmemory if limit else 0,
+        'maxmemory-policy': limit.policy if limit else 'noeviction',
+        'maxmemory-samples': limit.samples if limit else 5,
+        'latency-tracking': 'yes' if stats.enabled else 'no',
+        'slowlog-log-slower-than': stats.slowlog_log_slower_than,
+        'slowlog-max-len': stats.slowlog.maxlen,
+    }
+    for name in Encodings.PARAMS:
+        values[name] = encodings.get(name)
+    return dict((name, str(value)) for name, value in values.iteritems()
+                if fnmatch.fnmatchcase(name, pattern))
+
+@command('config_set', write=True, keys=_no_keys, denyoom=False,
+         propagate=_no_propagate, watch=False)
+def _config_set(client, name, value):
+    name = name.lower()
+    if name not in _config_params:
+        raise ResponseError("Unsupported CONFIG parameter: %s" % name)
+    try:
+        if name == 'maxmemory':
+            _configure_memory(client, maxmemory=int(value))
+        elif name == 'maxmemory-policy':
+            _configure_memory(client, policy=client._to_str(value).lower())
+        elif name == 'maxmemory-samples':
+            _configure_memory(client, samples=int(value))
+        elif name in Encodings.PARAMS:
+            _configure_encodings(client, name, value)
+        else:
+            _configure_stats(client, name, value)
+    except ValueError:
+        raise ResponseError("Invalid argument '%s' for CONFIG SET '%s'" % (value, name))
+    return True
+
+def _memory_info(client):
+    cache = client._cache
+    limit = cache.limit
+    if limit is not None:
+        used_memory = limit.used_memory
+    else:
+        used_memory = sum(MemoryLimit.size_of(key, value)
+                          for key, value in cache.iteritems())
+    return {
+        'used_memory': used_memory,
+        'maxmemory': limit.maxmemory if limit else 0,
+        'maxmemory_policy': limit.policy if limit else 'noeviction',
+    }
+
+def _stats_info(client):
+    limit = client._cache.limit
+    return {
+        'evicted_keys': limit.evicted_keys if limit else 0,
+    }
+
+def _keyspace_info(client):
+    """
+    The number of keys, of keys with a deadline and of keys of each type
+    of every non-empty database of the server, from their counters.
+    """
+    info = {}
+    for db, keyspace in _server_keyspaces('%s:%s' % (client._host, client._port)):
+        if len(keyspace):
+            values = keyspace.type_counts()
+            values['keys'] = len(keyspace)
+            values['expires'] = len(keyspace.expires)
+            info['db%s' % db] = values
+    return info
+
+def _commandstats_info(client):
+    stats = _stats.get('%s:%s' % (client._host, client._port))
+    return stats.command_info() if stats is not None else {}
+
+def _latencystats_info(client):
+    stats = _stats.get('%s:%s' % (client._host, client._port))
+    return stats.latency_info() if stats is not None else {}
+
+# The sections of INFO. Only the requested ones are computed.
+_info_sections = {
+    'memory': _memory_info,
+    'stats': _stats_info,
+    'keyspace': _keyspace_info,
+    'commandstats': _commandstats_info,
+    'latencystats': _latencystats_info,
+}
+
+# Like the server's, the default sections leave out the per-command ones.
+_default_info_sections = ('memory', 'stats', 'keyspace')
+
+@command('info', keys=_no_keys)
+def _info(client, section=None):
+    if section is None or section in ('all', 'default'):
+        info = {}
+        for name in (_info_sections if section == 'all' else _default_info_sections):
+            info.update(_info_sections[name](client))
+        return info
+    section_info = _info_sections.get(section.lower())
+    if section_info is None:
+        return {}
+    return section_info(client)
+
+#### SNAPSHOTS ####
+
+# A snapshot starts with SNAPSHOT_MAGIC and holds, for each database of a
+# server, a DB opcode with the database name followed by its keys. Each key
+# is an optional EXPIRE opcode with the deadline in milliseconds, a type
+# opcode, the key and the value. Strings are a 4-byte big-endian length
+# and the bytes; collections are a 4-byte count and their elements, with
+# sorted set scores as 8-byte doubles.
+SNAPSHOT_MAGIC = 'REDISMOCK\x01'
+_OP_DB = 'D'
+_OP_EXPIRE = 'E'
+_OP_EOF = '\xff'
+_TYPE_STRING = 's'
+_TYPE_LIST = 'l'
+_TYPE_SET = 'S'
+_TYPE_HASH = 'h'
+_TYPE_ZSET = 'z'
+
+_pack_length = struct.Struct('>I').pack
+_pack_deadline = struct.Struct('>q').pack
+_pack_score = struct.Struct('>d').pack
+
+def _server_keyspaces(server):
+    prefix = server + ':'
+    return sorted((name[len(prefix):], cache) for name, cache in _caches.items()
+                  if name.startswith(prefix))
+
+def _write_snapshot(path, databases):
+    """
+    Writes ``databases``, a list of (db, keyspace) pairs, to ``path``.
+    The file is written next to ``path`` and renamed over it once
+    complete, so a crash never leaves a truncated snapshot behind.
+    """
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    with open(tmp_path, 'wb', 1 << 16) as fp:
+        write = fp.write
+        write(SNAPSHOT_MAGIC)
+        for db, keyspace in databases:
+            write(_OP_DB + _pack_length(len(db)) + db)
+            expires = keyspace.expires
+            for key, value in keyspace.iteritems():
+                value = _full_value(value)
+                parts = []
+                deadline = expires.get(key)
+                if deadline is not None:
+                    parts.append(_OP_EXPIRE + _pack_deadline(deadline))
+                if isinstance(value, str):
+                    parts.append(_TYPE_STRING)
+                    parts += (_pack_length(len(key)), key, _pack_length(len(value)), value)
+                    write(''.join(parts))
+                    continue
+                if isinstance(value, (deque, list)):
+                    parts.append(_TYPE_LIST)
+                elif isinstance(value, dict):
+                    parts.append(_TYPE_HASH)
+                elif isinstance(value, SortedSet):
+                    parts.append(_TYPE_ZSET)
+                else:
+                    parts.append(_TYPE_SET)
+                parts += (_pack_length(len(key)), key, _pack_length(len(value)))
+                if isinstance(value, dict):
+                    for field, field_value in value.iteritems():
+                        parts += (_pack_length(len(field)), field,
+                                  _pack_length(len(field_value)), field_value)
+                elif isinstance(value, SortedSet):
+                    for score, member in value.pairs(0, len(value)):
+                        parts += (_pack_score(score), _pack_length(len(member)), member)
+                else:
+                    for element in value:
+                        parts += (_pack_length(len(element)), element)
+                write(''.join(parts))
+        write(_OP_EOF)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmp_path, path)
+
+def _copy_value(value):
+    if isinstance(value, (str, int)) or type(value) in _COMPACT_TYPES:
+        return value
+    if isinstance(value, SortedSet):
+        return SortedSet.from_pairs(value.pairs(0, len(value)))
+    return type(value)(value)
+
+def _read_snapshot(path, now_ms):
+    """
+    Reads the snapshot at ``path`` and returns a {db: Keyspace} dict,
+    leaving out keys whose deadline is before ``now_ms``.
+
+    The file is memory mapped and decoded with struct.unpack_from at
+    offsets into the map, so nothing but the keys and values is copied.
+    """
+    keyspaces = {}
+    with open(path, 'rb') as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            raise RedisError("Bad snapshot file %s" % path)
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise RedisError("Bad snapshot file %s" % path)
+        unpack_length = struct.Struct('>I').unpack_from
+        unpack_deadline = struct.Struct('>q').unpack_from
+        unpack_score = struct.Struct('>d').unpack_from
+        pos = len(SNAPSHOT_MAGIC)
+        keyspace = None
+        deadline = None
+
+        while True:
+            op = data[pos]
+            pos += 1
+            if op == _OP_EOF:
+                break
+            if op == _OP_DB:
+                length, = unpack_length(data, pos)
+                pos += 4
+                keyspace = keyspaces.setdefault(data[pos:pos + length], Keyspace())
+                pos += length
+                continue
+            if op == _OP_EXPIRE:
+                deadline, = unpack_deadline(data, pos)
+                pos += 8
+                continue
+
+            length, = unpack_length(data, pos)
+            pos += 4
+            key = data[pos:pos + length]
+            pos += length
+            count, = unpack_length(data, pos)
+            pos += 4
+            if op == _TYPE_STRING:
+                value = data[pos:pos + count]
+                pos += count
+            elif op == _TYPE_HASH:
+                value = {}
+                for i in xrange(count):
+                    length, = unpack_length(data, pos)
+                    field = data[pos + 4:pos + 4 + length]
+                    pos += 4 + length
+                    length, = unpack_length(data, pos)
+                    value[field] = data[pos + 4:pos + 4 + length]
+                    pos += 4 + length
+            elif op == _TYPE_ZSET:
+                pairs = []
+                for i in xrange(count):
+                    score, = unpack_score(data, pos)
+                    length, = unpack_length(data, pos + 8)
+                    pairs.append((score, data[pos + 12:pos + 12 + length]))
+                    pos += 12 + length
+                value = SortedSet.from_pairs(pairs)
+            elif op in (_TYPE_LIST, _TYPE_SET):
+                elements = []
+                for i in xrange(count):
+                    length, = unpack_length(data, pos)
+                    elements.append(data[pos + 4:pos + 4 + length])
+                    pos += 4 + length
+                value = deque(elements) if op == _TYPE_LIST else set(elements)
+            else:
+                raise RedisError("Bad snapshot file %s" % path)
+
+            if deadline is None:
+                keyspace[key] = value
+            elif deadline > now_ms:
+                keyspace[key] = value
+                keyspace.expire_at(key, deadline)
+            deadline = None
+    except (IndexError, struct.error):
+        raise RedisError("Bad snapshot file %s" % path)
+    finally:
+        data.close()
+    return keyspaces
+
+class _SnapshotLocks(object):
+    """
+    Takes the reader lock of every database of a server, in name order so
+    that snapshots of the same server don't deadlock each other.
+    """
+    def __init__(self, databases, server):
+        self.locks = [_get_lock('%s:%s' % (server, db)).reader()
+                      for db, keyspace in databases]
+
+    def __enter__(self):
+        entered = []
+        try:
+            for lock in self.locks:
+                lock.__enter__()
+                entered.append(lock)
+        except:
+            for lock in reversed(entered):
+                lock.__exit__(None, None, None)
+            raise
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self.locks):
+            lock.__exit__(None, None, None)
+
+def _save(server, path):
+    databases = _server_keyspaces(server)
+    with _SnapshotLocks(databases, server):
+        _write_snapshot(path, databases)
+    _lastsave[server] = time.time()
+
+def _bgsave(server, path):
+    """
+    Writes a snapshot in the background. Where os.fork() is available the
+    child process writes the memory it inherited at the fork, so the locks
+    are only held while forking. Otherwise the values are copied under the
+    locks and written from a thread.
+    """
+    fork = getattr(os, 'fork', None)
+
+    def run():
+        try:
+            if fork is not None:
+                ok = os.waitpid(pid, 0)[1] == 0
+            else:
+                _write_snapshot(path, copies)
+                ok = True
+            if ok:
+                _lastsave[server] = time.time()
+        finally:
+            del _bgsaves[server]
+    thread = threading.Thread(target=run, name='bgsave %s' % server)
+    thread.daemon = True
+    with _bgsaves_lock:
+        if server in _bgsaves:
+            raise ResponseError("Background save already in progress")
+        _bgsaves[server] = thread
+    try:
+        databases = _server_keyspaces(server)
+        with _SnapshotLocks(databases, server):
+            if fork is not None:
+                databases = _detach_shared(databases)
+                pid = fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        _write_snapshot(path, databases)
+                        status = 0
+                    finally:
+                        os._exit(status)
+            else:
+                copies = []
+                for db, keyspace in databases:
+                    copy = Keyspace()
+                    for key, value in keyspace.iteritems():
+                        dict.__setitem__(copy, key, _copy_value(value))
+                    copy.expires.update(keyspace.expires)
+                    copies.append((db, copy))
+    except:
+        del _bgsaves[server]
+        raise
+    thread.start()
+    return thread
+
+def _load(server, path, now_ms):
+    for db, keyspace in _read_snapshot(path, now_ms).iteritems():
+        _caches['%s:%s' % (server, db)] = keyspace
+
+#### APPEND-ONLY FILE ####
+
+_pack_record_length = struct.Struct('>I').pack
+_unpack_record_length = struct.Struct('>I').unpack_from
+
+_marshalable = (basestring, int, long, float, bool, type(None), tuple, list,
+                dict, set, frozenset)
+
+def _encode_record(record):
+    """
+    Encodes a (db, command name, args) record as a 4-byte length and the
+    marshalled record.
+    """
+    try:
+        data = marshal.dumps(record)
+    except ValueError:
+        db, name, args = record
+        args = tuple(arg if isinstance(arg, _marshalable) else str(arg) for arg in args)
+        data = marshal.dumps((db, name, args))
+    return _pack_record_length(len(data)) + data
+
+def _read_records(path):
+    """
+    Yields the records of the log at ``path``. A record cut short by a
+    crash while it was being written is ignored.
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    pos = 0
+    end = len(data)
+    while pos + 4 <= end:
+        length, = _unpack_record_length(data, pos)
+        pos += 4
+        if pos + length > end:
+            break
+        yield marshal.loads(data[pos:pos + length])
+        pos += length
+
+class AppendOnlyFile(object):
+    """
+    A log of the write commands run on the databases of a server.
+
+    Commands are queued by the connections and encoded and written by a
+    dedicated thread, so a write only pays for the queueing. With the
+    "always" fsync policy the connection then waits (outside of the
+    database lock) until its record has been written and fsynced, which
+    the thread does for all queued records at once. "everysec" fsyncs at
+    most once a second and "no" leaves it to the OS.
+    """
+    FSYNC_POLICIES = ('always', 'everysec', 'no')
+    BATCH_INTERVAL = 0.005
+
+    def __init__(self, path, fsync='everysec'):
+        if fsync not in self.FSYNC_POLICIES:
+            raise RedisError("Invalid appendfsync policy: %s" % fsync)
+        self.path = path
+        self.fsync = fsync
+        self.file = open(path, 'ab')
+        self.cond = threading.Condition(threading.Lock())
+        # Appending to and popping from a deque is thread safe, so the
+        # condition is only needed to wake up the thread when it's idle.
+        self.pending = deque()
+        self.idle = False
+        self.appended = 0
+        self.written = 0
+        self.rewriting = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='aof %s' % path)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, db, client, cmd, args, result):
+        """
+        Queues the effect of ``cmd``, which returned ``result``. With the "always" policy returns the
+        sequence number to pass to wait().
+        """
+        if cmd.propagate is None:
+            records = [(db, cmd.name, args)]
+        else:
+            records = [(db, name, cmd_args)
+                       for name, cmd_args in cmd.propagate(client, args, result)]
+        if self.fsync != 'always':
+            self.pending.extend(records)
+            if self.idle:
+                self._wake()
+            return None
+        with self.cond:
+            self.pending.extend(records)
+            self.appended += len(records)
+            self.cond.notify()
+            return self.appended
+
+    def wait(self, seq):
+        """
+        Waits until the first ``seq`` records are written and fsynced.
+        """
+        with self.cond:
+            while self.written < seq and not self.closed:
+                self.cond.wait()
+
+    def _wake(self):
+        with self.cond:
+            self.cond.notify()
+
+    def start_rewrite(self):
+        # Records queued after this are copied to the rewritten log.
+        self.rewriting = True
+        self.pending.append((None, 'rewrite-start', None))
+        self._wake()
+
+    def finish_rewrite(self, path, ok):
+        self.pending.append((None, 'rewrite-done', (path, ok)))
+        self._wake()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def _run(self):
+        pending = self.pending
+        rewrite_buffer = None
+        dirty = False
+        last_fsync = time.time()
+        while True:
+            with self.cond:
+                self.idle = True
+                while not pending and not self.closed:
+                    if dirty and self.fsync == 'everysec':
+                        # Wake up to fsync what's been written.
+                        self.cond.wait(max(last_fsync + 1 - time.time(), 0.01))
+                        break
+                    self.cond.wait()
+                self.idle = False
+                closed = self.closed
+
+            chunks = []
+            written = 0
+            while pending:
+                record = pending.popleft()
+                if record[0] is None and record[1] == 'rewrite-start':
+                    rewrite_buffer = []
+                elif record[0] is None and record[1] == 'rewrite-done':
+                    self._write(chunks)
+                    del chunks[:]
+                    self._replace(record[2], rewrite_buffer)
+                    rewrite_buffer = None
+                else:
+                    chunk = _encode_record(record)
+                    chunks.append(chunk)
+                    written += 1
+                    if rewrite_buffer is not None:
+                        rewrite_buffer.append(chunk)
+            if chunks:
+                self._write(chunks)
+                dirty = True
+
+            if dirty and (self.fsync == 'always' or closed or
+                          (self.fsync == 'everysec' and time.time() - last_fsync >= 1)):
+                os.fsync(self.file.fileno())
+                dirty = False
+                last_fsync = time.time()
+
+            with self.cond:
+                self.written += written
+                self.cond.notify_all()
+                if closed and not pending:
+                    self.file.close()
+                    return
+            if written and self.fsync != 'always':
+                # Let records accumulate rather than waking up for each.
+                time.sleep(self.BATCH_INTERVAL)
+
+    def _write(self, chunks):
+        self.file.write(''.join(chunks))
+        self.file.flush()
+
+    def _replace(self, result, rewrite_buffer):
+        path, ok = result
+        if ok:
+            with open(path, 'ab') as fp:
+                fp.write(''.join(rewrite_buffer or ()))
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.file.close()
+            os.rename(path, self.path)
+            self.file = open(self.path, 'ab')
+        elif os.path.exists(path):
+            os.unlink(path)
+        with self.cond:
+            self.rewriting = False
+
+def _write_rewrite(path, databases):
+    """
+    Writes a log that recreates ``databases`` with one record per key.
+    """
+    with open(path, 'wb', 1 << 16) as fp:
+        for db, keyspace in databases:
+            expires = keyspace.expires
+            for key, value in keyspace.iteritems():
+                value = _full_value(value)
+                if isinstance(value, str):
+                    value_type = _TYPE_STRING
+                elif isinstance(value, (deque, list)):
+                    value_type, value = _TYPE_LIST, list(value)
+                elif isinstance(value, dict):
+                    value_type = _TYPE_HASH
+                elif isinstance(value, SortedSet):
+                    value_type, value = _TYPE_ZSET, list(value.pairs(0, len(value)))
+                else:
+                    value_type = _TYPE_SET
+                fp.write(_encode_record(
+                    (db, '_restore', (key, value_type, value, expires.get(key)))))
+        fp.flush()
+        os.fsync(fp.fileno())
+
+def _bgrewriteaof(server):
+    """
+    Rewrites the log of ``server`` from the current data in the
+    background, the same way as _bgsave(). Records logged meanwhile are
+    appended to the new log by the writer thread before it replaces the
+    old one.
+    """
+    aof = _aofs.get(server)
+    if aof is None:
+        raise ResponseError("Append only file is not enabled")
+    if aof.rewriting:
+        raise ResponseError("Background append only file rewriting already in progress")
+    databases = _server_keyspaces(server)
+    path = '%s.rewrite-%d' % (aof.path, os.getpid())
+    fork = getattr(os, 'fork', None)
+    with _SnapshotLocks(databases, server):
+        aof.start_rewrite()
+        if fork is not None:
+            databases = _detach_shared(databases)
+            pid = fork()
+            if pid == 0:
+                status = 1
+                try:
+                    _write_rewrite(path, databases)
+                    status = 0
+                finally:
+                    os._exit(status)
+        else:
+            copies = []
+            for db, keyspace in databases:
+                copy = Keyspace()
+                for key, value in keyspace.iteritems():
+                    dict.__setitem__(copy, key, _copy_value(value))
+                copy.expires.update(keyspace.expires)
+                copies.append((db, copy))
+
+    def run():
+        ok = False
+        try:
+            if fork is not None:
+                ok = os.waitpid(pid, 0)[1] == 0
+            else:
+                _write_rewrite(path, copies)
+                ok = True
+        finally:
+            aof.finish_rewrite(path, ok)
+    thread = threading.Thread(target=run, name='bgrewriteaof %s' % server)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _replay(host, port, path, clock):
+    """
+    Runs the commands of the log at ``path`` against the databases of the
+    server, which must not be used yet.
+    """
+    clients = {}
+    for db, name, args in _read_records(path):
+        client = clients.get(db)
+        if client is None:
+            client = clients[db] = Redis(host, port, db, clock=clock, threadsafe=False)
+        if name == '_restore':
+            key, value_type, value, deadline = args
+            if value_type == _TYPE_LIST:
+                value = deque(value)
+            elif value_type == _TYPE_ZSET:
+                value = SortedSet.from_pairs(value)
+            client._cache[key] = value
+            if deadline is not None:
+                _expire_at(client, key, deadline)
+        else:
+            client._run_command(_commands[name], args)
+
+def _attach_aof(server, aof):
+    prefix = server + ':'
+    for name, keyspace in _caches.items():
+        if name.startswith(prefix):
+            keyspace.db = name[len(prefix):]
+            keyspace.aof = aof
+
+#### COMMAND STATISTICS ####
+
+# The CommandStats of each server whose command statistics were enabled
+# once, by "host:port". They are attached to the keyspaces of the server
+# while latency tracking is on.
+_stats = {}
+
+class LatencyHistogram(object):
+    """
+    Counts latencies in microseconds in buckets of logarithmically growing
+    width, like HdrHistogram: values below 2 ** SUB_BUCKET_BITS are counted
+    exactly and larger ones with a relative error below
+    2 ** (1 - SUB_BUCKET_BITS), in O(1) per value.
+    """
+    SUB_BUCKET_BITS = 6
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+
+    def add(self, value):
+        exponent = value.bit_length() - self.SUB_BUCKET_BITS
+        if exponent > 0:
+            value = (exponent << self.SUB_BUCKET_BITS - 1) + (value >> exponent)
+        self.counts[value] = self.counts.get(value, 0) + 1
+        self.total += 1
+
+    def merge(self, other):
+        """
+        Adds the values counted by ``other``.
+        """
+        for bucket, count in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+
+    def highest_equivalent(self, bucket):
+        """
+        Returns the largest value counted in ``bucket``.
+        """
+        half = 1 << self.SUB_BUCKET_BITS - 1
+        if bucket < 2 * half:
+            return bucket
+        exponent = (bucket >> self.SUB_BUCKET_BITS - 1) - 1
+        return ((bucket - (exponent << self.SUB_BUCKET_BITS - 1) + 1) << exponent) - 1
+
+    def percentiles(self, percentiles):
+        """
+        Returns the value at each of ``percentiles``, given in ascending
+        order.
+        """
+        values = []
+        if not self.total:
+            return [0] * len(percentiles)
+        seen = 0
+        buckets = iter(sorted(self.counts.iteritems()))
+        for percentile in percentiles:
+            wanted = max(1, int(math.ceil(self.total * percentile / 100.0)))
+            while seen < wanted:
+                bucket, count = next(buckets)
+                seen += count
+            values.append(self.highest_equivalent(bucket))
+        return values
+
+class _CommandStat(object):
+    __slots__ = ('calls', 'usec', 'lock_wait_usec', 'failed_calls', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.usec = 0
+        self.lock_wait_usec = 0
+        self.failed_calls = 0
+        self.histogram = LatencyHistogram()
+
+class _TimedLock(object):
+    """
+    Wraps the lock context of one command to record how long it waited
+    for the lock and how long it ran with it.
+    """
+    __slots__ = ('stats', 'lock', 'client', 'name', 'args', 'started', 'locked')
+
+    def __init__(self, stats, lock, client, name, args):
+        self.stats = stats
+        self.lock = lock
+        self.client = client
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.time()
+        self.lock.__enter__()
+        self.locked = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        finished = time.time()
+        try:
+            return self.lock.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.stats.record(self.client, self.name, self.args, self.started,
+                              self.locked, finished, exc_type is not None)
+
+class CommandStats(object):
+    """
+    Per-command call counts, execution and lock wait times, latency
+    histograms and the slow log of one server.
+
+    Commands are only timed while the CommandStats is attached to the
+    keyspaces as their ``stats``. Otherwise the command path pays for a
+    single attribute check.
+    """
+    PERCENTILES = (50, 99, 99.9)
+    SLOWLOG_ARGS = 32
+    SLOWLOG_ARG_LENGTH = 128
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.enabled = False
+        self.commands = {}
+        self.slowlog_log_slower_than = 10000
+        self.slowlog = deque(maxlen=128)
+        self.slowlog_id = 0
+
+    def timed(self, lock, client, name, args):
+        return _TimedLock(self, lock, client, name, args)
+
+    def record(self, client, name, args, started, locked, finished, failed):
+        lock_wait = int((locked - started) * 1000000)
+        usec = int((finished - locked) * 1000000)
+        slower_than = self.slowlog_log_slower_than
+        with self.mutex:
+            stat = self.commands.get(name)
+            if stat is None:
+                stat = self.commands[name] = _CommandStat()
+            stat.calls += 1
+            stat.usec += usec
+            stat.lock_wait_usec += lock_wait
+            if failed:
+                stat.failed_calls += 1
+            stat.histogram.add(lock_wait + usec)
+            if slower_than >= 0 and usec >= slower_than:
+                self.slowlog.appendleft((self.slowlog_id, int(started), usec,
+                                         self._slowlog_argv(client, name, args)))
+                self.slowlog_id += 1
+
+    def _slowlog_argv(self, client, name, args):
+        """
+        Returns the command as logged by SLOWLOG, with long arguments and
+        argument lists shortened the way the server does.
+        """
+        argv = [name]
+        for arg in args:
+            if isinstance(arg, (list, tuple)):
+                for item in arg:
+                    argv.extend(item if isinstance(item, tuple) else (item,))
+            elif arg is not None and not isinstance(arg, bool) and not callable(arg):
+                argv.append(arg)
+        argv = [client._to_str(arg) for arg in argv]
+        if len(argv) > self.SLOWLOG_ARGS:
+            more = len(argv) - self.SLOWLOG_ARGS + 1
+            argv[self.SLOWLOG_ARGS - 1:] = ['... (%d more arguments)' % more]
+        for i, arg in enumerate(argv):
+            if len(arg) > self.SLOWLOG_ARG_LENGTH:
+                argv[i] = '%s... (%d more bytes)' % (arg[:self.SLOWLOG_ARG_LENGTH],
+                                                    len(arg) - self.SLOWLOG_ARG_LENGTH)
+        return argv
+
+    def reset(self):
+        with self.mutex:
+            self.commands.clear()
+
+    def reset_slowlog(self):
+        with self.mutex:
+            self.slowlog.clear()
+
+    def set_slowlog_max_len(self, max_len):
+        with self.mutex:
+            self.slowlog = deque(self.slowlog, maxlen=max_len)
+
+    def command_info(self):
+        with self.mutex:
+            return dict(('cmdstat_%s' % name, {
+                'calls': stat.calls,
+                'usec': stat.usec,
+                'usec_per_call': round(float(stat.usec) / stat.calls, 2),
+                'lock_wait_usec': stat.lock_wait_usec,
+                'failed_calls': stat.failed_calls,
+            }) for name, stat in self.commands.iteritems())
+
+    def latency_info(self):
+        with self.mutex:
+            info = {}
+            for name, stat in self.commands.iteritems():
+                values = stat.histogram.percentiles(self.PERCENTILES)
+                info['latency_percentiles_usec_%s' % name] = dict(
+                    ('p%s' % ('%g' % percentile), value)
+                    for percentile, value in zip(self.PERCENTILES, values))
+            return info
+
+def _server_stats(server):
+    stats = _stats.get(server)
+    if stats is None:
+        stats = _stats.setdefault(server, CommandStats())
+    return stats
+
+def _attach_stats(server, stats):
+    """
+    Starts or stops timing the commands of every database of ``server``.
+    """
+    prefix = server + ':'
+    for name, keyspace in _caches.items():
+        if name.startswith(prefix):
+            keyspace.stats = stats if stats.enabled else None
+
+#### COMMAND TRACE ####
+
+# The CommandTrace of each server being traced, by "host:port".
+_traces = {}
+
+TRACE_MAGIC = 'redis-mock-trace'
+TRACE_VERSION = 1
+
+def _trace_arg(arg):
+    # Score casts only shape the reply, so replays cast with float().
+    if callable(arg):
+        return Ellipsis
+    if isinstance(arg, (list, tuple)):
+        return type(arg)(_trace_arg(item) for item in arg)
+    return arg if isinstance(arg, _marshalable) else str(arg)
+
+def _replay_arg(arg):
+    if arg is Ellipsis:
+        return float
+    if isinstance(arg, tuple):
+        return tuple(_replay_arg(item) for item in arg)
+    return arg
+
+class CommandTrace(object):
+    """
+    Records the commands run on the databases of a server, like MONITOR,
+    for replay_trace().
+
+    The trace file starts with a (TRACE_MAGIC, TRACE_VERSION, start time)
+    record, followed by a (microseconds since the start, thread number,
+    db, command name, args) record per command, encoded like the records
+    of the append-only file. Threads are numbered in the order they first
+    ran a command. A pipeline is a single "exec" record whose args are
+    the (command name, args) pairs it ran.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.mutex = threading.Lock()
+        self.started = time.time()
+        self.threads = {}
+        self.count = 0
+        self.file.write(self._encode((TRACE_MAGIC, TRACE_VERSION, self.started)))
+
+    def _encode(self, record):
+        try:
+            data = marshal.dumps(record)
+        except ValueError:
+            usec, thread_no, db, name, args = record
+            data = marshal.dumps((usec, thread_no, db, name, _trace_arg(args)))
+        return _pack_record_length(len(data)) + data
+
+    def log(self, db, name, args):
+        usec = int((time.time() - self.started) * 1000000)
+        ident = threading.current_thread().ident
+        with self.mutex:
+            if self.file is None:
+                return
+            thread_no = self.threads.get(ident)
+            if thread_no is None:
+                thread_no = self.threads[ident] = len(self.threads)
+            self.file.write(self._encode((usec, thread_no, db, name, args)))
+            self.count += 1
+
+    def close(self):
+        with self.mutex:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def _read_trace(path):
+    """
+    Returns the start time and the command records of the trace at
+    ``path``.
+    """
+    records = _read_records(path)
+    header = next(records, None)
+    if (not isinstance(header, tuple) or len(header) != 3 or
+            header[:2] != (TRACE_MAGIC, TRACE_VERSION)):
+        raise RedisError("%s is not a command trace" % path)
+    return header[2], records
+
+def _attach_trace(server, trace):
+    """
+    Starts tracing the commands of every database of ``server``, or stops
+    when ``trace`` is None.
+    """
+    prefix = server + ':'
+    for name, keyspace in _caches.items():
+        if name.startswith(prefix):
+            keyspace.db = name[len(prefix):]
+            keyspace.trace = trace
+
+def _replay_command(clients, db, name, args):
+    client = clients[db]
+    try:
+        if name == 'exec':
+            pipe = client.pipeline()
+            pipe.command_stack = [(cmd_name, _replay_arg(cmd_args))
+                                  for cmd_name, cmd_args in args]
+            try:
+                pipe._execute_batch()
+            finally:
+                pipe.reset()
+        else:
+            client._run_command(_commands[name], _replay_arg(args))
+    except RedisError:
+        # The traced command failed the same way.
+        pass
+
+def replay_trace(path, host='localhost', port=6379, speed=None, threads=None,
+                 **options):
+    """
+    Runs the commands of the trace at ``path`` against the databases of
+    ``host`` and ``port`` and returns the number of commands and the
+    seconds it took.
+
+    The commands of each traced thread run in order, in a thread of their
+    own or, when ``threads`` is given, spread over that many threads.
+    With ``speed`` each command waits until its time in the trace divided
+    by ``speed`` (1 for the original pace); otherwise they run as fast as
+    possible. ``options`` are passed on to Redis().
+    """
+    records = _read_trace(path)[1]
+    queues = defaultdict(list)
+    for usec, thread_no, db, name, args in records:
+        queues[thread_no if threads is None else thread_no % threads].append(
+            (usec, db, name, args))
+    count = sum(len(queue) for queue in queues.itervalues())
+    dbs = set(db for queue in queues.itervalues() for _, db, _, _ in queue)
+    # Create the databases before the clock starts.
+    for db in dbs:
+        Redis(host, port, db, **options)
+
+    def run(queue, start):
+        clients = dict((db, Redis(host, port, db, **options)) for db in dbs)
+        for usec, db, name, args in queue:
+            if speed:
+                delay = start + usec / 1000000.0 / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            _replay_command(clients, db, name, args)
+
+    start = time.time()
+    workers = [threading.Thread(target=run, args=(queue, start))
+               for queue in queues.itervalues()]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return count, time.time() - start
+
+#### SHARED KEYSPACE ####
+
+class ProcessRWLock(object):
+    """
+    A reader-writer lock shared by every process that maps the file of a
+    SharedKeyspace.
+
+    Threads of a process exclude each other with an RWLock and processes
+    with flock() on the process's descriptor of the file. A flock() lock
+    belongs to the open file rather than to a thread, so the first reader
+    of a process takes the shared lock for all of its readers and the
+    last one releases it.
+    """
+    stripe_count = 1
+
+    def __init__(self, keyspace):
+        self.keyspace = keyspace
+        self.local = RWLock()
+        self.mutex = threading.Lock()
+        self.readers = 0
+        self._reader = _LockContext(self.reader_enters, self.reader_leaves)
+        self._writer = _LockContext(self.writer_enters, self.writer_leaves)
+
+    def reader_enters(self):
+        self.local.reader_enters()
+        try:
+            with self.mutex:
+                if self.readers == 0:
+                    self.keyspace.lock_file(fcntl.LOCK_SH)
+                self.readers += 1
+        except:
+            self.local.reader_leaves()
+            raise
+
+    def reader_leaves(self):
+        with self.mutex:
+            self.readers -= 1
+            if self.readers == 0:
+                self.keyspace.unlock_file()
+        self.local.reader_leaves()
+
+    def reader(self, *keys):
+        return self._reader
+
+    def writer_enters(self):
+        self.local.writer_enters()
+        try:
+            self.keyspace.lock_file(fcntl.LOCK_EX)
+        except:
+            self.local.writer_leaves()
+            raise
+        self.keyspace.begin_write()
+
+    def writer_leaves(self):
+        try:
+            self.keyspace.end_write()
+        finally:
+            self.keyspace.unlock_file()
+            self.local.writer_leaves()
+
+    def writer(self, *keys):
+        return self._writer
+
+class _SharedExpires(object):
+    """
+    The ``expires`` mapping of a SharedKeyspace, whose deadlines are kept
+    in the hash table next to the keys.
+    """
+    def __init__(self, keyspace):
+        self.keyspace = keyspace
+
+    def __nonzero__(self):
+        return self.keyspace._field(_SHARED_VOLATILE) > 0
+
+    def __len__(self):
+        return self.keyspace._field(_SHARED_VOLATILE)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        slot = self.keyspace._find(key)
+        if slot is None:
+            return default
+        deadline = self.keyspace._slot(slot)[3]
+        return default if deadline < 0 else deadline
+
+    def __getitem__(self, key):
+        deadline = self.get(key)
+        if deadline is None:
+            raise KeyError(key)
+        return deadline
+
+    def __setitem__(self, key, deadline):
+        self.keyspace.expire_at(key, deadline)
+
+    def iteritems(self):
+        keyspace = self.keyspace
+        for key, slot in keyspace._slots():
+            deadline = keyspace._slot(slot)[3]
+            if deadline >= 0:
+                yield key, deadline
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [key for key, deadline in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+# A shared keyspace file starts with a header holding SHARED_MAGIC, the
+# number of hash table slots, of keys, of deleted slots and of keys with a
+# deadline, the end of the allocated blocks, the file size, the offset of
+# the hash table and the head of the free list of each block size class.
+SHARED_MAGIC = 'REDISMOCKSHM\x01\x00\x00\x00'
+(_SHARED_CAPACITY, _SHARED_COUNT, _SHARED_DELETED, _SHARED_VOLATILE,
+ _SHARED_TOP, _SHARED_SIZE, _SHARED_TABLE, _SHARED_FREE) = range(8)
+_SHARED_CLASSES = 48
+# After the free lists, the number of keys of each type.
+_SHARED_TYPES = _SHARED_FREE + _SHARED_CLASSES
+_SHARED_TYPE_NAMES = {
+    _TYPE_STRING: 'string',
+    _TYPE_LIST: 'list',
+    _TYPE_SET: 'set',
+    _TYPE_HASH: 'hash',
+    _TYPE_ZSET: 'zset',
+}
+_SHARED_TYPE_FIELDS = dict((value_type, _SHARED_TYPES + i) for i, value_type
+                           in enumerate(sorted(_SHARED_TYPE_NAMES)))
+_SHARED_HEADER_SIZE = 4096
+
+# Each hash table slot holds the hash of its key (0 for a free slot and 1
+# for a deleted one), the offset and length of the key's entry and its
+# deadline in milliseconds, or -1. An entry is the key's length, the key,
+# a type opcode and the marshalled value.
+_shared_slot = struct.Struct('<QQQq')
+_shared_field = struct.Struct('<Q')
+_shared_key_length = struct.Struct('<I')
+_FREE_SLOT = 0
+_DELETED_SLOT = 1
+
+class SharedKeyspace(object):
+    """
+    The keys and values of one database, kept in a memory mapped file so
+    that every process that opens the file works on the same keys.
+
+    Keys are found through an open addressing hash table with linear
+    probing on their CRC-32, which unlike hash() is the same in every
+    process. Each key and its marshalled value are stored in a block from
+    a slab allocator with power of two size classes, and freed blocks are
+    reused through a free list per class. The file doubles when it's full
+    and other processes remap it the next time they take the lock.
+
+    Every access must hold ``lock``. Commands mutate the values they get
+    in place, so during a writer section the values are decoded once,
+    kept in ``loaded`` and written back when the writer leaves. Like
+    every keyspace, expired keys are only deleted under the writer lock.
+    """
+    MIN_CAPACITY = 64
+    MIN_CLASS = 5
+    MAX_LOAD = 0.7
+
+    sweeper = None
+    limit = None
+    scans = None
+    encodings = None
+
+    def __init__(self, path, initial_size=1 << 20):
+        if fcntl is None:
+            raise RedisError("Shared keyspaces need fcntl.flock()")
+        self.path = path
+        self.initial_size = initial_size
+        self.expires = _SharedExpires(self)
+        self.heap = None
+        self.aof = None
+        self.db = None
+        self.stats = None
+        self.trace = None
+        self.views = {}
+        self.loaded = None
+        self.lock = ProcessRWLock(self)
+        self._open()
+
+    def _open(self):
+        self.pid = os.getpid()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                self._initialize()
+            self.map = mmap.mmap(self.fd, os.fstat(self.fd).st_size)
+            if self.map[:len(SHARED_MAGIC)] != SHARED_MAGIC:
+                self.map.close()
+                raise RedisError("%s is not a shared keyspace file" % self.path)
+        except:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            raise
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _initialize(self):
+        size = max(self.initial_size, 2 * _SHARED_HEADER_SIZE)
+        os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.map[:len(SHARED_MAGIC)] = SHARED_MAGIC
+        self._set_field(_SHARED_TOP, _SHARED_HEADER_SIZE)
+        self._set_field(_SHARED_SIZE, size)
+        self._set_field(_SHARED_TABLE, self._new_table(self.MIN_CAPACITY))
+        self._set_field(_SHARED_CAPACITY, self.MIN_CAPACITY)
+        self.map.close()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    #### LOCKING ####
+
+    def lock_file(self, operation):
+        if os.getpid() != self.pid:
+            # A forked child shares its parent's open file and so its
+            # flock() locks; it needs a file of its own.
+            self.map.close()
+            os.close(self.fd)
+            self._open()
+        fcntl.flock(self.fd, operation)
+        try:
+            size = self._field(_SHARED_SIZE)
+            if size != len(self.map):
+                self.map.close()
+                self.map = mmap.mmap(self.fd, size)
+        except:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            raise
+
+    def unlock_file(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def begin_write(self):
+        self.loaded = {}
+
+    def end_write(self):
+        loaded, self.loaded = self.loaded, None
+        for key, value in loaded.iteritems():
+            slot = self._find(key)
+            if slot is None:
+                continue
+            data = self._entry_data(key, value)
+            slot_hash, entry, length, deadline = self._slot(slot)
+            if length != len(data) or self.map[entry + 1:entry + 1 + length] != data:
+                self._write_entry(key, data, slot)
+
+    #### HEADER AND ALLOCATOR ####
+
+    def _field(self, field):
+        return _shared_field.unpack_from(self.map, len(SHARED_MAGIC) + 8 * field)[0]
+
+    def _set_field(self, field, value):
+        _shared_field.pack_into(self.map, len(SHARED_MAGIC) + 8 * field, value)
+
+    def _alloc(self, length):
+        """
+        Returns the offset of a free block for ``length`` bytes. The first
+        byte of each block holds its size class.
+        """
+        size_class = max(self.MIN_CLASS, (length + 1).bit_length())
+        free_list = _SHARED_FREE + size_class
+        offset = self._field(free_list)
+        if offset:
+            self._set_field(free_list, _shared_field.unpack_from(self.map, offset + 1)[0])
+            return offset
+        offset = self._field(_SHARED_TOP)
+        top = offset + (1 << size_class)
+        if top > len(self.map):
+            size = len(self.map)
+            while size < top:
+                size *= 2
+            self.map.resize(size)
+            self._set_field(_SHARED_SIZE, size)
+        self._set_field(_SHARED_TOP, top)
+        self.map[offset] = chr(size_class)
+        return offset
+
+    def _free(self, offset):
+        free_list = _SHARED_FREE + ord(self.map[offset])
+        _shared_field.pack_into(self.map, offset + 1, self._field(free_list))
+        self._set_field(free_list, offset)
+
+    #### HASH TABLE ####
+
+    def _new_table(self, capacity):
+        table = self._alloc(capacity * _shared_slot.size)
+        self.map[table + 1:table + 1 + capacity * _shared_slot.size] = \
+            '\x00' * (capacity * _shared_slot.size)
+        return table
+
+    def _slot_offset(self, slot):
+        return self._field(_SHARED_TABLE) + 1 + slot * _shared_slot.size
+
+    def _slot(self, slot):
+        return _shared_slot.unpack_from(self.map, self._slot_offset(slot))
+
+    def _probe(self, key, key_hash):
+        """
+        Returns the slot holding ``key``, or None, and the slot where it
+        would be inserted.
+        """
+        data = self.map
+        unpack = _shared_slot.unpack_from
+        mask = self._field(_SHARED_CAPACITY) - 1
+        table = self._field(_SHARED_TABLE) + 1
+        slot = key_hash & mask
+        insert_at = None
+        while True:
+            slot_hash, entry, length, deadline = unpack(data, table + slot * _shared_slot.size)
+            if slot_hash == _FREE_SLOT:
+                return None, slot if insert_at is None else insert_at
+            if slot_hash == _DELETED_SLOT:
+                if insert_at is None:
+                    insert_at = slot
+            elif slot_hash == key_hash:
+                end = entry + 5 + _shared_key_length.unpack_from(data, entry + 1)[0]
+                if data[entry + 5:end] == key:
+                    return slot, slot
+            slot = (slot + 1) & mask
+
+    def _find(self, key):
+        return self._probe(key, _shared_hash(key))[0]
+
+    def _slots(self):
+        for slot in xrange(self._field(_SHARED_CAPACITY)):
+            slot_hash, entry, length, deadline = self._slot(slot)
+            if slot_hash > _DELETED_SLOT:
+                yield self._entry_key(entry), slot
+
+    def _entry_key(self, entry):
+        end = entry + 5 + _shared_key_length.unpack_from(self.map, entry + 1)[0]
+        return self.map[entry + 5:end]
+
+    def _resize(self, capacity):
+        old_table = self._field(_SHARED_TABLE)
+        old_slots = [self._slot(slot) for slot in xrange(self._field(_SHARED_CAPACITY))]
+        table = self._new_table(capacity)
+        mask = capacity - 1
+        for slot_hash, entry, length, deadline in old_slots:
+            if slot_hash <= _DELETED_SLOT:
+                continue
+            slot = slot_hash & mask
+            while _shared_field.unpack_from(self.map, table + 1 + slot * _shared_slot.size)[0]:
+                slot = (slot + 1) & mask
+            _shared_slot.pack_into(self.map, table + 1 + slot * _shared_slot.size,
+                                   slot_hash, entry, length, deadline)
+        self._set_field(_SHARED_TABLE, table)
+        self._set_field(_SHARED_CAPACITY, capacity)
+        self._set_field(_SHARED_DELETED, 0)
+        self._free(old_table)
+
+    #### ENTRIES ####
+
+    def _entry_data(self, key, value):
+        if isinstance(value, str):
+            value_type = _TYPE_STRING
+        elif isinstance(value, int):
+            # Counters are stored formatted, as snapshots store them.
+            value_type, value = _TYPE_STRING, str(value)
+        elif isinstance(value, (deque, list)):
+            value_type, value = _TYPE_LIST, list(value)
+        elif isinstance(value, dict):
+            value_type = _TYPE_HASH
+        elif isinstance(value, SortedSet):
+            value_type, value = _TYPE_ZSET, list(value.pairs(0, len(value)))
+        else:
+            value_type = _TYPE_SET
+        return ''.join((_shared_key_length.pack(len(key)), key, value_type,
+                        marshal.dumps(value)))
+
+    def _decode(self, slot):
+        slot_hash, entry, length, deadline = self._slot(slot)
+        start = entry + 5 + _shared_key_length.unpack_from(self.map, entry + 1)[0]
+        value_type = self.map[start]
+        value = marshal.loads(self.map[start + 1:entry + 1 + length])
+        if value_type == _TYPE_LIST:
+            return deque(value)
+        if value_type == _TYPE_ZSET:
+            return SortedSet.from_pairs(value)
+        return value
+
+    def _entry_type(self, entry):
+        return self.map[entry + 5 + _shared_key_length.unpack_from(self.map, entry + 1)[0]]
+
+    def _count_type(self, value_type, amount):
+        field = _SHARED_TYPE_FIELDS[value_type]
+        self._set_field(field, self._field(field) + amount)
+
+    def _write_entry(self, key, data, slot):
+        slot_hash, entry, length, deadline = self._slot(slot)
+        old_type = self._entry_type(entry)
+        new_type = data[4 + len(key)]
+        if old_type != new_type:
+            self._count_type(old_type, -1)
+            self._count_type(new_type, 1)
+        if ord(self.map[entry]) < max(self.MIN_CLASS, (len(data) + 1).bit_length()):
+            self._free(entry)
+            entry = self._alloc(len(data))
+        self.map[entry + 1:entry + 1 + len(data)] = data
+        _shared_slot.pack_into(self.map, self._slot_offset(slot),
+                               slot_hash, entry, len(data), deadline)
+
+    def _remove(self, key, slot):
+        slot_hash, entry, length, deadline = self._slot(slot)
+        self._count_type(self._entry_type(entry), -1)
+        if deadline >= 0:
+            self._set_field(_SHARED_VOLATILE, self._field(_SHARED_VOLATILE) - 1)
+        self._free(entry)
+        _shared_slot.pack_into(self.map, self._slot_offset(slot), _DELETED_SLOT, 0, 0, -1)
+        self._set_field(_SHARED_COUNT, self._field(_SHARED_COUNT) - 1)
+        self._set_field(_SHARED_DELETED, self._field(_SHARED_DELETED) + 1)
+        if self.loaded is not None:
+            self.loaded.pop(key, None)
+
+    #### MAPPING ####
+
+    def __len__(self):
+        return self._field(_SHARED_COUNT)
+
+    def type_counts(self):
+        return dict((name, self._field(_SHARED_TYPE_FIELDS[value_type]))
+                    for value_type, name in _SHARED_TYPE_NAMES.iteritems())
+
+    def __contains__(self, key):
+        if self.loaded is not None and key in self.loaded:
+            return True
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        loaded = self.loaded
+        if loaded is not None and key in loaded:
+            return loaded[key]
+        slot = self._find(key)
+        if slot is None:
+            return default
+        value = self._decode(slot)
+        if loaded is not None:
+            loaded[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        data = self._entry_data(key, value)
+        key_hash = _shared_hash(key)
+        slot, insert_at = self._probe(key, key_hash)
+        if slot is not None:
+            self._write_entry(key, data, slot)
+        else:
+            count = self._field(_SHARED_COUNT)
+            capacity = self._field(_SHARED_CAPACITY)
+            if count + self._field(_SHARED_DELETED) + 1 > capacity * self.MAX_LOAD:
+                # Grow the table, or only drop its deleted slots when they
+                # are what fills it.
+                while (count + 1) * 2 > capacity * self.MAX_LOAD:
+                    capacity *= 2
+                self._resize(capacity)
+                slot, insert_at = self._probe(key, key_hash)
+            elif self._slot(insert_at)[0] == _DELETED_SLOT:
+                self._set_field(_SHARED_DELETED, self._field(_SHARED_DELETED) - 1)
+            entry = self._alloc(len(data))
+            self.map[entry + 1:entry + 1 + len(data)] = data
+            _shared_slot.pack_into(self.map, self._slot_offset(insert_at),
+                                   key_hash, entry, len(data), -1)
+            self._set_field(_SHARED_COUNT, count + 1)
+            self._count_type(data[4 + len(key)], 1)
+        if self.loaded is not None:
+            self.loaded[key] = value
+
+    def __delitem__(self, key):
+        if self.pop(key, None) is None:
+            raise KeyError(key)
+
+    def pop(self, key, *default):
+        slot = self._find(key)
+        if slot is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self.get(key)
+        self._remove(key, slot)
+        return value
+
+    def clear(self):
+        for key, slot in list(self._slots()):
+            self._remove(key, slot)
+        if self.heap is not None:
+            del self.heap[:]
+        self._resize(self.MIN_CAPACITY)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [key for key, slot in self._slots()]
+
+    def iteritems(self):
+        loaded = self.loaded
+        for key, slot in list(self._slots()):
+            if loaded is not None and key in loaded:
+                yield key, loaded[key]
+            else:
+                yield key, self._decode(slot)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def expire_at(self, key, deadline):
+        slot = self._find(key)
+        if slot is None:
+            return
+        slot_hash, entry, length, old_deadline = self._slot(slot)
+        if old_deadline < 0:
+            self._set_field(_SHARED_VOLATILE, self._field(_SHARED_VOLATILE) + 1)
+        _shared_slot.pack_into(self.map, self._slot_offset(slot),
+                               slot_hash, entry, length, deadline)
+        if self.heap is not None:
+            heapq.heappush(self.heap, (deadline, key))
+
+    def persist(self, key):
+        slot = self._find(key)
+        if slot is None:
+            return False
+        slot_hash, entry, length, deadline = self._slot(slot)
+        if deadline < 0:
+            return False
+        self._set_field(_SHARED_VOLATILE, self._field(_SHARED_VOLATILE) - 1)
+        _shared_slot.pack_into(self.map, self._slot_offset(slot),
+                               slot_hash, entry, length, -1)
+        return True
+
+    def scan(self, cursor, count):
+        """
+        Returns the next cursor and about ``count`` keys from ``cursor``.
+        The cursor counts through the home slots of the keys, the slots
+        their hash maps to, the same way _ScanIndex counts through its
+        buckets, so it survives the table growing.
+        """
+        capacity = self._field(_SHARED_CAPACITY)
+        bits = capacity.bit_length() - 1
+        mask = capacity - 1
+        found = []
+        while True:
+            home = cursor & mask
+            slot = home
+            while True:
+                slot_hash, entry, length, deadline = self._slot(slot)
+                if slot_hash == _FREE_SLOT:
+                    break
+                if slot_hash > _DELETED_SLOT and slot_hash & mask == home:
+                    found.append(self._entry_key(entry))
+                slot = (slot + 1) & mask
+                if slot == home:
+                    break
+            cursor = _next_cursor(cursor, bits)
+            if not cursor or len(found) >= count:
+                return cursor, found
+
+    def scan_members(self, key, members, cursor, count):
+        # Values are decoded for every command, so there is no index to
+        # keep between steps.
+        return _ScanIndex(members).scan(cursor, count)
+
+    def detach(self):
+        """
+        Returns a private Keyspace with a copy of the keys, for snapshots
+        written after the lock is released.
+        """
+        copy = Keyspace()
+        copy.update(self.iteritems())
+        copy.expires.update(self.expires.iteritems())
+        return copy
+
+def _shared_hash(key):
+    return (zlib.crc32(key) & 0xffffffff) + 2
+
+def _detach_shared(databases):
+    return [(db, keyspace.detach() if isinstance(keyspace, SharedKeyspace) else keyspace)
+            for db, keyspace in databases]
+
+def _shared_keyspace(name, path):
+    """
+    Returns the SharedKeyspace of the database ``name`` in the file at
+    ``path`` and registers its lock as the lock of the database.
+    """
+    keyspace = _caches.get(name)
+    if keyspace is None:
+        keyspace = _caches.setdefault(name, SharedKeyspace(path))
+    if not isinstance(keyspace, SharedKeyspace) or keyspace.path != path:
+        raise RedisError("%s is not kept in %s" % (name, path))
+    if _locks.setdefault(name, keyspace.lock) is not keyspace.lock:
+        raise RedisError("%s is already locked by a private keyspace" % name)
+    return keyspace
+
+#### COMMAND ROUTER ####
+
+# Routes map the commands as they are sent over the wire, an upper case
+# name and a list of string arguments, to a registered command and its
+# Python arguments, and format the result the way the server replies.
+
+class Status(str):
+    """
+    A status reply such as "OK", as opposed to a bulk string.
+    """
+
+_OK = Status('OK')
+_QUEUED = Status('QUEUED')
+
+class Route(object):
+    """
+    A command as sent over the wire.
+
+    ``arity`` counts the command name like the server's COMMAND does: a
+    negative arity is a minimum number of arguments. ``parse`` returns the
+    name and the arguments of the registered command to run and ``reply``
+    converts its result.
+    """
+    __slots__ = ('name', 'arity', 'parse', 'reply')
+
+    def __init__(self, name, arity, parse, reply):
+        self.name = name
+        self.arity = arity
+        self.parse = parse
+        self.reply = reply
+
+    def check_arity(self, argv):
+        arity = self.arity
+        if (arity >= 0 and len(argv) != arity) or (arity < 0 and len(argv) < -arity):
+            raise ResponseError("wrong number of arguments for '%s' command"
+                                % self.name.lower())
+
+_routes = {}
+
+def _reply_bulk(result):
+    return result
+
+def _reply_int(result):
+    return None if result is None else int(result)
+
+def _reply_ok(result):
+    return _OK
+
+def _reply_ok_or_nil(result):
+    return None if result is None else _OK
+
+def _reply_list(result):
+    return list(result)
+
+def _reply_flat(result):
+    """
+    Flattens (member, score) tuples and hash items into one list.
+    """
+    if isinstance(result, Mapping):
+        result = result.iteritems()
+    flat = []
+    for item in result:
+        if isinstance(item, tuple):
+            flat.extend(item)
+        else:
+            flat.append(item)
+    return flat
+
+def _reply_score(result):
+    return None if result is None else _format_score(result)
+
+def _reply_config(result):
+    return _OK if result is True else _reply_flat(result)
+
+def _reply_info(result):
+    lines = []
+    for name, value in sorted(result.iteritems()):
+        if isinstance(value, dict):
+            value = ','.join('%s=%s' % item for item in sorted(value.iteritems()))
+        lines.append('%s:%s\r\n' % (name, value))
+    return ''.join(lines)
+
+def _reply_status(result):
+    return Status(result)
+
+def route(name, arity, reply=_reply_bulk):
+    """
+    Registers the decorated function as the parser of the wire command
+    ``name``. It's called with the arguments that follow the name.
+    """
+    def decorator(parse):
+        _routes[name] = Route(name, arity, parse, reply)
+        return parse
+    return decorator
+
+def _same(command_name):
+    """
+    Returns a parser that passes the arguments through unchanged.
+    """
+    def parse(args):
+        return command_name, args
+    return parse
+
+def _int_arg(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ResponseError("value is not an integer or out of range")
+
+def _resolve(argv):
+    """
+    Returns the route of ``argv``, and the name and the arguments of the
+    registered command to run for it.
+    """
+    name = argv[0].upper()
+    wire = _routes.get(name)
+    if wire is None:
+        raise ResponseError("unknown command '%s'" % argv[0])
+    wire.check_arity(argv)
+    command_name, args = wire.parse(argv[1:])
+    return wire, command_name, args
+
+for _name, _arity, _reply in [
+        ('exists', 2, _reply_int),
+        ('type', 2, _reply_status),
+        ('dbsize', 1, _reply_int),
+        ('get', 2, _reply_bulk),
+        ('incr', 2, _reply_int),
+        ('decr', 2, _reply_int),
+        ('append', 3, _reply_int),
+        ('strlen', 2, _reply_int),
+        ('setnx', 3, _reply_int),
+        ('mget', -2, _reply_list),
+        ('getset', 3, _reply_bulk),
+        ('delete', -2, _reply_int),
+        ('pttl', 2, _reply_int),
+        ('ttl', 2, _reply_int),
+        ('persist', 2, _reply_int),
+        ('llen', 2, _reply_int),
+        ('lpush', -3, _reply_int),
+        ('rpush', -3, _reply_int),
+        ('lpop', 2, _reply_bulk),
+        ('rpop', 2, _reply_bulk),
+        ('rpoplpush', 3, _reply_bulk),
+        ('hdel', -3, _reply_int),
+        ('hexists', 3, _reply_int),
+        ('hget', 3, _reply_bulk),
+        ('hgetall', 2, _reply_flat),
+        ('hset', 4, _reply_int),
+        ('hmget', -3, _reply_list),
+        ('hlen', 2, _reply_int),
+        ('sadd', -3, _reply_int),
+        ('scard', 2, _reply_int),
+        ('srem', -3, _reply_int),
+        ('sinter', -2, _reply_list),
+        ('sinterstore', -3, _reply_int),
+        ('sunion', -2, _reply_list),
+        ('sunionstore', -3, _reply_int),
+        ('sdiff', -2, _reply_list),
+        ('sdiffstore', -3, _reply_int),
+        ('smove', 4, _reply_int),
+        ('sismember', 3, _reply_int),
+        ('smembers', 2, _reply_list),
+        ('zrem', -3, _reply_int),
+        ('zremrangebyscore', 4, _reply_int),
+        ('zcard', 2, _reply_int),
+        ('zcount', 4, _reply_int),
+        ('zscore', 3, _reply_score),
+        ('zrank', 3, _reply_int),
+        ('zrevrank', 3, _reply_int),
+        ('flushdb', 1, _reply_ok),
+        ('flushall', 1, _reply_ok)]:
+    route('DEL' if _name == 'delete' else _name.upper(), _arity, _reply)(_same(_name))
+del _name, _arity, _reply
+
+def _pairs_route(command_name):
+    def parse(args):
+        if len(args) % 2:
+            raise ResponseError("wrong number of arguments for '%s' command" % command_name)
+        return command_name, (dict(zip(args[::2], args[1::2])),)
+    return parse
+
+route('MSET', -3, _reply_ok)(_pairs_route('mset'))
+route('MSETNX', -3, _reply_int)(_pairs_route('msetnx'))
+
+@route('HMSET', -4, _reply_ok)
+def _route_hmset(args):
+    if len(args) % 2 == 0:
+        raise ResponseError("wrong number of arguments for 'hmset' command")
+    return 'hmset', (args[0], dict(zip(args[1::2], args[2::2])))
+
+def _reply_member_or_list(result):
+    return list(result) if isinstance(result, (set, list)) else result
+
+@route('SPOP', -2, _reply_member_or_list)
+def _route_spop(args):
+    if len(args) > 2:
+        raise ResponseError("syntax error")
+    return 'spop', (args[0],) + tuple(_int_arg(arg) for arg in args[1:])
+
+@route('SRANDMEMBER', -2, _reply_member_or_list)
+def _route_srandmember(args):
+    if len(args) > 2:
+        raise ResponseError("syntax error")
+    return 'srandmember', (args[0],) + tuple(_int_arg(arg) for arg in args[1:])
+
+@route('SINTERCARD', -3, _reply_int)
+def _route_sintercard(args):
+    numkeys = _int_arg(args[0])
+    if numkeys <= 0:
+        raise ResponseError("numkeys should be greater than 0")
+    if numkeys > len(args) - 1:
+        raise ResponseError("Number of keys can't be greater than number of args")
+    keys = args[1:numkeys + 1]
+    options = args[numkeys + 1:]
+    if not options:
+        return 'sintercard', (keys,)
+    if len(options) != 2 or options[0].upper() != 'LIMIT':
+        raise ResponseError("syntax error")
+    return 'sintercard', (keys, _int_arg(options[1]))
+
+@route('INCRBY', 3, _reply_int)
+def _route_incrby(args):
+    return 'incrby', (args[0], _int_arg(args[1]))
+
+@route('DECRBY', 3, _reply_int)
+def _route_decrby(args):
+    return 'decrby', (args[0], _int_arg(args[1]))
+
+@route('INCRBYFLOAT', 3, _reply_score)
+def _route_incrbyfloat(args):
+    return 'incrbyfloat', tuple(args)
+
+@route('GETRANGE', 4)
+def _route_getrange(args):
+    return 'getrange', (args[0], _int_arg(args[1]), _int_arg(args[2]))
+
+@route('SETRANGE', 4, _reply_int)
+def _route_setrange(args):
+    return 'setrange', (args[0], _int_arg(args[1]), args[2])
+
+@route('HINCRBY', 4, _reply_int)
+def _route_hincrby(args):
+    return 'hincrby', (args[0], args[1], _int_arg(args[2]))
+
+@route('HINCRBYFLOAT', 4, _reply_score)
+def _route_hincrbyfloat(args):
+    return 'hincrbyfloat', tuple(args)
+
+@route('SET', -3, _reply_ok_or_nil)
+def _route_set(args):
+    name, value = args[:2]
+    ex = px = None
+    nx = xx = False
+    options = iter(args[2:])
+    for option in options:
+        option = option.upper()
+        if option == 'NX':
+            nx = True
+        elif option == 'XX':
+            xx = True
+        elif option in ('EX', 'PX'):
+            try:
+                amount = _int_arg(next(options))
+            except StopIteration:
+                raise ResponseError("syntax error")
+            if option == 'EX':
+                ex = amount
+            else:
+                px = amount
+        else:
+            raise ResponseError("syntax error")
+    return 'set', (name, value, ex, px, nx, xx)
+
+@route('SETEX', 4, _reply_ok)
+def _route_setex(args):
+    return 'setex', (args[0], args[2], _int_arg(args[1]))
+
+@route('PSETEX', 4, _reply_ok)
+def _route_psetex(args):
+    return 'psetex', (args[0], _int_arg(args[1]), args[2])
+
+def _expire_route(command_name):
+    def parse(args):
+        return command_name, (args[0], _int_arg(args[1]))
+    route(command_name.upper(), 3, _reply_int)(parse)
+
+for _name in ('expire', 'pexpire', 'expireat', 'pexpireat'):
+    _expire_route(_name)
+del _name
+
+@route('LINDEX', 3)
+def _route_lindex(args):
+    return 'lindex', (args[0], _int_arg(args[1]))
+
+@route('LSET', 4, _reply_ok)
+def _route_lset(args):
+    return 'lset', (args[0], _int_arg(args[1]), args[2])
+
+@route('LINSERT', 5, _reply_int)
+def _route_linsert(args):
+    return 'linsert', tuple(args)
+
+@route('LRANGE', 4, _reply_list)
+def _route_lrange(args):
+    return 'lrange', (args[0], _int_arg(args[1]), _int_arg(args[2]))
+
+@route('LTRIM', 4, _reply_ok)
+def _route_ltrim(args):
+    return 'ltrim', (args[0], _int_arg(args[1]), _int_arg(args[2]))
+
+@route('LREM', 4, _reply_int)
+def _route_lrem(args):
+    return 'lrem', (args[0], args[2], _int_arg(args[1]))
+
+@route('ZADD', -4, _reply_int)
+def _route_zadd(args):
+    if len(args) % 2 != 1:
+        raise ResponseError("syntax error")
+    return 'zadd', (args[0], [(args[i + 1], args[i]) for i in xrange(1, len(args), 2)])
+
+@route('ZINCRBY', 4, _reply_score)
+def _route_zincrby(args):
+    return 'zincrby', (args[0], args[2], args[1])
+
+def _withscores(args):
+    if not args:
+        return False
+    if len(args) == 1 and args[0].upper() == 'WITHSCORES':
+        return True
+    raise ResponseError("syntax error")
+
+@route('ZRANGE', -4, _reply_flat)
+def _route_zrange(args):
+    return 'zrange', (args[0], _int_arg(args[1]), _int_arg(args[2]), False,
+                      _withscores(args[3:]), str)
+
+@route('ZREVRANGE', -4, _reply_flat)
+def _route_zrevrange(args):
+    return 'zrange', (args[0], _int_arg(args[1]), _int_arg(args[2]), True,
+                      _withscores(args[3:]), str)
+
+def _score_range_args(args, desc):
+    name, low, high = args[:3]
+    if desc:
+        low, high = high, low
+    withscores = False
+    start = num = None
+    options = args[3:]
+    i = 0
+    while i < len(options):
+        option = options[i].upper()
+        if option == 'WITHSCORES':
+            withscores = True
+            i += 1
+        elif option == 'LIMIT' and i + 2 < len(options):
+            start, num = _int_arg(options[i + 1]), _int_arg(options[i + 2])
+            i += 3
+        else:
+            raise ResponseError("syntax error")
+    return 'zrangebyscore', (name, low, high, start, num, withscores, str, desc)
+
+@route('ZRANGEBYSCORE', -4, _reply_flat)
+def _route_zrangebyscore(args):
+    return _score_range_args(args, False)
+
+@route('ZREVRANGEBYSCORE', -4, _reply_flat)
+def _route_zrevrangebyscore(args):
+    return _score_range_args(args, True)
+
+def _reply_scan(result):
+    cursor, items = result
+    return [str(cursor), _reply_flat(items)]
+
+def _scan_options(args, allow_type=False):
+    options = {}
+    if len(args) % 2:
+        raise ResponseError("syntax error")
+    for i in xrange(0, len(args), 2):
+        option = args[i].upper()
+        if option == 'MATCH':
+            options['match'] = args[i + 1]
+        elif option == 'COUNT':
+            options['count'] = _int_arg(args[i + 1])
+        elif option == 'TYPE' and allow_type:
+            options['type_name'] = args[i + 1]
+        else:
+            raise ResponseError("syntax error")
+    return options
+
+@route('KEYS', 2, _reply_list)
+def _route_keys(args):
+    return 'keys', tuple(args)
+
+@route('SCAN', -2, _reply_scan)
+def _route_scan(args):
+    options = _scan_options(args[1:], allow_type=True)
+    return 'scan', (args[0], options.get('match'), options.get('count'),
+                    options.get('type_name'))
+
+def _member_scan_route(command_name, *extra):
+    def parse(args):
+        options = _scan_options(args[2:])
+        return command_name, (args[0], args[1], options.get('match'),
+                              options.get('count')) + extra
+    route(command_name.upper(), -3, _reply_scan)(parse)
+
+_member_scan_route('sscan')
+_member_scan_route('hscan')
+_member_scan_route('zscan', str)
+
+@route('CONFIG', -2, _reply_config)
+def _route_config(args):
+    subcommand = args[0].upper()
+    if subcommand == 'GET' and len(args) == 2:
+        return 'config_get', (args[1],)
+    if subcommand == 'SET' and len(args) == 3:
+        return 'config_set', (args[1], args[2])
+    if subcommand == 'RESETSTAT' and len(args) == 1:
+        return 'config_resetstat', ()
+    raise ResponseError("Unknown CONFIG subcommand or wrong number of arguments for '%s'"
+                        % args[0])
+
+@route('INFO', -1, _reply_info)
+def _route_info(args):
+    if len(args) > 1:
+        raise ResponseError("syntax error")
+    return 'info', tuple(args)
+
+@route('OBJECT', -2)
+def _route_object(args):
+    if args[0].upper() == 'ENCODING' and len(args) == 2:
+        return 'object_encoding', (args[1],)
+    raise ResponseError("Unknown OBJECT subcommand or wrong number of arguments for '%s'"
+                        % args[0])
+
+# Commands that work on the whole server rather than on the keys of a
+# database. They run without the database lock, taking the locks they
+# need themselves.
+_server_commands = {}
+
+def _server_command(name, arity, func):
+    _server_commands[name.lower()] = func
+    route(name, arity)(_same(name.lower()))
+
+def _server_ping(client, message=None):
+    return Status('PONG') if message is None else message
+
+def _server_save(client):
+    client.save()
+    return _OK
+
+def _server_bgsave(client):
+    client.bgsave()
+    return Status('Background saving started')
+
+def _server_bgrewriteaof(client):
+    client.bgrewriteaof()
+    return Status('Background append only file rewriting started')
+
+def _server_lastsave(client):
+    return int(_lastsave.get('%s:%s' % (client._host, client._port), 0))
+
+def _server_slowlog(client, subcommand, *args):
+    subcommand = subcommand.upper()
+    if subcommand == 'GET' and len(args) <= 1:
+        return [list(entry) for entry in client._slowlog(*map(_int_arg, args))]
+    if subcommand == 'LEN' and not args:
+        return client.slowlog_len()
+    if subcommand == 'RESET' and not args:
+        client.slowlog_reset()
+        return _OK
+    raise ResponseError("Unknown SLOWLOG subcommand or wrong number of arguments for '%s'"
+                        % subcommand)
+
+def _server_config_resetstat(client):
+    return client.config_resetstat()
+
+_server_command('PING', -1, _server_ping)
+_server_command('ECHO', 2, lambda client, message: message)
+_server_command('SAVE', 1, _server_save)
+_server_command('BGSAVE', 1, _server_bgsave)
+_server_command('BGREWRITEAOF', 1, _server_bgrewriteaof)
+_server_command('LASTSAVE', 1, _server_lastsave)
+_server_command('SLOWLOG', -2, _server_slowlog)
+_server_commands['config_resetstat'] = _server_config_resetstat
+
+def _command_argv(client, args):
+    """
+    Encodes a command the way redis-py's Connection does, which splits a
+    name such as "SLOWLOG GET" into words.
+    """
+    return _encode_arg(client, args[0]).split(' ') + [_encode_arg(client, arg)
+                                                      for arg in args[1:]]
+
+def _encode_arg(client, value):
+    """
+    Encodes a command argument the way redis-py's Connection does.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    return client._to_str(value)
 
 class MockConnectionPool(object):
     def disconnect(self):
@@ -111,6 +4947,55 @@ class MockConnectionPool(object):
 class Redis(BaseRedis):
     """
     A redis.py mock object.
+
+    Pass ``lock_stripes=N`` to guard the database with N lock stripes
+    instead of a single reader-writer lock, so that threads working on
+    unrelated keys don't serialize on each other.
+
+    Pass ``threadsafe=False`` to skip locking altogether. This is only safe
+    when no other thread uses the same database.
+
+    Keys with a TTL are deleted when a command touches them after their
+    deadline. Pass ``active_expire=True`` (or an interval in seconds) to
+    also delete them from a background ExpirySweeper. ``clock`` replaces
+    time.time() for tests; all connections to a database should share it.
+
+    Pass ``maxmemory`` (in bytes) to bound the approximate memory used by
+    the database, with ``maxmemory_policy`` and ``maxmemory_samples``
+    choosing which keys are evicted as in the Redis server. The settings
+    can also be changed with config_set().
+
+    save() and bgsave() write every database of the host and port to a
+    snapshot file, ``dbfilename`` ("dump.rdb" by default). When
+    ``dbfilename`` is passed and exists, it's loaded by the first
+    connection to the host and port.
+
+    Pass ``appendonly=True`` to also log every write of the host and port
+    to ``appendfilename`` ("appendonly.aof" by default), fsynced according
+    to ``appendfsync`` ("always", "everysec" or "no"). When the log exists
+    it's replayed by the first connection instead of loading the snapshot.
+
+    Pass ``shared_file`` to keep the database in a memory mapped file
+    instead, shared with the connections of every process that passes the
+    same file. Each database needs a file of its own.
+
+    Pass ``latency_tracking=True``, or set the "latency-tracking" config
+    parameter, to time the commands of the host and port for
+    info('commandstats'), info('latencystats') and slowlog_get().
+
+    trace_start() records the commands of the host and port to a file
+    until trace_stop(), for replay_trace().
+
+    Pass ``read_views=True`` to have smembers(), hgetall() and lrange()
+    return read-only views of the stored values in O(1) instead of
+    copies. The next write to a viewed key copies its value first, so the
+    views don't change.
+
+    Pass ``compact_encodings=True``, or set one of the thresholds in
+    Encodings.PARAMS with config_set(), to keep small hashes and lists
+    packed into a string and small sets of integers in an array, as the
+    Redis listpack and intset encodings do. object_encoding() tells which
+    encoding a key uses.
     """
     def __init__(self, host='localhost', port=6379, db=0, *args, **kwargs):
         self._name = '%s:%s:%s' % (host, port, db)
@@ -119,137 +5004,222 @@ class Redis(BaseRedis):
         self._charset = kwargs.pop('charset', 'utf-8')
         self._errors = kwargs.pop('errors', 'strict')
         self._server_version = kwargs.pop('_server_version', (2, 4))
+        self._clock = kwargs.pop('clock', time.time)
+        lock_stripes = kwargs.pop('lock_stripes', None)
+        threadsafe = kwargs.pop('threadsafe', True)
+        active_expire = kwargs.pop('active_expire', False)
+        maxmemory = kwargs.pop('maxmemory', None)
+        maxmemory_policy = kwargs.pop('maxmemory_policy', None)
+        maxmemory_samples = kwargs.pop('maxmemory_samples', None)
+        self._dbfilename = kwargs.pop('dbfilename', None)
+        appendonly = kwargs.pop('appendonly', False)
+        appendfilename = kwargs.pop('appendfilename', 'appendonly.aof')
+        appendfsync = kwargs.pop('appendfsync', 'everysec')
+        shared_file = kwargs.pop('shared_file', None)
+        latency_tracking = kwargs.pop('latency_tracking', False)
+        self._read_views = kwargs.pop('read_views', False)
+        compact_encodings = kwargs.pop('compact_encodings', False)
+        if shared_file is not None and (
+                maxmemory is not None or maxmemory_policy or maxmemory_samples or
+                appendonly or lock_stripes or not threadsafe or compact_encodings):
+            raise RedisError("shared_file can't be combined with maxmemory, "
+                             "appendonly, lock_stripes, threadsafe=False or "
+                             "compact_encodings")
 
         global _caches, _locks
-        self._cache = _caches.setdefault(self._name, {})
-        self._lock = _locks.setdefault(self._name, RWLock())
+        server = '%s:%s' % (host, port)
+        if not _server_keyspaces(server):
+            if appendonly and os.path.exists(appendfilename):
+                _replay(host, port, appendfilename, self._clock)
+            elif self._dbfilename is not None and os.path.exists(self._dbfilename):
+                _load(server, self._dbfilename, int(self._clock() * 1000))
+        if shared_file is not None:
+            self._cache = _shared_keyspace(self._name, shared_file)
+        else:
+            self._cache = _caches.setdefault(self._name, Keyspace())
+        self._watched = _watches.setdefault(self._name, {})
+        if appendonly and server not in _aofs:
+            _aofs[server] = AppendOnlyFile(appendfilename, appendfsync)
+        if self._cache.aof is None and server in _aofs:
+            _attach_aof(server, _aofs[server])
+        if latency_tracking:
+            _server_stats(server).enabled = True
+        if server in _stats:
+            _attach_stats(server, _stats[server])
+        if self._cache.trace is None and server in _traces:
+            _attach_trace(server, _traces[server])
+        if shared_file is not None:
+            self._lock = self._cache.lock
+        elif threadsafe:
+            self._lock = _get_lock(self._name, lock_stripes)
+        else:
+            self._lock = NullLock()
         self.connection_pool = MockConnectionPool()
+        self.response_callbacks = self.__class__.RESPONSE_CALLBACKS.copy()
+        if active_expire:
+            self._start_sweeper(0.1 if active_expire is True else active_expire)
+        if maxmemory is not None or maxmemory_policy or maxmemory_samples:
+            with self._lock.writer():
+                _configure_memory(self, maxmemory, maxmemory_policy, maxmemory_samples)
+        if compact_encodings and self._cache.encodings is None:
+            with self._lock.writer():
+                _configure_encodings(self)
 
     #### BASIC KEY COMMANDS ####
     def exists(self, name):
-        def _exists(name):
-            with self._lock.reader():
-                return name in self._cache
-        return self._execute_command(_exists, name)
+        return self._execute_command('exists', name)
 
     def get(self, name):
-        def _get(name):
-            with self._lock.reader():
-                return self._assert_str(self._cache.get(name, None))
-        return self._execute_command(_get, name)
+        return self._execute_command('get', name)
 
     def getset(self, name, value):
-        return self._execute_command(self.__set, name, value, _get=True)
+        return self._execute_command('getset', name, value)
+
+    def mget(self, keys, *args):
+        return self._execute_command('mget', keys, *args)
+
+    def _mapping(self, command_name, args, kwargs):
+        if args:
+            if len(args) != 1 or not isinstance(args[0], dict):
+                raise RedisError('%s requires **kwargs or a single dict arg' % command_name)
+            kwargs.update(args[0])
+        return kwargs
+
+    def mset(self, *args, **kwargs):
+        return self._execute_command('mset', self._mapping('MSET', args, kwargs))
+
+    def msetnx(self, *args, **kwargs):
+        return self._execute_command('msetnx', self._mapping('MSETNX', args, kwargs))
 
     def incr(self, name, amount=1):
-        def _incr(name, amount):
-            with self._lock.writer():
-                value = self._assert_int(self._cache.get(name, None))
-                value += self._assert_int(amount)
-                value = self._to_str(value)
-                self._cache[name] = value
-                return value
-        return self._execute_command(_incr, name, amount)
+        return self._execute_command('incr', name, amount)
 
     def incrby(self, name, amount=1):
-        return self.incr(name, amount)
+        return self._execute_command('incrby', name, amount)
+
+    def decr(self, name, amount=1):
+        return self._execute_command('decr', name, amount)
+
+    def decrby(self, name, amount=1):
+        return self._execute_command('decrby', name, amount)
+
+    def incrbyfloat(self, name, amount=1.0):
+        return self._execute_command('incrbyfloat', name, amount)
 
-    def set(self, name, value):
-        return self._execute_command(self.__set, name, value)
+    def append(self, key, value):
+        return self._execute_command('append', key, value)
+
+    def strlen(self, name):
+        return self._execute_command('strlen', name)
+
+    def getrange(self, key, start, end):
+        return self._execute_command('getrange', key, start, end)
+
+    def setrange(self, name, offset, value):
+        return self._execute_command('setrange', name, offset, value)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        return self._execute_command('set', name, value, ex, px, nx, xx)
 
     def setnx(self, name, value):
-        return self._execute_command(self.__set, name, value, _nx=True)
+        return self._execute_command('setnx', name, value)
+
+    def setex(self, name, value, time):
+        return self._execute_command('setex', name, value, time)
+
+    def psetex(self, name, time_ms, value):
+        return self._execute_command('psetex', name, time_ms, value)
+
+    def delete(self, *names):
+        return self._execute_command('delete', *names)
 
-    def __set(self, name, value, _nx=False, _get=False):
+    def type(self, name):
+        return self._execute_command('type', name)
+
+    def object_encoding(self, name):
         """
-        Non-pipelineable set operation.
-        Used only internally.
+        Returns the encoding of the value at ``name``, like OBJECT ENCODING.
         """
-        with self._lock.writer():
-            name = self._to_str(name)
-            value = self._to_str(value) 
-            prev_value = self._cache.get(name, None)
-            if _nx and name in self._cache:
-                return prev_value if _get else False
-            self._cache[name] = value
-            return prev_value if _get else True
+        return self._execute_command('object_encoding', name)
 
-    def delete(self, *names):
-        def _delete(*names):
-            with self._lock.writer():
-                deleted = False
-                for name in names:
-                    name = self._to_str(name)
-                    if name in self._cache:
-                        del self._cache[name]
-                        deleted = True
-                return deleted
-        return self._execute_command(_delete, *names)
+    def dbsize(self):
+        return self._execute_command('dbsize')
+
+    def keys(self, pattern='*'):
+        return self._execute_command('keys', pattern)
+
+    def scan(self, cursor=0, match=None, count=None, _type=None):
+        """
+        Returns the next cursor and a batch of keys. Each call holds the
+        lock for one batch only, and keys that exist for the whole scan
+        are returned at least once, though possibly more than once.
+        """
+        return self._execute_command('scan', cursor, match, count, _type)
+
+    def scan_iter(self, match=None, count=None, _type=None):
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.scan(cursor or 0, match, count, _type)
+            for key in keys:
+                yield key
+
+    #### EXPIRY COMMANDS ####
+
+    def expire(self, name, time):
+        return self._execute_command('expire', name, time)
+
+    def pexpire(self, name, time):
+        return self._execute_command('pexpire', name, time)
+
+    def expireat(self, name, when):
+        return self._execute_command('expireat', name, when)
+
+    def pexpireat(self, name, when):
+        return self._execute_command('pexpireat', name, when)
+
+    def ttl(self, name):
+        return self._execute_command('ttl', name)
+
+    def pttl(self, name):
+        return self._execute_command('pttl', name)
+
+    def persist(self, name):
+        return self._execute_command('persist', name)
 
     #### LIST COMMANDS ####
 
     def llen(self, name):
-        def _llen(name):
-            with self._lock.reader():
-                name = self._to_str(name)
-                value = self._assert_list(self._cache.get(name, None))
-                if value is None:
-                    return 0
-                return len(value)
-        return self._execute_command(_llen, name)
+        return self._execute_command('llen', name)
 
-    def lpush(self, name, value):
-        def _lpush(name, value):
-            with self._lock.writer():
-                name = self._to_str(name)
-                value = self._to_str(value)
-                val = self._assert_list(self._cache.get(name, None))
-                val.insert(0, value)
-                self._cache[name] = val
-                return len(val)
-        return self._execute_command(_lpush, name, value)
-
-    def rpush(self, name, value):
-        def _rpush(name, value):
-            with self._lock.writer():
-                name = self._to_str(name)
-                value = self._to_str(value)
-                val = self._assert_list(self._cache.get(name, None))
-                val.append(value)
-                self._cache[name] = val
-                return len(val)
-        return self._execute_command(_rpush, name, value)
-
-    def _lrange(self, name, start, end):
-        val = self._assert_list(self._cache.get(name, None))
-        end += 1
-        if end == 0:
-            end = None
-        return val[start:end]
+    def lpush(self, name, *values):
+        return self._execute_command('lpush', name, *values)
 
-    def lrange(self, name, start, end):
-        def __lrange(name, start, end):
-            with self._lock.writer():
-                return self._lrange(self._to_str(name), start, end)
-        return self._execute_command(__lrange, name, start, end)
+    def rpush(self, name, *values):
+        return self._execute_command('rpush', name, *values)
 
-    def ltrim(self, name, start, end):
-        def _ltrim(name, start, end):
-            with self._lock.writer():
-                name = self._to_str(name)
+    def lpop(self, name):
+        return self._execute_command('lpop', name)
 
-                if name not in self._cache:
-                    # name が存在しない場合は何もしない
-                    return True
+    def rpop(self, name):
+        return self._execute_command('rpop', name)
 
-                val = self._lrange(name, start, end)
+    def rpoplpush(self, src, dst):
+        return self._execute_command('rpoplpush', src, dst)
 
-                if val:
-                    self._cache[name] = val
-                else:
-                    del self._cache[name]
-                return True
-        return self._execute_command(_ltrim, name, start, end)
+    def lindex(self, name, index):
+        return self._execute_command('lindex', name, index)
+
+    def lset(self, name, index, value):
+        return self._execute_command('lset', name, index, value)
+
+    def linsert(self, name, where, refvalue, value):
+        return self._execute_command('linsert', name, where, refvalue, value)
+
+    def lrange(self, name, start, end):
+        return self._execute_command('lrange', name, start, end)
+
+    def ltrim(self, name, start, end):
+        return self._execute_command('ltrim', name, start, end)
 
     def lrem(self, name, value, num=0):
         """
@@ -267,214 +5237,374 @@ class Redis(BaseRedis):
         Note that non-existing keys are treated like empty lists, so when key
         does not exist, the command will always return 0.
         """
-        def _lrem(name, value, num):
-            with self._lock.writer():
-                name = self._to_str(name)
-                value = self._to_str(value)
-
-                if name not in self._cache:
-                    # Non-existing keys are treated like empty lists,
-                    # so when key does not exist, the command will always return 0.
-                    return 0
-
-                val = self._assert_list(self._cache.get(name, None))
-
-                _num = num if num != 0 else None
-                if num is not None and num < 0:
-                    val = reversed(val)
-                    _num *= -1
-
-                new_val = [] 
-                rem_count = 0
-                for x in val:
-                    if x == value and (_num is None or _num > 0):
-                        if _num is not None:
-                            _num -= 1
-                        rem_count += 1
-                    else:
-                        new_val.append(x)
-                
-                if num < 0:
-                    new_val.reverse()
-
-                if new_val:
-                    self._cache[name] = new_val
-                else:
-                    del self._cache[name]
-                return rem_count
-
-        return self._execute_command(_lrem, name, value, num)
+        return self._execute_command('lrem', name, value, num)
 
     #### HASH COMMANDS ####
-    
+
     def hdel(self, name, *keys):
-        def _hdel(name, *keys):
-            with self._lock.writer():
-                # Emulate Redis < 2.4 for now
-                # TODO: Behavior based on _server_verison
-                if len(keys) != 1:
-                    # When no keys are passed emulate an error
-                    # returned from the server.
-                    raise ResponseError("wrong number of arguments for 'hdel' command")
-                val = self._assert_dict(self._cache.get(self._to_str(name), None))
-
-                deleted_count = 0
-                for k in keys:
-                    k = self._to_str(k)
-                    if k in val:
-                        deleted_count+=1
-                        del val[k]
-
-                # Emulate Redis < 2.4 for now
-                return deleted_count > 0
-
-        return self._execute_command(_hdel, name, *keys)
+        return self._execute_command('hdel', name, *keys)
 
     def hexists(self, name, key):
-        def _hexists(name, keys):
-            with self._lock.writer():
-                val = self._assert_dict(self._cache.get(self._to_str(name), None))
-                return key in val
-        return self._execute_command(_hexists, name, key)
+        return self._execute_command('hexists', name, key)
 
     def hget(self, name, key):
-        def _hget(name, key):
-            with self._lock.writer():
-                name = self._to_str(name)
-                key = self._to_str(key)
-
-                return self._assert_dict(self._cache.get(name, None)).get(key)
-        return self._execute_command(_hget, name, key)
+        return self._execute_command('hget', name, key)
 
     def hgetall(self, name):
-        def _hgetall(name):
-            with self._lock.writer():
-                # Redis only stores strings in hashes
-                # which are immutable in Python so a shallow copy is adequate.
-                return self._assert_dict(self._cache.get(self._to_str(name), None)).copy()
-        return self._execute_command(_hgetall, name)
+        return self._execute_command('hgetall', name)
 
     def hset(self, name, key, value):
-        def _hset(name, key, value):
-            with self._lock.writer():
+        return self._execute_command('hset', name, key, value)
+
+    def hincrby(self, name, key, amount=1):
+        return self._execute_command('hincrby', name, key, amount)
 
-                name = self._to_str(name)
-                key = self._to_str(key)
-                value = self._to_str(value)
+    def hincrbyfloat(self, name, key, amount=1.0):
+        return self._execute_command('hincrbyfloat', name, key, amount)
 
-                val = self._assert_dict(self._cache.get(name, None))
-                rtn_val = 0 if key in val else 1
-                val[key] = value
-                self._cache[name] = val
-                return rtn_val
+    def hmset(self, name, mapping):
+        if not mapping:
+            raise DataError("'hmset' with 'mapping' of length 0")
+        return self._execute_command('hmset', name, mapping)
 
-        return self._execute_command(_hset, name, key, value)
+    def hmget(self, name, keys, *args):
+        return self._execute_command('hmget', name, keys, *args)
 
     def hlen(self, name):
-        def _hlen(name):
-            with self._lock.writer():
-                return len(self._assert_dict(self._cache.get(self._to_str(name), None)))
-        return self._execute_command(_hlen, name)
+        return self._execute_command('hlen', name)
 
-    #### SET COMMANDS ####
+    def hscan(self, name, cursor=0, match=None, count=None):
+        return self._execute_command('hscan', name, cursor, match, count)
 
-    def sadd(self, name, value):
-        def _sadd(name, value):
-            with self._lock.writer():
-                name = self._to_str(name)
-                value = self._to_str(value)
-
-                val = self._assert_set(self._cache.get(name, None))
-                if value in val:
-                    return False
-                val.add(value)
-                self._cache[name] = val
-                return True
+    #### SET COMMANDS ####
 
-        return self._execute_command(_sadd, name, value)
+    def sadd(self, name, *values):
+        return self._execute_command('sadd', name, *values)
 
     def scard(self, name):
-        def _scard(name):
-            with self._lock.reader():
-                val = self._assert_set(self._cache.get(name, None))
-                return len(val)
-        return self._execute_command(_scard, name)
-
-    def srem(self, name, value):
-        def _srem(name, value):
-            with self._lock.writer():
-                name = self._to_str(name)
-                value = self._to_str(value)
-                val = self._assert_set(self._cache.get(name, None))
-                if value in val:
-                    val.remove(value)
-                    return True
-                else:
-                    return False
-        return self._execute_command(_srem, name, value)
+        return self._execute_command('scard', name)
+
+    def srem(self, name, *values):
+        return self._execute_command('srem', name, *values)
 
     def sinter(self, keys, *args):
-        def _sinter(keys, *args):
-            with self._lock.writer():
-                keys = list_or_args(keys, args)
-                sets = [self._assert_set(self._cache.get(key, None)) for key in keys]
-
-                if sets:
-                    i = sets[0]
-                    for s in sets[1:]:
-                        i = i.intersection(s)
-                    return i
-                else:
-                    return set()
-        return self._execute_command(_sinter, keys, *args)
+        return self._execute_command('sinter', keys, *args)
+
+    def sinterstore(self, dest, keys, *args):
+        return self._execute_command('sinterstore', dest, keys, *args)
+
+    def sintercard(self, numkeys, keys, limit=0):
+        keys = list_or_args(keys, [])
+        if numkeys != len(keys):
+            raise DataError("numkeys must be the number of keys")
+        return self._execute_command('sintercard', keys, limit)
+
+    def sunion(self, keys, *args):
+        return self._execute_command('sunion', keys, *args)
+
+    def sunionstore(self, dest, keys, *args):
+        return self._execute_command('sunionstore', dest, keys, *args)
+
+    def sdiff(self, keys, *args):
+        return self._execute_command('sdiff', keys, *args)
+
+    def sdiffstore(self, dest, keys, *args):
+        return self._execute_command('sdiffstore', dest, keys, *args)
+
+    def smove(self, src, dst, value):
+        return self._execute_command('smove', src, dst, value)
+
+    def spop(self, name, count=None):
+        return self._execute_command('spop', name, count)
+
+    def srandmember(self, name, number=None):
+        return self._execute_command('srandmember', name, number)
 
     def sismember(self, name, value):
-        def _sismember(name, value):
-            with self._lock.reader():
-                name = self._to_str(name)
-                value = self._to_str(value)
-                val = self._assert_set(self._cache.get(name, None))
-                return value in val
-        return self._execute_command(_sismember, name, value)
+        return self._execute_command('sismember', name, value)
 
     def smembers(self, name):
-        def _smembers(name):
-            with self._lock.reader():
-                name = self._to_str(name)
-                return self._assert_set(self._cache.get(name, None))
-        return self._execute_command(_smembers, name)
+        return self._execute_command('smembers', name)
+
+    def sscan(self, name, cursor=0, match=None, count=None):
+        return self._execute_command('sscan', name, cursor, match, count)
+
+    #### SORTED SET COMMANDS ####
+
+    def zadd(self, name, *args, **kwargs):
+        """
+        Like redis.Redis, takes member1, score1, member2, score2, ... or
+        member1=score1, member2=score2, ...
+        """
+        if len(args) % 2 != 0:
+            raise RedisError("ZADD requires an equal number of "
+                             "values and scores")
+        pairs = zip(args[::2], args[1::2])
+        pairs.extend(kwargs.iteritems())
+        return self._execute_command('zadd', name, pairs)
+
+    def zincrby(self, name, value, amount=1):
+        return self._execute_command('zincrby', name, value, amount)
+
+    def zrem(self, name, *values):
+        return self._execute_command('zrem', name, *values)
+
+    def zremrangebyscore(self, name, min, max):
+        return self._execute_command('zremrangebyscore', name, min, max)
+
+    def zcard(self, name):
+        return self._execute_command('zcard', name)
+
+    def zcount(self, name, min, max):
+        return self._execute_command('zcount', name, min, max)
+
+    def zscore(self, name, value):
+        return self._execute_command('zscore', name, value)
+
+    def zrank(self, name, value):
+        return self._execute_command('zrank', name, value)
+
+    def zrevrank(self, name, value):
+        return self._execute_command('zrevrank', name, value)
+
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        return self._execute_command('zrange', name, start, end, desc,
+                                     withscores, score_cast_func)
+
+    def zrevrange(self, name, start, end, withscores=False,
+                  score_cast_func=float):
+        return self._execute_command('zrange', name, start, end, True,
+                                     withscores, score_cast_func)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        return self._execute_command('zrangebyscore', name, min, max, start,
+                                     num, withscores, score_cast_func)
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None,
+                         withscores=False, score_cast_func=float):
+        return self._execute_command('zrangebyscore', name, min, max, start,
+                                     num, withscores, score_cast_func, True)
+
+    def zscan(self, name, cursor=0, match=None, count=None, score_cast_func=float):
+        return self._execute_command('zscan', name, cursor, match, count,
+                                     score_cast_func)
 
     #### SERVER COMMANDS ####
 
     def flushdb(self):
-        def _flushdb():
-            with self._lock.writer():
-                self._cache.clear()
-        return self._execute_command(_flushdb)
+        return self._execute_command('flushdb')
 
     def flushall(self):
-        def _flushall():
-            with self._lock.writer():
-                global _caches
+        return self._execute_command('flushall')
+
+    def save(self):
+        _save('%s:%s' % (self._host, self._port), self._dbfilename or 'dump.rdb')
+        return True
+
+    def bgsave(self):
+        _bgsave('%s:%s' % (self._host, self._port), self._dbfilename or 'dump.rdb')
+        return True
+
+    def bgrewriteaof(self):
+        _bgrewriteaof('%s:%s' % (self._host, self._port))
+        return True
 
-                for name in _caches.keys():
-                    if name.startswith('%s:%s' % (self._host, self._port)):
-                        _caches[name].clear()
+    def lastsave(self):
+        timestamp = _lastsave.get('%s:%s' % (self._host, self._port))
+        if timestamp is None:
+            return None
+        return datetime.datetime.fromtimestamp(int(timestamp))
+
+    def config_get(self, pattern="*"):
+        return self._execute_command('config_get', pattern)
+
+    def config_set(self, name, value):
+        return self._execute_command('config_set', name, value)
+
+    def info(self, section=None):
+        return self._execute_command('info', section)
+
+    def config_resetstat(self):
+        _server_stats('%s:%s' % (self._host, self._port)).reset()
+        return True
+
+    def _slowlog(self, num=None):
+        slowlog = list(_server_stats('%s:%s' % (self._host, self._port)).slowlog)
+        return slowlog if num is None or num < 0 else slowlog[:num]
+
+    def slowlog_get(self, num=None):
+        return [{
+            'id': entry_id,
+            'start_time': start_time,
+            'duration': duration,
+            'command': ' '.join(argv),
+        } for entry_id, start_time, duration, argv in self._slowlog(num)]
+
+    def slowlog_len(self):
+        return len(_server_stats('%s:%s' % (self._host, self._port)).slowlog)
 
-        return self._execute_command(_flushall)
+    def slowlog_reset(self):
+        _server_stats('%s:%s' % (self._host, self._port)).reset_slowlog()
+        return True
+
+    def trace_start(self, path):
+        """
+        Records the commands run on the databases of the host and port to
+        ``path`` until trace_stop(), replacing a trace already running.
+        """
+        server = '%s:%s' % (self._host, self._port)
+        trace = CommandTrace(path)
+        old = _traces.get(server)
+        _traces[server] = trace
+        _attach_trace(server, trace)
+        if old is not None:
+            old.close()
+        return True
+
+    def trace_stop(self):
+        """
+        Stops tracing the host and port and returns the number of commands
+        recorded.
+        """
+        server = '%s:%s' % (self._host, self._port)
+        trace = _traces.pop(server, None)
+        if trace is None:
+            return 0
+        _attach_trace(server, None)
+        trace.close()
+        return trace.count
 
     def pipeline(self, transaction=True, shard_hint=None):
-        # TODO: Support response_callbacks
-        pipe = Pipeline(self._name, self.connection_pool, None, transaction, shard_hint)
+        pipe = Pipeline(self._name, self.connection_pool, self.response_callbacks,
+                        transaction, shard_hint)
+        pipe._host = self._host
+        pipe._port = self._port
         pipe._charset = self._charset
         pipe._errors = self._errors
+        pipe._lock = self._lock
+        pipe._clock = self._clock
+        pipe._read_views = self._read_views
         return pipe
 
     def execute_command(self, *args, **options):
-        raise NotImplemented("Executing commands is not supported by this Mock")
+        """
+        Runs a command given as it would be sent to the server and parses
+        the reply with the response_callbacks, like redis.Redis does.
+        """
+        name = args[0]
+        reply = self._execute_wire(_command_argv(self, args))
+        callback = self.response_callbacks.get(name.upper())
+        if callback is not None:
+            return callback(reply, **options)
+        return reply
+
+    def _execute_wire(self, argv):
+        """
+        Runs the wire command ``argv`` and returns the reply the server
+        would send.
+        """
+        wire, command_name, args = _resolve(argv)
+        cmd = _commands.get(command_name)
+        if cmd is None:
+            return wire.reply(_server_commands[command_name](self, *args))
+        return wire.reply(self._run_command(cmd, args))
+
+    def _execute_command(self, name, *args):
+        return self._run_command(_commands[name], args)
+
+    def _run_command(self, cmd, args):
+        keys = cmd.keys(self, args)
+        cache = self._cache
+        if cache.trace is not None:
+            cache.trace.log(cache.db, cmd.name, args)
+        limit = cache.limit
+        if cmd.write and limit is not None and limit.over_limit():
+            self._free_memory([cmd])
+        now = int(self._clock() * 1000)
+        # Only writers delete expired keys, so a read of one takes the
+        # writer lock.
+        write = cmd.write or bool(cache.expires) and self._has_expired(keys, now)
+        while True:
+            lock = self._lock.writer(*keys) if write else self._lock.reader(*keys)
+            if cache.stats is not None:
+                lock = cache.stats.timed(lock, self, cmd.name, args)
+            with lock:
+                if cache.expires:
+                    if write:
+                        self._expire_keys(keys, now)
+                    elif self._has_expired(keys, now):
+                        write = True
+                        continue
+                if limit is not None:
+                    limit.touch(keys)
+                if cmd.write:
+                    if cache.encodings is not None:
+                        _expand(cache, keys)
+                    if cache.views:
+                        _unshare(cache, keys)
+                result = cmd.func(self, *args)
+                if not cmd.write:
+                    return result
+                if cache.encodings is not None and keys:
+                    _compact(cache, keys)
+                if self._watched and cmd.watch:
+                    _touch(self._watched, keys)
+                if limit is not None and keys:
+                    limit.update(keys)
+                if cache.scans is not None and keys:
+                    cache.scans.update(keys)
+                aof = cache.aof
+                if aof is not None:
+                    seq = aof.log(cache.db, self, cmd, args, result)
+            break
+        if aof is not None and aof.fsync == 'always':
+            aof.wait(seq)
+        return result
+
+    def _free_memory(self, cmds):
+        """
+        Evicts keys when the database is over maxmemory, before ``cmds``
+        run. Takes the whole writer lock since any key may be evicted.
+        """
+        with self._lock.writer():
+            limit = self._cache.limit
+            if limit is None or limit.evict(self._watched):
+                return
+        for cmd in cmds:
+            if cmd.denyoom:
+                raise ResponseError("OOM command not allowed when used memory > 'maxmemory'.")
+
+    def _has_expired(self, keys, now):
+        """
+        Returns whether any of ``keys`` has a deadline at or before ``now``.
+        """
+        expires = self._cache.expires
+        for key in keys:
+            deadline = expires.get(key)
+            if deadline is not None and deadline <= now:
+                return True
+        return False
+
+    def _expire_keys(self, keys, now):
+        """
+        Deletes those of ``keys`` whose deadline is at or before ``now``.
+        Called with the writer lock held, before a command touches the keys.
+        """
+        expires = self._cache.expires
+        for key in keys:
+            deadline = expires.get(key)
+            if deadline is not None and deadline <= now:
+                self._cache.pop(key, None)
+                if self._watched:
+                    _touch(self._watched, [key])
 
-    def _execute_command(self, cmd, *args, **kwargs):
-        return cmd(*args, **kwargs)
+    def _start_sweeper(self, interval):
+        with self._lock.writer():
+            if self._cache.sweeper is None:
+                self._cache.sweeper = ExpirySweeper(self, interval)
+                self._cache.sweeper.start()
 
     def _assert_int(self, val):
         if val is None:
@@ -489,8 +5619,12 @@ class Redis(BaseRedis):
 
     def _assert_list(self, val):
         if val is None:
-            return [] 
+            return deque()
+        if isinstance(val, deque):
+            return val
         if isinstance(val, (list, tuple)):
+            return deque(val)
+        if isinstance(val, PackedList):
             return val
         else:
             raise ResponseError("Operation against a key holding the wrong kind of value")
@@ -498,7 +5632,7 @@ class Redis(BaseRedis):
     def _assert_set(self, val):
         if val is None:
             return set()
-        if isinstance(val, set):
+        if isinstance(val, (set, IntSet)):
             return val
         else:
             raise ResponseError("Operation against a key holding the wrong kind of value")
@@ -506,7 +5640,15 @@ class Redis(BaseRedis):
     def _assert_dict(self, val):
         if val is None:
             return {}
-        if isinstance(val, dict):
+        if isinstance(val, (dict, PackedHash)):
+            return val
+        else:
+            raise ResponseError("Operation against a key holding the wrong kind of value")
+
+    def _assert_zset(self, val):
+        if val is None:
+            return SortedSet()
+        if isinstance(val, SortedSet):
             return val
         else:
             raise ResponseError("Operation against a key holding the wrong kind of value")
@@ -516,6 +5658,8 @@ class Redis(BaseRedis):
             return None
         if isinstance(val, str):
             return val
+        elif isinstance(val, int):
+            return str(val)
         elif isinstance(val, unicode):
             return val.decode(self._charset, self._errors)
         else:
@@ -534,16 +5678,32 @@ class Redis(BaseRedis):
         return str(value)
 
 class Pipeline(Redis):
+    """
+    Queues commands and runs them all with a single lock acquisition when
+    execute() is called, so no other connection sees the batch half done.
+
+    WATCHed keys are checked against the version counters in _watches
+    before the batch runs and WatchError is raised if any of them changed.
+    Like redis.py, commands issued after watch() and before multi() run
+    immediately.
+    """
     def __init__(self, name, connection_pool, response_callbacks, transaction, shard_hint):
         self._name = name
         global _caches, _locks
-        self._cache = _caches.setdefault(self._name, {})
-        self._lock = _locks.setdefault(self._name, RWLock())
+        self._cache = _caches.setdefault(self._name, Keyspace())
+        self._watched = _watches.setdefault(self._name, {})
+        self._lock = _get_lock(self._name)
+        self._clock = time.time
 
         self.connection_pool = connection_pool
         self.watching = False
         self.explicit_transaction = False
         self.command_stack = []
+        self.watched_versions = {}
+        self.response_callbacks = response_callbacks or {}
+        # Replies of the commands queued by execute_command(), by their
+        # position in the command_stack.
+        self.wire_replies = {}
 
         # This is a mock so these are not used
         self.transaction = transaction
@@ -555,10 +5715,32 @@ class Pipeline(Redis):
     def __exit__(self, exc_type, exc_value, traceback):
         self.reset()
 
-    def watch(self, name):
+    def watch(self, *names):
         if self.explicit_transaction:
             raise RedisError('Cannot issue a WATCH after a MULTI')
+        names = [self._to_str(name) for name in names]
+        with self._lock.writer(*names):
+            for name in names:
+                if name in self.watched_versions:
+                    continue
+                entry = self._watched.setdefault(name, [0, 0])
+                entry[0] += 1
+                self.watched_versions[name] = entry[1]
         self.watching = True
+        return True
+
+    def unwatch(self):
+        if self.watched_versions:
+            names = list(self.watched_versions)
+            with self._lock.writer(*names):
+                for name in names:
+                    entry = self._watched[name]
+                    entry[0] -= 1
+                    if entry[0] == 0:
+                        del self._watched[name]
+            self.watched_versions = {}
+        self.watching = False
+        return True
 
     def multi(self):
         if self.explicit_transaction:
@@ -566,23 +5748,535 @@ class Pipeline(Redis):
         if self.command_stack:
             raise RedisError('Commands without an initial WATCH have already '
                              'been issued')
-        self.explicit_transaction = False
+        self.explicit_transaction = True
 
     def execute(self):
-        ret_vals = []
-        for cmd, args, kwargs in self.command_stack:
-            try:
-                ret_vals.append(cmd(*args, **kwargs))
-            except RedisError, error:
-                ret_vals.append(error)
-        self.reset()    
+        try:
+            results = self._execute_batch()
+        finally:
+            wire_replies = self.wire_replies
+            self.reset()
+        for i, (wire, name, options) in wire_replies.iteritems():
+            results[i] = self._parse_reply(wire, name, options, results[i])
+        return results
+
+    def execute_command(self, *args, **options):
+        """
+        Queues a command given as it would be sent to the server. Its
+        reply is parsed with the response_callbacks by execute().
+        """
+        name = args[0]
+        wire, command_name, cmd_args = _resolve(_command_argv(self, args))
+        if command_name not in _commands:
+            raise ResponseError("'%s' can't be run in a pipeline" % name)
+        if self.watching and not self.explicit_transaction:
+            result = self._run_command(_commands[command_name], cmd_args)
+            return self._parse_reply(wire, name, options, result)
+        self.wire_replies[len(self.command_stack)] = (wire, name, options)
+        self.command_stack.append((command_name, cmd_args))
+        return self
+
+    def _parse_reply(self, wire, name, options, result):
+        if isinstance(result, Exception):
+            return result
+        reply = wire.reply(result)
+        callback = self.response_callbacks.get(name.upper())
+        if callback is not None:
+            return callback(reply, **options)
+        return reply
+
+    def _execute_batch(self):
+        stack = [(_commands[name], args) for name, args in self.command_stack]
+        if not stack and not self.watched_versions:
+            return []
+        if self._cache.trace is not None:
+            self._cache.trace.log(self._cache.db, 'exec', tuple(self.command_stack))
+
+        keys = set(self.watched_versions)
+        write = False
+        lock_all = False
+        for cmd, args in stack:
+            cmd_keys = cmd.keys(self, args)
+            if not cmd_keys:
+                lock_all = True
+            keys.update(cmd_keys)
+            write = write or cmd.write
+        limit = self._cache.limit
+        if write and limit is not None and limit.over_limit():
+            self._free_memory([cmd for cmd, args in stack])
+        now = int(self._clock() * 1000)
+        write = write or bool(self._cache.expires) and self._has_expired(keys, now)
+        lock_keys = () if lock_all else keys
+        stats = self._cache.stats
+        while True:
+            lock = self._lock.writer(*lock_keys) if write else self._lock.reader(*lock_keys)
+            if stats is not None:
+                lock = stats.timed(lock, self, 'exec', ())
+            with lock:
+                if self._cache.expires:
+                    if write:
+                        self._expire_keys(keys, now)
+                    elif self._has_expired(keys, now):
+                        write = True
+                        continue
+                if limit is not None:
+                    limit.touch(keys)
+                watched = self._watched
+                for name, version in self.watched_versions.iteritems():
+                    if watched[name][1] != version:
+                        raise WatchError("Watched variable changed.")
+
+                aof = self._cache.aof
+                scans = self._cache.scans
+                views = self._cache.views
+                encodings = self._cache.encodings
+                seq = None
+                ret_vals = []
+                for cmd, args in stack:
+                    if cmd.write and encodings is not None:
+                        _expand(self._cache, cmd.keys(self, args))
+                    if cmd.write and views:
+                        _unshare(self._cache, cmd.keys(self, args))
+                    if stats is not None:
+                        started = time.time()
+                    try:
+                        ret_vals.append(cmd.func(self, *args))
+                    except RedisError, error:
+                        ret_vals.append(error)
+                        if stats is not None:
+                            stats.record(self, cmd.name, args, started, started,
+                                         time.time(), True)
+                    else:
+                        if stats is not None:
+                            stats.record(self, cmd.name, args, started, started,
+                                         time.time(), False)
+                        if cmd.write and (watched or limit is not None or scans is not None or
+                                          encodings is not None):
+                            cmd_keys = cmd.keys(self, args)
+                            if encodings is not None and cmd_keys:
+                                _compact(self._cache, cmd_keys)
+                            if watched and cmd.watch:
+                                _touch(watched, cmd_keys)
+                            if limit is not None and cmd_keys:
+                                limit.update(cmd_keys)
+                            if scans is not None and cmd_keys:
+                                scans.update(cmd_keys)
+                        if cmd.write and aof is not None:
+                            seq = aof.log(self._cache.db, self, cmd, args, ret_vals[-1])
+            break
+        if seq is not None and aof.fsync == 'always':
+            aof.wait(seq)
         return ret_vals
 
     def reset(self):
+        self.unwatch()
         self.watching = False
         self.explicit_transaction = False
         self.command_stack = []
+        self.wire_replies = {}
 
-    def _execute_command(self, cmd, *args, **kwargs):
-        self.command_stack.append((cmd, args, kwargs))
+    def _execute_command(self, name, *args):
+        if self.watching and not self.explicit_transaction:
+            return self._run_command(_commands[name], args)
+        self.command_stack.append((name, args))
         return self
+
+#### RESP SERVER ####
+
+class ProtocolError(RedisError):
+    pass
+
+class _NilArray(object):
+    """
+    The reply of an EXEC aborted by WATCH.
+    """
+
+_NIL_ARRAY = _NilArray()
+
+class RespReader(object):
+    """
+    Splits the RESP2 requests received on a connection into argument
+    lists. Inline commands (space separated, as typed in telnet) are
+    accepted too.
+
+    Received data is only joined once a request is known to be complete,
+    so a large value arriving in many chunks isn't copied for each chunk.
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+        self.chunks = []
+        self.size = 0
+        self.needed = 0
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def get(self):
+        """
+        Returns the next request or None if it hasn't been fully received.
+        """
+        if self.size < self.needed:
+            return None
+        if self.chunks:
+            self.buffer = self.buffer[self.pos:] + ''.join(self.chunks)
+            self.pos = 0
+            self.chunks = []
+        buf = self.buffer
+        pos = self.pos
+        if pos >= len(buf):
+            return None
+        end = buf.find('\r\n', pos)
+        if end < 0:
+            return self._incomplete(len(buf) + 1)
+        if buf[pos] != '*':
+            self._consumed(end + 2)
+            return buf[pos:end].split()
+        count = self._length(buf[pos + 1:end])
+        pos = end + 2
+        argv = []
+        for i in xrange(count):
+            end = buf.find('\r\n', pos)
+            if end < 0:
+                return self._incomplete(len(buf) + 1)
+            if buf[pos] != '$':
+                raise ProtocolError("Protocol error: expected '$', got '%s'" % buf[pos])
+            start = end + 2
+            stop = start + self._length(buf[pos + 1:end])
+            if stop + 2 > len(buf):
+                return self._incomplete(stop + 2)
+            argv.append(buf[start:stop])
+            pos = stop + 2
+        self._consumed(pos)
+        return argv
+
+    def _length(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            raise ProtocolError("Protocol error: invalid length")
+
+    def _incomplete(self, needed):
+        self.needed = needed - self.pos
+        self.size = len(self.buffer) - self.pos
+        return None
+
+    def _consumed(self, pos):
+        self.pos = pos
+        self.needed = 0
+        self.size = len(self.buffer) - pos
+
+def _error_reply(error):
+    message = str(error).replace('\r', ' ').replace('\n', ' ')
+    code = message.split(' ', 1)[0]
+    if not (code.isupper() and len(code) > 1):
+        message = 'ERR ' + message
+    return '-%s\r\n' % message
+
+def encode_reply(reply, out):
+    """
+    Appends the RESP2 encoding of ``reply`` to the list ``out``.
+    """
+    if reply is None:
+        out.append('$-1\r\n')
+    elif isinstance(reply, Status):
+        out.append('+%s\r\n' % reply)
+    elif isinstance(reply, str):
+        out.append('$%d\r\n%s\r\n' % (len(reply), reply))
+    elif isinstance(reply, (bool, int, long)):
+        out.append(':%d\r\n' % reply)
+    elif isinstance(reply, unicode):
+        encode_reply(reply.encode('utf-8'), out)
+    elif isinstance(reply, float):
+        encode_reply(_format_score(reply), out)
+    elif isinstance(reply, Exception):
+        out.append(_error_reply(reply))
+    elif reply is _NIL_ARRAY:
+        out.append('*-1\r\n')
+    else:
+        out.append('*%d\r\n' % len(reply))
+        for item in reply:
+            encode_reply(item, out)
+
+class Session(object):
+    """
+    The state of one client connection: the selected database and the
+    transaction being queued. Commands that only make sense per
+    connection are handled here, the others are routed to the database.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.client = server.client(0)
+        self.pipe = None
+        self.queued = None
+        self.aborted = False
+        self.closing = False
+
+    def execute(self, argv):
+        """
+        Runs the request ``argv`` and returns the reply, or the error to
+        reply with.
+        """
+        name = argv[0].upper()
+        handler = self._handlers.get(name)
+        try:
+            if handler is not None:
+                if self.queued is not None and name not in ('EXEC', 'DISCARD', 'MULTI', 'WATCH'):
+                    return self._queue(argv)
+                return handler(self, argv[1:])
+            if self.queued is not None:
+                return self._queue(argv)
+            return self.client._execute_wire(argv)
+        except RedisError, error:
+            return error
+
+    def _queue(self, argv):
+        try:
+            wire, command_name, args = _resolve(argv)
+            if command_name not in _commands:
+                raise ResponseError("'%s' can't be queued in a transaction" % argv[0])
+        except RedisError:
+            self.aborted = True
+            raise
+        self.pipe._execute_command(command_name, *args)
+        self.queued.append(wire)
+        return _QUEUED
+
+    def _select(self, args):
+        if len(args) != 1:
+            raise ResponseError("wrong number of arguments for 'select' command")
+        self.client = self.server.client(_int_arg(args[0]))
+        self._reset()
+        return _OK
+
+    def _quit(self, args):
+        self.closing = True
+        return _OK
+
+    def _multi(self, args):
+        if self.queued is not None:
+            raise ResponseError("MULTI calls can not be nested")
+        if self.pipe is None:
+            self.pipe = self.client.pipeline()
+        self.pipe.multi()
+        self.queued = []
+        return _OK
+
+    def _exec(self, args):
+        if self.queued is None:
+            raise ResponseError("EXEC without MULTI")
+        routes = self.queued
+        aborted = self.aborted
+        pipe = self.pipe
+        self._reset()
+        if aborted:
+            pipe.reset()
+            raise ResponseError("EXECABORT Transaction discarded because of previous errors.")
+        try:
+            results = pipe.execute()
+        except WatchError:
+            return _NIL_ARRAY
+        return [result if isinstance(result, Exception) else wire.reply(result)
+                for wire, result in zip(routes, results)]
+
+    def _discard(self, args):
+        if self.queued is None:
+            raise ResponseError("DISCARD without MULTI")
+        self.pipe.reset()
+        self._reset()
+        return _OK
+
+    def _watch(self, args):
+        if self.queued is not None:
+            raise ResponseError("WATCH inside MULTI is not allowed")
+        if not args:
+            raise ResponseError("wrong number of arguments for 'watch' command")
+        if self.pipe is None:
+            self.pipe = self.client.pipeline()
+        self.pipe.watch(*args)
+        return _OK
+
+    def _unwatch(self, args):
+        if self.pipe is not None:
+            self.pipe.reset()
+        self._reset()
+        return _OK
+
+    def _reset(self):
+        if self.pipe is not None and self.queued is None:
+            self.pipe.reset()
+        self.pipe = None
+        self.queued = None
+        self.aborted = False
+
+    def _ignored(self, args):
+        # CLIENT SETNAME and the like, which clients send on connect.
+        return _OK
+
+    def _command(self, args):
+        return []
+
+    _handlers = {
+        'SELECT': _select,
+        'QUIT': _quit,
+        'MULTI': _multi,
+        'EXEC': _exec,
+        'DISCARD': _discard,
+        'WATCH': _watch,
+        'UNWATCH': _unwatch,
+        'CLIENT': _ignored,
+        'COMMAND': _command,
+    }
+
+class RespHandler(SocketServer.BaseRequestHandler):
+    """
+    Serves one connection. Every request received in one read is run
+    before the replies are sent back together, so pipelined requests
+    cost one send.
+    """
+    def handle(self):
+        sock = self.request
+        if sock.family != getattr(socket, 'AF_UNIX', None):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session = Session(self.server)
+        reader = RespReader()
+        try:
+            while not session.closing:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                reader.feed(data)
+                out = []
+                try:
+                    while not session.closing:
+                        argv = reader.get()
+                        if argv is None:
+                            break
+                        if argv:
+                            encode_reply(session.execute(argv), out)
+                except ProtocolError, error:
+                    out.append(_error_reply(error))
+                    session.closing = True
+                if out:
+                    sock.sendall(''.join(out))
+        except socket.error:
+            pass
+        finally:
+            session._unwatch(())
+
+class _ServerMixin(object):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def setup_databases(self, host, port, options):
+        self.db_host = host
+        self.db_port = port
+        self.options = options
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    def client(self, db):
+        client = self.clients.get(db)
+        if client is None:
+            with self.clients_lock:
+                client = self.clients.get(db)
+                if client is None:
+                    client = Redis(self.db_host, self.db_port, db, **self.options)
+                    self.clients[db] = client
+        return client
+
+class RespServer(_ServerMixin, SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    A RESP2 server over TCP, with a thread per connection, serving the
+    databases of the given host and port of the mock.
+    """
+    def __init__(self, address, **options):
+        SocketServer.TCPServer.__init__(self, address, RespHandler)
+        host, port = self.server_address[:2]
+        self.setup_databases(host, port, options)
+
+if hasattr(SocketServer, 'UnixStreamServer'):
+    class UnixRespServer(_ServerMixin, SocketServer.ThreadingMixIn,
+                         SocketServer.UnixStreamServer):
+        """
+        A RESP2 server over a unix socket.
+        """
+        def __init__(self, path, **options):
+            if os.path.exists(path):
+                os.unlink(path)
+            SocketServer.UnixStreamServer.__init__(self, path, RespHandler)
+            self.setup_databases(path, 0, options)
+
+def serve(argv):
+    parser = optparse.OptionParser(usage="python -m redis_mock serve [options]")
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=6379)
+    parser.add_option('--unixsocket', help="listen on a unix socket instead of TCP")
+    parser.add_option('--dbfilename')
+    parser.add_option('--appendonly', action='store_true', default=False)
+    parser.add_option('--appendfilename', default='appendonly.aof')
+    parser.add_option('--appendfsync', default='everysec',
+                      choices=AppendOnlyFile.FSYNC_POLICIES)
+    parser.add_option('--maxmemory', type='int')
+    parser.add_option('--maxmemory-policy', dest='maxmemory_policy')
+    parser.add_option('--lock-stripes', dest='lock_stripes', type='int')
+    parser.add_option('--trace', help="record the commands to a trace file")
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error("unexpected arguments: %s" % ' '.join(args))
+
+    redis_options = {}
+    for name in ('dbfilename', 'maxmemory', 'maxmemory_policy', 'lock_stripes'):
+        if getattr(options, name) is not None:
+            redis_options[name] = getattr(options, name)
+    if options.appendonly:
+        redis_options.update(appendonly=True, appendfilename=options.appendfilename,
+                             appendfsync=options.appendfsync)
+    if options.unixsocket:
+        server = UnixRespServer(options.unixsocket, **redis_options)
+    else:
+        server = RespServer((options.host, options.port), **redis_options)
+    # Load the snapshot or the log before accepting connections.
+    client = server.client(0)
+    if options.trace:
+        client.trace_start(options.trace)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if options.trace:
+            client.trace_stop()
+
+def replay(argv):
+    parser = optparse.OptionParser(usage="python -m redis_mock replay [options] TRACE")
+    parser.add_option('--speed', type='float',
+                      help="replay at SPEED times the traced pace instead of "
+                           "as fast as possible")
+    parser.add_option('--threads', type='int',
+                      help="spread the traced threads over THREADS threads")
+    parser.add_option('--lock-stripes', dest='lock_stripes', type='int')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected a single trace file")
+
+    redis_options = {}
+    if options.lock_stripes is not None:
+        redis_options['lock_stripes'] = options.lock_stripes
+    count, elapsed = replay_trace(args[0], 'replay', speed=options.speed,
+                                  threads=options.threads, **redis_options)
+    print "%d commands in %.3fs, %.0f commands/sec" % (count, elapsed,
+                                                        count / elapsed if elapsed else 0)
+
+def main(argv):
+    commands = {'serve': serve, 'replay': replay}
+    if not argv or argv[0] not in commands:
+        print >> sys.stderr, "usage: python -m redis_mock serve|replay [options]"
+        return 2
+    commands[argv[0]](argv[1:])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
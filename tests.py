@@ -1,5 +1,14 @@
 #:coding=utf-8:
 
+import collections
+import datetime
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
 from unittest import TestCase
 
 import redis
@@ -11,7 +20,27 @@ __all__ = (
     'RedisMockListTest',
     'RedisMockSetTest',
     'RedisMockHashTest',
+    'RedisMockSortedSetTest',
     'RedisPipelineTest',
+    'RedisStripedLockTest',
+    'RedisLockTest',
+    'RedisNotThreadsafeTest',
+    'RedisCommandLockTest',
+    'RedisExpiryTest',
+    'RedisMaxmemoryTest',
+    'RedisSnapshotTest',
+    'RedisAppendOnlyTest',
+    'RedisServerTest',
+    'RedisExecuteCommandTest',
+    'RedisSharedKeyspaceTest',
+    'RedisScanTest',
+    'RedisKeyspaceInfoTest',
+    'RedisCommandStatsTest',
+    'RedisTraceTest',
+    'RedisBulkCommandTest',
+    'RedisSetAlgebraTest',
+    'RedisReadViewTest',
+    'RedisCompactEncodingTest',
 )
 
 class RedisMockStringTest(TestCase):
@@ -37,25 +66,83 @@ class RedisMockStringTest(TestCase):
         val = self.mock.incr('int-val')
         self.assertTrue(isinstance(val, str))
         self.assertEquals(val, "12")
-        self.assertEquals(self.mock._cache['int-val'], "12")
+        self.assertEquals(self.mock._cache['int-val'], 12)
 
     def test_incr_amount(self):
         val = self.mock.incr('int-val', amount=5)
         self.assertTrue(isinstance(val, str))
         self.assertEquals(val, "16")
-        self.assertEquals(self.mock._cache['int-val'], "16")
+        self.assertEquals(self.mock._cache['int-val'], 16)
 
     def test_new_incr(self):
         val = self.mock.incr('new-int-val')
         self.assertTrue(isinstance(val, str))
         self.assertEquals(val, "1")
-        self.assertEquals(self.mock._cache['new-int-val'], "1")
+        self.assertEquals(self.mock._cache['new-int-val'], 1)
 
     def test_new_incr_amount(self):
         val = self.mock.incr('new-int-val', amount=4)
         self.assertTrue(isinstance(val, str))
         self.assertEquals(val, "4")
-        self.assertEquals(self.mock._cache['new-int-val'], "4")
+        self.assertEquals(self.mock._cache['new-int-val'], 4)
+
+    def test_incr_stored_natively(self):
+        self.mock.incr('int-val')
+        self.assertEquals(self.mock.get('int-val'), '12')
+        self.assertEquals(self.mock.mget('int-val'), ['12'])
+        self.assertEquals(self.mock.type('int-val'), 'string')
+        self.assertEquals(self.mock.object_encoding('int-val'), 'int')
+        self.assertEquals(self.mock.getset('int-val', 'x'), '12')
+
+    def test_incr_errors(self):
+        self.assertRaises(redis.ResponseError, self.mock.incr, 'test-key')
+        self.mock.set('big', str((1 << 63) - 1))
+        self.assertRaises(redis.ResponseError, self.mock.incr, 'big')
+        self.assertEquals(self.mock.get('big'), str((1 << 63) - 1))
+
+    def test_decr(self):
+        self.assertEquals(self.mock.decr('int-val'), '10')
+        self.assertEquals(self.mock.decrby('int-val', 20), '-10')
+        self.assertEquals(self.mock.decr('new-int-val', 3), '-3')
+        self.assertEquals(self.mock._cache['int-val'], -10)
+
+    def test_incrbyfloat(self):
+        self.assertEquals(self.mock.incrbyfloat('int-val', 0.5), 11.5)
+        self.assertEquals(self.mock.get('int-val'), '11.5')
+        self.assertEquals(self.mock.incrbyfloat('int-val', 0.5), 12.0)
+        self.assertEquals(self.mock.get('int-val'), '12')
+        self.assertEquals(self.mock.incrbyfloat('new-val'), 1.0)
+        self.assertRaises(redis.ResponseError, self.mock.incrbyfloat, 'test-key')
+        self.assertRaises(redis.ResponseError, self.mock.incrbyfloat, 'int-val', float('inf'))
+
+    def test_append_strlen(self):
+        self.assertEquals(self.mock.append('new-key', 'spam'), 4)
+        self.assertEquals(self.mock.append('new-key', 'egg'), 7)
+        self.assertEquals(self.mock.get('new-key'), 'spamegg')
+        self.mock.incr('int-val')
+        self.assertEquals(self.mock.strlen('int-val'), 2)
+        self.assertEquals(self.mock.append('int-val', '0'), 3)
+        self.assertEquals(self.mock.incr('int-val'), '121')
+        self.assertEquals(self.mock.strlen('missing'), 0)
+
+    def test_getrange(self):
+        self.mock.set('key', 'This is a string')
+        self.assertEquals(self.mock.getrange('key', 0, 3), 'This')
+        self.assertEquals(self.mock.getrange('key', -3, -1), 'ing')
+        self.assertEquals(self.mock.getrange('key', 0, -100), 'T')
+        self.assertEquals(self.mock.getrange('key', 10, 100), 'string')
+        self.assertEquals(self.mock.getrange('key', 5, 3), '')
+        self.assertEquals(self.mock.getrange('missing', 0, -1), '')
+
+    def test_setrange(self):
+        self.mock.set('key', 'Hello World')
+        self.assertEquals(self.mock.setrange('key', 6, 'Redis'), 11)
+        self.assertEquals(self.mock.get('key'), 'Hello Redis')
+        self.assertEquals(self.mock.setrange('new-key', 3, 'abc'), 6)
+        self.assertEquals(self.mock.get('new-key'), '\0\0\0abc')
+        self.assertEquals(self.mock.setrange('missing', 3, ''), 0)
+        self.assertFalse(self.mock.exists('missing'))
+        self.assertRaises(redis.ResponseError, self.mock.setrange, 'key', -1, 'x')
 
     def test_set(self):
         self.assertTrue(self.mock.set('test-key', "testvalue"))
@@ -142,7 +229,7 @@ class RedisMockListTest(TestCase):
 
     def test_lpush_unicode_value(self):
         self.assertEquals(self.mock.lpush('test-int-list', u"ほげ"), 9)
-        self.assertEquals(self.mock._cache['test-int-list'], [u"ほげ".encode("utf8"), '1','2','3','4','5','6','7','8'])
+        self.assertEquals(list(self.mock._cache['test-int-list']), [u"ほげ".encode("utf8"), '1','2','3','4','5','6','7','8'])
 
     def test_lpush_not_exists(self):
         self.assertEquals(self.mock.lpush('test-not-exists', 10), 1)
@@ -160,7 +247,7 @@ class RedisMockListTest(TestCase):
 
     def test_rpush_unicode_value(self):
         self.assertEquals(self.mock.rpush('test-int-list', u"ほげ"), 9)
-        self.assertEquals(self.mock._cache['test-int-list'], ['1','2','3','4','5','6','7','8', u"ほげ".encode("utf8")])
+        self.assertEquals(list(self.mock._cache['test-int-list']), ['1','2','3','4','5','6','7','8', u"ほげ".encode("utf8")])
 
     def test_lrange_all(self):
         self.assertEquals(self.mock.lrange('test-int-list', 0, -1), ['1','2','3','4','5','6','7','8'])
@@ -232,6 +319,72 @@ class RedisMockListTest(TestCase):
         self.assertEquals(self.mock.lrem('test-dup-list', 4, 0), 3)
         self.assertEquals(self.mock.lrange('test-dup-list', 0, -1), ['1','3','7','7','8'])
 
+    def test_lrange_tail(self):
+        self.assertEquals(self.mock.lrange('test-int-list', -3, -1), ['6','7','8'])
+        self.assertEquals(self.mock.lrange('test-int-list', 6, 100), ['7','8'])
+        self.assertEquals(self.mock.lrange('test-int-list', 5, 2), [])
+
+    def test_ltrim_tail(self):
+        self.assertEquals(self.mock.ltrim('test-int-list', 7, -1), True)
+        self.assertEquals(self.mock.lrange('test-int-list', 0, -1), ['8'])
+
+    def test_list_storage(self):
+        self.mock.rpush('new-list', 1)
+        self.assertTrue(isinstance(self.mock._cache['new-list'], collections.deque))
+        self.mock.lpush('test-int-list', 0)
+        self.assertTrue(isinstance(self.mock._cache['test-int-list'], collections.deque))
+
+    def test_lpop(self):
+        self.assertEquals(self.mock.lpop('test-int-list'), '1')
+        self.assertEquals(self.mock.lpop('test-list'), u"スパム".encode('utf-8'))
+        self.assertEquals(self.mock.lpop('test-list'), u"エッグ".encode('utf-8'))
+        self.assertEquals(self.mock.lpop('test-list'), None)
+        self.assertFalse(self.mock.exists('test-list'))
+
+    def test_rpop(self):
+        self.assertEquals(self.mock.rpop('test-int-list'), '8')
+        self.assertEquals(self.mock.llen('test-int-list'), 7)
+        self.assertEquals(self.mock.rpop('test-not-exists'), None)
+        self.assertRaises(redis.ResponseError,
+            self.mock.rpop, 'test-key')
+
+    def test_rpoplpush(self):
+        self.assertEquals(self.mock.rpoplpush('test-int-list', 'new-list'), '8')
+        self.assertEquals(self.mock.rpoplpush('test-int-list', 'new-list'), '7')
+        self.assertEquals(self.mock.lrange('new-list', 0, -1), ['7', '8'])
+        self.assertEquals(self.mock.rpoplpush('test-not-exists', 'new-list'), None)
+        self.assertRaises(redis.ResponseError,
+            self.mock.rpoplpush, 'test-int-list', 'test-key')
+        self.assertEquals(self.mock.llen('test-int-list'), 6)
+
+    def test_rpoplpush_rotate(self):
+        self.assertEquals(self.mock.rpoplpush('test-int-list', 'test-int-list'), '8')
+        self.assertEquals(self.mock.lrange('test-int-list', 0, 2), ['8', '1', '2'])
+
+    def test_lindex(self):
+        self.assertEquals(self.mock.lindex('test-int-list', 0), '1')
+        self.assertEquals(self.mock.lindex('test-int-list', -1), '8')
+        self.assertEquals(self.mock.lindex('test-int-list', 8), None)
+        self.assertEquals(self.mock.lindex('test-not-exists', 0), None)
+
+    def test_lset(self):
+        self.assertTrue(self.mock.lset('test-int-list', -2, u"ほげ"))
+        self.assertEquals(self.mock.lindex('test-int-list', 6), u"ほげ".encode('utf-8'))
+        self.assertRaises(redis.ResponseError,
+            self.mock.lset, 'test-int-list', 8, 'value')
+        self.assertRaises(redis.ResponseError,
+            self.mock.lset, 'test-not-exists', 0, 'value')
+
+    def test_linsert(self):
+        self.assertEquals(self.mock.linsert('test-int-list', 'before', 2, 'a'), 9)
+        self.assertEquals(self.mock.linsert('test-int-list', 'AFTER', 7, 'b'), 10)
+        self.assertEquals(self.mock.lrange('test-int-list', 0, -1),
+            ['1', 'a', '2', '3', '4', '5', '6', '7', 'b', '8'])
+        self.assertEquals(self.mock.linsert('test-int-list', 'AFTER', 100, 'c'), -1)
+        self.assertEquals(self.mock.linsert('test-not-exists', 'AFTER', 1, 'c'), 0)
+        self.assertRaises(redis.ResponseError,
+            self.mock.linsert, 'test-int-list', 'NEAR', 1, 'c')
+
 class RedisMockSetTest(TestCase):
     def setUp(self):
         self.mock = redis_mock.Redis()
@@ -370,6 +523,19 @@ class RedisMockHashTest(TestCase):
         self.assertFalse(self.mock.hexists('test-hash', 'not-exists'))
         self.assertFalse(self.mock.hexists('not-exists', 'not-exists'))
 
+    def test_hincrby(self):
+        self.assertEquals(self.mock.hincrby('hash', 'field'), 1)
+        self.assertEquals(self.mock.hincrby('hash', 'field', -5), -4)
+        self.assertEquals(self.mock.hget('hash', 'field'), '-4')
+        self.assertRaises(redis.ResponseError, self.mock.hincrby, 'test-hash', 'hashkey1')
+
+    def test_hincrbyfloat(self):
+        self.assertEquals(self.mock.hincrbyfloat('hash', 'field', 1.5), 1.5)
+        self.assertEquals(self.mock.hincrbyfloat('hash', 'field', 1.5), 3.0)
+        self.assertEquals(self.mock.hget('hash', 'field'), '3')
+        self.assertRaises(redis.ResponseError,
+                          self.mock.hincrbyfloat, 'test-hash', 'hashkey1')
+
     def test_hexists_bad_val(self):
         self.assertRaises(redis.ResponseError,
             self.mock.hexists, 'test-key', 'some-key')
@@ -400,3 +566,2170 @@ class RedisPipelineTest(TestCase):
 
         value = pipe.execute()
         self.assertEquals(value, [1, 2, 3, 4])
+
+    def test_single_lock_acquisition(self):
+        acquired = []
+        class RecordingLock(redis_mock.RWLock):
+            def writer(self, *keys):
+                acquired.append(('writer', sorted(keys)))
+                return redis_mock.RWLock.writer(self, *keys)
+            def reader(self, *keys):
+                acquired.append(('reader', sorted(keys)))
+                return redis_mock.RWLock.reader(self, *keys)
+        pipe = self.mock.pipeline()
+        pipe._lock = RecordingLock()
+        pipe.set("test-key", "value").incr("int-val").get("test-key2")
+        self.assertEquals(pipe.execute(), [True, '1', u"エッグ".encode('utf-8')])
+        self.assertEquals(acquired, [('writer', ['int-val', 'test-key', 'test-key2'])])
+
+        del acquired[:]
+        pipe.get("test-key").get("test-key2")
+        pipe.execute()
+        self.assertEquals(acquired, [('reader', ['test-key', 'test-key2'])])
+
+    def test_errors_in_results(self):
+        pipe = self.mock.pipeline()
+        pipe.set("test-key", "value").lpush("test-key", "value").get("test-key")
+        value = pipe.execute()
+        self.assertEquals(value[0], True)
+        self.assertTrue(isinstance(value[1], redis.ResponseError))
+        self.assertEquals(value[2], "value")
+
+    def test_multi(self):
+        pipe = self.mock.pipeline()
+        pipe.multi()
+        self.assertTrue(pipe.explicit_transaction)
+        self.assertRaises(redis.RedisError, pipe.multi)
+        self.assertEquals(pipe, pipe.set("test-key", "value"))
+        self.assertEquals(pipe.execute(), [True])
+        self.assertFalse(pipe.explicit_transaction)
+
+    def test_watch(self):
+        pipe = self.mock.pipeline()
+        self.assertTrue(pipe.watch("test-key"))
+        # Commands run immediately until MULTI
+        self.assertEquals(pipe.get("test-key"), u"スパム".encode('utf-8'))
+        pipe.multi()
+        pipe.set("test-key", "value")
+        self.assertEquals(pipe.execute(), [True])
+        self.assertEquals(self.mock.get("test-key"), "value")
+        self.assertEquals(self.mock._watched, {})
+
+    def test_watch_error(self):
+        pipe = self.mock.pipeline()
+        pipe.watch("test-key")
+        pipe.multi()
+        pipe.set("test-key", "value")
+        self.mock.set("test-key", "other-value")
+        self.assertRaises(redis.WatchError, pipe.execute)
+        self.assertEquals(self.mock.get("test-key"), "other-value")
+        self.assertEquals(pipe.command_stack, [])
+        self.assertEquals(self.mock._watched, {})
+
+    def test_watch_new_key(self):
+        pipe = self.mock.pipeline()
+        pipe.watch("new-key")
+        self.mock.rpush("new-key", "value")
+        pipe.multi()
+        pipe.get("test-key")
+        self.assertRaises(redis.WatchError, pipe.execute)
+
+    def test_watch_flushdb(self):
+        pipe = self.mock.pipeline()
+        pipe.watch("test-key")
+        self.mock.flushdb()
+        pipe.multi()
+        pipe.get("test-key")
+        self.assertRaises(redis.WatchError, pipe.execute)
+
+    def test_watch_unrelated_key(self):
+        pipe = self.mock.pipeline()
+        pipe.watch("test-key")
+        self.mock.set("test-key2", "value")
+        self.mock.get("test-key")
+        pipe.multi()
+        pipe.get("test-key2")
+        self.assertEquals(pipe.execute(), ["value"])
+
+    def test_unwatch(self):
+        pipe = self.mock.pipeline()
+        pipe.watch("test-key")
+        other = self.mock.pipeline()
+        other.watch("test-key")
+        pipe.unwatch()
+        self.assertEquals(self.mock._watched, {'test-key': [1, 0]})
+        other.reset()
+        self.assertEquals(self.mock._watched, {})
+
+    def test_command_stack(self):
+        pipe = self.mock.pipeline()
+        pipe.set("test-key", "value").get("test-key")
+        self.assertEquals(pipe.command_stack, [
+            ('set', ('test-key', 'value', None, None, False, False)),
+            ('get', ('test-key',)),
+        ])
+        self.assertEquals(pipe.execute(), [True, 'value'])
+        self.assertEquals(pipe.command_stack, [])
+
+class RedisStripedLockTest(TestCase):
+    def setUp(self):
+        self.mock = redis_mock.Redis(db=15, lock_stripes=8)
+        self.mock._cache.clear()
+        self.mock._cache['test-key'] = u"スパム".encode('utf-8')
+        self.mock._cache['test-key2'] = u"エッグ".encode('utf-8')
+
+    def test_lock_type(self):
+        self.assertTrue(isinstance(self.mock._lock, redis_mock.StripedRWLock))
+        self.assertEquals(self.mock._lock.stripe_count, 8)
+
+    def test_shared_lock(self):
+        other = redis_mock.Redis(db=15)
+        self.assertTrue(other._lock is self.mock._lock)
+        self.assertEquals(other.get('test-key'), u"スパム".encode('utf-8'))
+
+    def test_stripe_mismatch(self):
+        self.assertRaises(redis.RedisError,
+            redis_mock.Redis, db=15, lock_stripes=4)
+
+    def test_stripe_indexes_sorted(self):
+        indexes = self.mock._lock._indexes(['a', 'b', 'c', 'd', 'e', 'a'])
+        self.assertEquals(indexes, sorted(set(indexes)))
+        self.assertEquals(self.mock._lock._indexes(()), range(8))
+
+    def test_delete_multi(self):
+        self.assertTrue(self.mock.delete('test-key', 'test-key2'))
+        self.assertEquals(self.mock.get('test-key'), None)
+        self.assertEquals(self.mock.get('test-key2'), None)
+
+    def test_concurrent_incr(self):
+        def worker():
+            for i in range(200):
+                self.mock.incr('counter')
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(self.mock.get('counter'), '800')
+
+    def test_multi_key_no_deadlock(self):
+        keys = ['key-%d' % i for i in range(16)]
+        def worker(names):
+            for i in range(100):
+                self.mock.sinter(names)
+                self.mock.sadd(names[0], i)
+                self.mock.delete(*names)
+        threads = [
+            threading.Thread(target=worker, args=(keys,)),
+            threading.Thread(target=worker, args=(list(reversed(keys)),)),
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+            self.assertFalse(t.isAlive())
+
+class RedisLockTest(TestCase):
+    def test_reader_fast_path(self):
+        lock = redis_mock.RWLock()
+        with lock.reader():
+            with lock.reader():
+                self.assertEquals(lock.active_readers, 2)
+        self.assertEquals(lock.active_readers, 0)
+        with lock.writer():
+            self.assertEquals(lock.active_writers, 1)
+        self.assertEquals(lock.active_writers, 0)
+
+    def test_writer_excludes_readers(self):
+        lock = redis_mock.RWLock()
+        events = []
+        def reader():
+            with lock.reader():
+                events.append('read')
+        lock.writer_enters()
+        t = threading.Thread(target=reader)
+        t.start()
+        t.join(0.05)
+        self.assertEquals(events, [])
+        self.assertEquals(lock.waiting_readers, 1)
+        events.append('write')
+        lock.writer_leaves()
+        t.join()
+        self.assertEquals(events, ['write', 'read'])
+
+    def test_exception_releases_lock(self):
+        lock = redis_mock.RWLock()
+        def fail():
+            with lock.writer():
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertEquals(lock.active_writers, 0)
+
+class RedisNotThreadsafeTest(TestCase):
+    def setUp(self):
+        self.mock = redis_mock.Redis(threadsafe=False)
+        self.mock._cache.clear()
+
+    def test_lock_type(self):
+        self.assertTrue(isinstance(self.mock._lock, redis_mock.NullLock))
+        self.assertTrue(isinstance(self.mock.pipeline()._lock, redis_mock.NullLock))
+
+    def test_shared_cache(self):
+        self.assertTrue(self.mock.set('test-key', 'spam'))
+        self.assertEquals(redis_mock.Redis().get('test-key'), 'spam')
+        self.assertEquals(self.mock.incr('int-val', 2), '2')
+
+class RedisCommandLockTest(TestCase):
+    def setUp(self):
+        self.mock = redis_mock.Redis(db=14)
+        self.mock._cache.clear()
+        self.mock._cache['test-hash'] = {"hashkey1": "value1"}
+
+    def test_read_only_commands(self):
+        for name in ('get', 'exists', 'llen', 'lrange', 'lindex', 'hget',
+                     'hexists', 'hgetall', 'hlen', 'scard', 'sinter',
+                     'sismember', 'smembers'):
+            self.assertFalse(redis_mock._commands[name].write, name)
+        for name in ('set', 'delete', 'lpush', 'ltrim', 'hset', 'hdel',
+                     'sadd', 'srem', 'flushdb'):
+            self.assertTrue(redis_mock._commands[name].write, name)
+
+    def _run_while_reading(self, func, *args):
+        results = []
+        t = threading.Thread(target=lambda: results.append(func(*args)))
+        self.mock._lock.reader_enters()
+        try:
+            t.start()
+            t.join(0.1)
+            return list(results)
+        finally:
+            self.mock._lock.reader_leaves()
+            t.join()
+
+    def test_hget_shares_reader_lock(self):
+        self.assertEquals(self._run_while_reading(
+            self.mock.hget, 'test-hash', 'hashkey1'), ['value1'])
+        self.assertEquals(self._run_while_reading(
+            self.mock.hgetall, 'test-hash'), [{"hashkey1": "value1"}])
+
+    def test_hset_waits_for_readers(self):
+        self.assertEquals(self._run_while_reading(
+            self.mock.hset, 'test-hash', 'hashkey1', 'value2'), [])
+        self.assertEquals(self.mock.hget('test-hash', 'hashkey1'), 'value2')
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class RedisExpiryTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.mock = redis_mock.Redis(clock=self.clock)
+        self.mock._cache.clear()
+        self.mock._cache['test-key'] = u"スパム".encode('utf-8')
+        self.mock._cache['test-list'] = ['1', '2']
+
+    def test_expire(self):
+        self.assertTrue(self.mock.expire('test-key', 10))
+        self.assertEquals(self.mock.ttl('test-key'), 10)
+        self.clock.now += 9.9
+        self.assertEquals(self.mock.pttl('test-key'), 100)
+        self.assertEquals(self.mock.get('test-key'), u"スパム".encode('utf-8'))
+        self.clock.now += 0.1
+        self.assertEquals(self.mock.get('test-key'), None)
+        self.assertFalse('test-key' in self.mock._cache)
+        self.assertEquals(self.mock._cache.expires, {})
+
+    def test_expire_not_exists(self):
+        self.assertFalse(self.mock.expire('test-not-exists', 10))
+        self.assertEquals(self.mock.ttl('test-not-exists'), -2)
+        self.assertEquals(self.mock.ttl('test-key'), -1)
+
+    def test_expire_timedelta(self):
+        self.assertTrue(self.mock.pexpire('test-list', datetime.timedelta(seconds=1.5)))
+        self.assertEquals(self.mock.pttl('test-list'), 1500)
+        self.clock.now += 2
+        self.assertEquals(self.mock.lrange('test-list', 0, -1), [])
+        self.assertEquals(self.mock.rpush('test-list', 'a'), 1)
+        self.assertEquals(self.mock.ttl('test-list'), -1)
+
+    def test_expire_negative(self):
+        self.assertTrue(self.mock.expire('test-key', -1))
+        self.assertFalse(self.mock.exists('test-key'))
+
+    def test_expireat(self):
+        self.assertTrue(self.mock.expireat('test-key', 1005))
+        self.assertEquals(self.mock.ttl('test-key'), 5)
+        self.assertTrue(self.mock.pexpireat('test-key', 1000250))
+        self.assertEquals(self.mock.pttl('test-key'), 250)
+
+    def test_persist(self):
+        self.mock.expire('test-key', 10)
+        self.assertTrue(self.mock.persist('test-key'))
+        self.assertFalse(self.mock.persist('test-key'))
+        self.clock.now += 20
+        self.assertEquals(self.mock.ttl('test-key'), -1)
+
+    def test_set_clears_ttl(self):
+        self.mock.expire('test-key', 10)
+        self.mock.set('test-key', 'value')
+        self.assertEquals(self.mock.ttl('test-key'), -1)
+
+    def test_incr_keeps_ttl(self):
+        self.mock.setex('int-val', 1, 10)
+        self.assertEquals(self.mock.incr('int-val'), '2')
+        self.assertEquals(self.mock.ttl('int-val'), 10)
+
+    def test_set_ex_px(self):
+        self.assertTrue(self.mock.set('test-key', 'value', ex=10))
+        self.assertEquals(self.mock.ttl('test-key'), 10)
+        self.assertTrue(self.mock.set('test-key', 'value', px=1500))
+        self.assertEquals(self.mock.pttl('test-key'), 1500)
+        self.assertRaises(redis.ResponseError,
+            self.mock.set, 'test-key', 'value', ex=0)
+
+    def test_set_nx_xx(self):
+        self.assertEquals(self.mock.set('test-key', 'value', nx=True), None)
+        self.assertTrue(self.mock.set('new-key', 'value', nx=True))
+        self.assertEquals(self.mock.set('other-key', 'value', xx=True), None)
+        self.assertFalse(self.mock.exists('other-key'))
+        self.assertTrue(self.mock.set('test-key', 'value', xx=True))
+        self.assertEquals(self.mock.get('test-key'), 'value')
+
+    def test_setex_psetex(self):
+        self.assertTrue(self.mock.setex('new-key', 'value', 10))
+        self.assertEquals(self.mock.ttl('new-key'), 10)
+        self.assertTrue(self.mock.psetex('new-key', 500, 'value'))
+        self.assertEquals(self.mock.pttl('new-key'), 500)
+        self.assertRaises(redis.ResponseError,
+            self.mock.setex, 'new-key', 'value', 0)
+
+    def test_delete_drops_ttl(self):
+        self.mock.expire('test-key', 10)
+        self.mock.delete('test-key')
+        self.assertEquals(self.mock._cache.expires, {})
+
+    def test_pipeline_expires(self):
+        self.mock.expire('test-key', 10)
+        self.clock.now += 10
+        pipe = self.mock.pipeline()
+        pipe.get('test-key').exists('test-key')
+        self.assertEquals(pipe.execute(), [None, False])
+
+    def test_watch_expired_key(self):
+        self.mock.expire('test-key', 10)
+        pipe = self.mock.pipeline()
+        pipe.watch('test-key')
+        self.clock.now += 10
+        pipe.multi()
+        pipe.get('test-key')
+        self.assertRaises(redis.WatchError, pipe.execute)
+
+    def test_concurrent_reads_of_expired_keys(self):
+        mock = redis_mock.Redis(host='expiry-race-test', clock=self.clock, maxmemory=1 << 30)
+        mock.flushdb()
+        for i in range(20000):
+            mock.setex('key-%d' % i, 'value', 1)
+        self.clock.now += 2
+        errors = []
+        def read():
+            try:
+                for i in range(20000):
+                    mock.get('key-%d' % i)
+            except Exception, error:
+                errors.append(error)
+        threads = [threading.Thread(target=read) for i in range(8)]
+        # Switching threads as often as possible makes races show up.
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEquals(errors, [])
+        self.assertEquals(mock.dbsize(), 0)
+        self.assertEquals(mock.info('memory')['used_memory'], 0)
+
+    def test_pop(self):
+        cache = self.mock._cache
+        self.assertEquals(cache.pop('missing', None), None)
+        self.assertRaises(KeyError, cache.pop, 'missing')
+        self.assertEquals(cache.pop('test-key'), u"スパム".encode('utf-8'))
+        self.assertEquals(cache.type_counts()['string'], 0)
+
+    def test_sweeper(self):
+        mock = redis_mock.Redis(db=13, clock=self.clock)
+        mock.flushdb()
+        for i in range(10):
+            mock.setex('key-%d' % i, 'value', i + 1)
+        mock.set('no-ttl', 'value')
+        sweeper = redis_mock.ExpirySweeper(mock, limit=3)
+        mock.expire('key-0', 100)
+        self.clock.now += 5
+        self.assertEquals(sweeper.sweep(), 3)
+        self.assertEquals(sweeper.sweep(), 1)
+        self.assertEquals(sweeper.sweep(), 0)
+        self.assertEquals(sorted(mock._cache),
+            ['key-0', 'key-5', 'key-6', 'key-7', 'key-8', 'key-9', 'no-ttl'])
+
+    def test_active_expire(self):
+        mock = redis_mock.Redis(db=12, active_expire=0.01)
+        try:
+            mock.psetex('test-key', 10, 'value')
+            for i in range(100):
+                if 'test-key' not in mock._cache:
+                    break
+                time.sleep(0.01)
+            self.assertFalse('test-key' in mock._cache)
+        finally:
+            mock._cache.sweeper.stop()
+
+class RedisMaxmemoryTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.mock = redis_mock.Redis(db=11, clock=self.clock, maxmemory=1000,
+                                     maxmemory_policy='allkeys-lru')
+        self.mock.flushdb()
+
+    def tearDown(self):
+        self.mock._cache.limit = None
+        self.mock.flushdb()
+
+    def used_memory(self):
+        return self.mock.info('memory')['used_memory']
+
+    def test_used_memory(self):
+        self.assertEquals(self.used_memory(), 0)
+        self.mock.set('key', 'x' * 100)
+        used = self.used_memory()
+        self.assertTrue(used > 100)
+        self.mock.rpush('list', 'a')
+        self.mock.rpush('list', 'b')
+        self.assertTrue(self.used_memory() > used)
+        self.mock.delete('list')
+        self.assertEquals(self.used_memory(), used)
+        self.mock.flushdb()
+        self.assertEquals(self.used_memory(), 0)
+
+    def test_used_memory_untracked(self):
+        mock = redis_mock.Redis(db=10)
+        mock.flushdb()
+        mock.set('key', 'x' * 100)
+        self.mock.set('key', 'x' * 100)
+        self.assertEquals(mock.info('memory')['used_memory'], self.used_memory())
+
+    def test_concurrent_accounting(self):
+        mock = redis_mock.Redis(host='maxmemory-race-test', lock_stripes=16,
+                                maxmemory=1 << 30)
+        mock.flushdb()
+        def write(index):
+            for i in range(2000):
+                key = 'key-%d-%d' % (index, i % 50)
+                mock.set(key, 'x' * (i % 7))
+                if i % 3 == 0:
+                    mock.delete(key)
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        cache = mock._cache
+        self.assertEquals(mock.info('memory')['used_memory'],
+                          sum(redis_mock.MemoryLimit.size_of(key, value)
+                              for key, value in cache.items()))
+
+    def test_evict_lru(self):
+        for i in range(5):
+            self.mock.set('key-%d' % i, 'x' * 100)
+        self.mock.get('key-0')
+        for i in range(5, 20):
+            self.mock.set('key-%d' % i, 'x' * 100)
+            self.mock.get('key-0')
+        self.assertTrue(self.used_memory() <= 1000 + 200)
+        self.assertTrue(self.mock.exists('key-0'))
+        self.assertTrue(self.mock.info('stats')['evicted_keys'] > 0)
+
+    def test_evict_lfu(self):
+        self.mock.config_set('maxmemory-policy', 'allkeys-lfu')
+        self.mock.set('hot', 'x' * 100)
+        for i in range(100):
+            self.mock.get('hot')
+        for i in range(20):
+            self.mock.set('key-%d' % i, 'x' * 100)
+        self.assertTrue(self.mock.exists('hot'))
+
+    def test_evict_volatile_ttl(self):
+        self.mock.config_set('maxmemory-policy', 'volatile-ttl')
+        self.mock.set('persistent', 'x' * 100)
+        for i in range(10):
+            self.mock.setex('key-%d' % i, 'x' * 100, 100 + i)
+        self.assertTrue(self.mock.exists('persistent'))
+        self.assertFalse(self.mock.exists('key-0'))
+        self.assertTrue(self.mock.exists('key-9'))
+
+    def test_noeviction(self):
+        self.mock.config_set('maxmemory-policy', 'noeviction')
+        for i in range(6):
+            self.mock.set('key-%d' % i, 'x' * 100)
+        self.assertRaises(redis.ResponseError, self.mock.set, 'key', 'value')
+        self.assertRaises(redis.ResponseError, self.mock.rpush, 'list', 'value')
+        # Reads and commands that free memory are still allowed.
+        self.assertEquals(self.mock.get('key-0'), 'x' * 100)
+        self.assertEquals(self.mock.delete('key-0'), True)
+        self.assertEquals(self.mock.info('stats')['evicted_keys'], 0)
+
+    def test_noeviction_pipeline(self):
+        self.mock.config_set('maxmemory-policy', 'noeviction')
+        for i in range(6):
+            self.mock.set('key-%d' % i, 'x' * 100)
+        pipe = self.mock.pipeline()
+        pipe.set('key', 'value')
+        self.assertRaises(redis.ResponseError, pipe.execute)
+        pipe.delete('key-0')
+        self.assertEquals(pipe.execute(), [True])
+
+    def test_evict_touches_watch(self):
+        self.mock.set('watched', 'x' * 100)
+        pipe = self.mock.pipeline()
+        pipe.watch('watched')
+        for i in range(20):
+            self.mock.set('key-%d' % i, 'x' * 100)
+        self.assertFalse(self.mock.exists('watched'))
+        pipe.multi()
+        pipe.set('watched', 'value')
+        self.assertRaises(redis.WatchError, pipe.execute)
+
+    def test_config(self):
+        self.assertEquals(self.mock.config_get('maxmemory*'), {
+            'maxmemory': '1000',
+            'maxmemory-policy': 'allkeys-lru',
+            'maxmemory-samples': '5',
+        })
+        self.mock.config_set('maxmemory-samples', 10)
+        self.assertEquals(self.mock.config_get('maxmemory-samples'),
+                          {'maxmemory-samples': '10'})
+        self.assertRaises(redis.ResponseError, self.mock.config_set,
+                          'maxmemory-policy', 'bogus')
+        self.assertRaises(redis.ResponseError, self.mock.config_set, 'bogus', 1)
+
+    def test_config_set_keeps_watches(self):
+        self.mock.set('watched', 'value')
+        pipe = self.mock.pipeline()
+        pipe.watch('watched')
+        self.mock.config_set('maxmemory', 2000)
+        pipe.multi()
+        pipe.get('watched')
+        self.assertEquals(pipe.execute(), ['value'])
+
+    def test_lower_maxmemory_evicts(self):
+        for i in range(5):
+            self.mock.set('key-%d' % i, 'x' * 100)
+        self.mock.config_set('maxmemory', 400)
+        self.assertTrue(self.used_memory() <= 400)
+        self.mock.config_set('maxmemory', 0)
+        for i in range(20):
+            self.mock.set('key-%d' % i, 'x' * 100)
+        self.assertEquals(len(self.mock._cache), 20)
+
+class RedisSnapshotTest(TestCase):
+    host = 'snapshot-test'
+
+    def setUp(self):
+        redis_mock._lastsave.pop(self.host + ':6379', None)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'dump.rdb')
+        self.clock = FakeClock()
+        self.mock = self.connect(0)
+
+    def tearDown(self):
+        self.forget()
+        shutil.rmtree(self.dir)
+
+    def connect(self, db):
+        return redis_mock.Redis(host=self.host, db=db, clock=self.clock,
+                                dbfilename=self.path)
+
+    def forget(self):
+        # Simulates a restart by dropping the databases of the test server.
+        for name in list(redis_mock._caches):
+            if name.startswith(self.host + ':'):
+                del redis_mock._caches[name]
+
+    def fill(self):
+        self.mock.set('string', u"スパム".encode('utf-8'))
+        self.mock.set('empty', '')
+        self.mock.incrby('counter', 3)
+        self.mock.rpush('list', 'a')
+        self.mock.rpush('list', 'b')
+        self.mock.sadd('set', 'a')
+        self.mock.sadd('set', 'b')
+        self.mock.hset('hash', 'field', 'value')
+        self.mock.zadd('zset', 'a', 2, 'b', 1.5)
+        self.mock.setex('volatile', 'value', 10)
+        self.connect(1).set('other-db', 'value')
+
+    def assertRestored(self, mock):
+        self.assertEquals(mock.get('string'), u"スパム".encode('utf-8'))
+        self.assertEquals(mock.get('empty'), '')
+        self.assertEquals(mock.get('counter'), '3')
+        self.assertEquals(mock.lrange('list', 0, -1), ['a', 'b'])
+        self.assertEquals(mock.smembers('set'), set(['a', 'b']))
+        self.assertEquals(mock.hgetall('hash'), {'field': 'value'})
+        self.assertEquals(mock.zrange('zset', 0, -1, withscores=True),
+                          [('b', 1.5), ('a', 2.0)])
+        self.assertEquals(mock.ttl('volatile'), 10)
+        self.assertEquals(self.connect(1).get('other-db'), 'value')
+
+    def test_save_load(self):
+        self.fill()
+        self.assertEquals(self.mock.lastsave(), None)
+        self.assertTrue(self.mock.save())
+        self.assertTrue(isinstance(self.mock.lastsave(), datetime.datetime))
+        self.forget()
+        self.assertRestored(self.connect(0))
+
+    def test_bgsave(self):
+        self.fill()
+        self.assertTrue(self.mock.bgsave())
+        thread = redis_mock._bgsaves.get(self.host + ':6379')
+        if thread is not None:
+            thread.join()
+        self.assertTrue(isinstance(self.mock.lastsave(), datetime.datetime))
+        self.forget()
+        self.assertRestored(self.connect(0))
+
+    def test_concurrent_bgsave(self):
+        self.fill()
+        errors = []
+
+        def bgsave():
+            try:
+                self.mock.bgsave()
+            except redis.ResponseError as e:
+                errors.append(e)
+        # The first bgsave waits for the writer lock with its slot reserved.
+        threads = [threading.Thread(target=bgsave) for i in range(2)]
+        with self.mock._lock.writer():
+            for thread in threads:
+                thread.start()
+            deadline = time.time() + 5
+            while not errors and time.time() < deadline:
+                time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        thread = redis_mock._bgsaves.get(self.host + ':6379')
+        if thread is not None:
+            thread.join()
+        self.assertEquals(len(errors), 1)
+        self.forget()
+        self.assertRestored(self.connect(0))
+
+    def test_plain_list(self):
+        self.mock._cache['list'] = ['b', 'a', 'c']
+        self.mock.save()
+        self.forget()
+        mock = self.connect(0)
+        self.assertEquals(mock.type('list'), 'list')
+        self.assertEquals(mock.lrange('list', 0, -1), ['b', 'a', 'c'])
+
+    def test_load_skips_expired(self):
+        self.fill()
+        self.mock.save()
+        self.forget()
+        self.clock.now += 10
+        mock = self.connect(0)
+        self.assertFalse(mock.exists('volatile'))
+        self.assertEquals(mock.get('string'), u"スパム".encode('utf-8'))
+
+    def test_load_only_once(self):
+        self.fill()
+        self.mock.save()
+        self.mock.delete('string')
+        self.assertFalse(self.connect(0).exists('string'))
+
+    def test_large_zset(self):
+        for i in range(0, 3000, 100):
+            args = []
+            for j in range(i, i + 100):
+                args.extend(('m%d' % j, j % 7))
+            self.mock.zadd('zset', *args)
+        expected = self.mock.zrange('zset', 0, -1, withscores=True)
+        rank = self.mock.zrank('zset', 'm700')
+        self.mock.save()
+        self.forget()
+        mock = self.connect(0)
+        self.assertEquals(mock.zrange('zset', 0, -1, withscores=True), expected)
+        self.assertEquals(mock.zrank('zset', 'm700'), rank)
+        mock.zadd('zset', 'm700', 100)
+        self.assertEquals(mock.zrange('zset', -1, -1), ['m700'])
+
+    def test_bad_file(self):
+        with open(self.path, 'wb') as fp:
+            fp.write('garbage')
+        self.forget()
+        self.assertRaises(redis.RedisError, self.connect, 0)
+
+class RedisAppendOnlyTest(TestCase):
+    host = 'aof-test'
+    server = 'aof-test:6379'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'appendonly.aof')
+        self.clock = FakeClock()
+        self.mock = self.connect(0)
+
+    def tearDown(self):
+        self.restart()
+        shutil.rmtree(self.dir)
+
+    def connect(self, db, fsync='always'):
+        return redis_mock.Redis(host=self.host, db=db, clock=self.clock, appendonly=True,
+                                appendfilename=self.path, appendfsync=fsync)
+
+    def restart(self):
+        aof = redis_mock._aofs.pop(self.server, None)
+        if aof is not None:
+            aof.close()
+        for name in list(redis_mock._caches):
+            if name.startswith(self.server + ':'):
+                del redis_mock._caches[name]
+
+    def fill(self):
+        self.mock.set('string', 'value')
+        self.mock.incr('counter')
+        self.mock.incr('counter')
+        self.mock.rpush('list', 'a')
+        self.mock.lpush('list', 'b')
+        self.mock.sadd('set', 'a')
+        self.mock.hset('hash', 'field', 'value')
+        self.mock.zadd('zset', 'a', 2, 'b', 1.5)
+        self.mock.set('deleted', 'value')
+        self.mock.delete('deleted')
+        self.connect(1).set('other-db', 'value')
+
+    def assertRestored(self, mock):
+        self.assertEquals(mock.get('string'), 'value')
+        self.assertEquals(mock.get('counter'), '2')
+        self.assertEquals(mock.lrange('list', 0, -1), ['b', 'a'])
+        self.assertEquals(mock.smembers('set'), set(['a']))
+        self.assertEquals(mock.hgetall('hash'), {'field': 'value'})
+        self.assertEquals(mock.zrange('zset', 0, -1, withscores=True),
+                          [('b', 1.5), ('a', 2.0)])
+        self.assertFalse(mock.exists('deleted'))
+        self.assertEquals(self.connect(1).get('other-db'), 'value')
+
+    def test_replay(self):
+        self.fill()
+        self.restart()
+        self.assertRestored(self.connect(0))
+
+    def test_spop_logged_as_srem(self):
+        self.mock.sadd('set', *map(str, range(10)))
+        self.mock.spop('set')
+        self.mock.spop('set', 3)
+        names = [record[1] for record in redis_mock._read_records(self.path)]
+        self.assertEquals(names, ['sadd', 'srem', 'srem'])
+        members = self.mock.smembers('set')
+        self.restart()
+        self.assertEquals(self.connect(0).smembers('set'), members)
+
+    def test_replay_pipeline(self):
+        pipe = self.mock.pipeline()
+        pipe.set('a', '1')
+        pipe.rpush('b', '2')
+        pipe.execute()
+        self.restart()
+        mock = self.connect(0)
+        self.assertEquals(mock.get('a'), '1')
+        self.assertEquals(mock.lrange('b', 0, -1), ['2'])
+
+    def test_fsync_policies(self):
+        for fsync in ('everysec', 'no'):
+            self.restart()
+            os.unlink(self.path)
+            self.mock = self.connect(0, fsync)
+            self.fill()
+            self.restart()
+            self.assertRestored(self.connect(0, fsync))
+
+    def test_expire_logged_as_deadline(self):
+        self.mock.set('key', 'value')
+        self.mock.expire('key', 10)
+        self.mock.setex('setex-key', 'value', 10)
+        self.mock.set('set-key', 'value', px=10000)
+        self.clock.now += 5
+        self.restart()
+        mock = self.connect(0)
+        self.assertEquals(mock.ttl('key'), 5)
+        self.assertEquals(mock.ttl('setex-key'), 5)
+        self.assertEquals(mock.ttl('set-key'), 5)
+        self.clock.now += 5
+        self.restart()
+        mock = self.connect(0)
+        self.assertFalse(mock.exists('key'))
+        self.assertFalse(mock.exists('setex-key'))
+
+    def test_truncated_record(self):
+        self.mock.set('a', '1')
+        self.mock.set('b', '2')
+        self.restart()
+        with open(self.path, 'rb+') as fp:
+            fp.truncate(os.path.getsize(self.path) - 1)
+        mock = self.connect(0)
+        self.assertEquals(mock.get('a'), '1')
+        self.assertFalse(mock.exists('b'))
+
+    def test_eviction_logged(self):
+        self.restart()
+        mock = redis_mock.Redis(host=self.host, clock=self.clock, appendonly=True,
+                                appendfilename=self.path, appendfsync='always',
+                                maxmemory=1000, maxmemory_policy='allkeys-lru')
+        for i in range(20):
+            mock.set('key-%d' % i, 'x' * 100)
+        keys = set(mock._cache)
+        self.restart()
+        self.assertEquals(set(self.connect(0)._cache), keys)
+
+    def test_bgrewriteaof(self):
+        self.fill()
+        for i in range(100):
+            self.mock.incr('counter')
+        self.mock.expire('string', 10)
+        size = os.path.getsize(self.path)
+        aof = redis_mock._aofs[self.server]
+        self.assertTrue(self.mock.bgrewriteaof())
+        self.mock.set('after-rewrite', 'value')
+        while aof.rewriting:
+            time.sleep(0.01)
+        self.mock.set('after-swap', 'value')
+        self.assertTrue(os.path.getsize(self.path) < size)
+        self.restart()
+        mock = self.connect(0)
+        self.assertEquals(mock.get('counter'), '102')
+        self.assertEquals(mock.ttl('string'), 10)
+        self.assertEquals(mock.get('after-rewrite'), 'value')
+        self.assertEquals(mock.get('after-swap'), 'value')
+        self.assertEquals(mock.lrange('list', 0, -1), ['b', 'a'])
+        self.assertEquals(mock.zrange('zset', 0, -1, withscores=True),
+                          [('b', 1.5), ('a', 2.0)])
+        self.assertEquals(self.connect(1).get('other-db'), 'value')
+
+    def test_bgrewriteaof_plain_list(self):
+        self.mock._cache['list'] = ['b', 'a', 'c']
+        aof = redis_mock._aofs[self.server]
+        self.assertTrue(self.mock.bgrewriteaof())
+        while aof.rewriting:
+            time.sleep(0.01)
+        self.restart()
+        mock = self.connect(0)
+        self.assertEquals(mock.type('list'), 'list')
+        self.assertEquals(mock.lrange('list', 0, -1), ['b', 'a', 'c'])
+
+    def test_bgrewriteaof_not_enabled(self):
+        mock = redis_mock.Redis(host='no-aof-test')
+        self.assertRaises(redis.ResponseError, mock.bgrewriteaof)
+
+class RedisServerTest(TestCase):
+    host = '127.0.0.1'
+
+    def setUp(self):
+        self.server = redis_mock.RespServer((self.host, 0))
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.port = self.server.server_address[1]
+        self.client = redis.StrictRedis(port=self.port)
+        self.client.flushall()
+
+    def tearDown(self):
+        self.client.connection_pool.disconnect()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def raw(self, data):
+        sock = socket.create_connection((self.host, self.port))
+        try:
+            sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    return ''.join(chunks)
+                chunks.append(chunk)
+        finally:
+            sock.close()
+
+    def test_commands(self):
+        client = self.client
+        self.assertTrue(client.ping())
+        self.assertTrue(client.set('key', 'value'))
+        self.assertEquals(client.get('key'), 'value')
+        self.assertEquals(client.set('key', 'other', nx=True), None)
+        self.assertTrue(client.set('volatile', 'value', ex=10))
+        self.assertEquals(client.ttl('volatile'), 10)
+        self.assertEquals(client.incrby('counter', 5), 5)
+        self.assertEquals(client.delete('key', 'counter', 'missing'), 2)
+        self.assertEquals(client.rpush('list', 'a'), 1)
+        self.assertEquals(client.lpush('list', 'b'), 2)
+        self.assertEquals(client.lrange('list', 0, -1), ['b', 'a'])
+        self.assertEquals(client.hset('hash', 'field', 'value'), 1)
+        self.assertEquals(client.hgetall('hash'), {'field': 'value'})
+        self.assertEquals(client.sadd('set', 'a'), 1)
+        self.assertEquals(client.smembers('set'), set(['a']))
+        self.assertEquals(client.zadd('zset', 1, 'a', 2.5, 'b'), 2)
+        self.assertEquals(client.zrange('zset', 0, -1, withscores=True),
+                          [('a', 1.0), ('b', 2.5)])
+        self.assertEquals(client.zrevrangebyscore('zset', '+inf', '(1'), ['b'])
+        self.assertEquals(client.zincrby('zset', 'a', 2), 3.0)
+        self.assertEquals(client.zscore('zset', 'missing'), None)
+
+    def test_errors(self):
+        self.client.set('key', 'value')
+        self.assertRaises(redis.ResponseError, self.client.lpush, 'key', 'value')
+        self.assertRaises(redis.ResponseError, self.client.execute_command, 'NOSUCHCOMMAND')
+        self.assertRaises(redis.ResponseError, self.client.execute_command, 'GET')
+        self.assertRaises(redis.ResponseError, self.client.execute_command,
+                          'SET', 'key', 'value', 'BOGUS')
+        self.assertEquals(self.client.get('key'), 'value')
+
+    def test_select(self):
+        other = redis.StrictRedis(port=self.port, db=3)
+        other.set('key', 'db3')
+        self.assertEquals(self.client.get('key'), None)
+        self.assertEquals(other.get('key'), 'db3')
+        other.connection_pool.disconnect()
+
+    def test_pipeline(self):
+        for transaction in (True, False):
+            pipe = self.client.pipeline(transaction=transaction)
+            pipe.set('key', 1).incr('key').get('key')
+            self.assertEquals(pipe.execute(), [True, 2, '2'])
+
+    def test_transaction_errors(self):
+        pipe = self.client.pipeline()
+        pipe.set('key', 'value').lpush('key', 'value').get('key')
+        self.assertRaises(redis.ResponseError, pipe.execute)
+        self.assertEquals(self.client.get('key'), 'value')
+
+    def test_watch(self):
+        with self.client.pipeline() as pipe:
+            pipe.watch('key')
+            self.client.set('key', 'changed')
+            pipe.multi()
+            pipe.set('key', 'value')
+            self.assertRaises(redis.WatchError, pipe.execute)
+        self.assertEquals(self.client.get('key'), 'changed')
+
+    def test_raw_pipelining(self):
+        request = '*3\r\n$3\r\nSET\r\n$1\r\na\r\n$1\r\n1\r\n' * 2
+        request += 'GET a\r\n*2\r\n$4\r\nINCR\r\n$1\r\na\r\nQUIT\r\nPING\r\n'
+        self.assertEquals(self.raw(request), '+OK\r\n+OK\r\n$1\r\n1\r\n:2\r\n+OK\r\n')
+
+    def test_protocol_error(self):
+        self.assertTrue(self.raw('*1\r\n:1\r\n').startswith('-ERR Protocol error'))
+
+    def test_reader_chunks(self):
+        reader = redis_mock.RespReader()
+        value = 'x' * 100000
+        request = '*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$%d\r\n%s\r\n' % (len(value), value)
+        for i in range(0, len(request), 1000):
+            self.assertEquals(reader.get(), None)
+            reader.feed(request[i:i + 1000])
+        self.assertEquals(reader.get(), ['SET', 'key', value])
+        self.assertEquals(reader.get(), None)
+
+    def test_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'redis.sock')
+        server = redis_mock.UnixRespServer(path)
+        thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        try:
+            client = redis.StrictRedis(unix_socket_path=path)
+            self.assertTrue(client.set('key', 'value'))
+            self.assertEquals(client.get('key'), 'value')
+            client.connection_pool.disconnect()
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(directory)
+
+    def test_concurrent_clients(self):
+        def work(index):
+            client = redis.StrictRedis(port=self.port)
+            for i in range(100):
+                client.incr('counter')
+            client.connection_pool.disconnect()
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(self.client.get('counter'), '800')
+
+class RedisExecuteCommandTest(TestCase):
+    def setUp(self):
+        self.mock = redis_mock.Redis()
+        self.mock._cache.clear()
+
+    def test_execute_command(self):
+        mock = self.mock
+        self.assertEquals(mock.execute_command('SET', 'key', 1), True)
+        self.assertEquals(mock.execute_command('get', 'key'), '1')
+        self.assertEquals(mock.execute_command('INCRBY', 'key', 2), 3)
+        self.assertEquals(mock.execute_command('DECRBY', 'key', 5), -2)
+        self.assertEquals(mock.execute_command('INCRBYFLOAT', 'key', 0.5), -1.5)
+        self.assertEquals(mock.execute_command('GETRANGE', 'key', 0, 1), '-1')
+        self.assertEquals(mock.execute_command('HINCRBY', 'hash', 'field', 2), 2)
+        self.assertEquals(mock.execute_command('SET', 'key', 'value', 'NX'), None)
+        self.assertEquals(mock.execute_command('SET', u'ユニコード', 1.5), True)
+        self.assertEquals(mock.get(u'ユニコード'), '1.5')
+        self.assertEquals(mock.execute_command('DEL', 'key', 'missing'), 1)
+        self.assertEquals(mock.execute_command('PING'), True)
+        self.assertEquals(mock.execute_command('ECHO', 'hello'), 'hello')
+
+    def test_response_callbacks(self):
+        mock = self.mock
+        mock.hset('hash', 'field', 'value')
+        self.assertEquals(mock.execute_command('HGETALL', 'hash'), {'field': 'value'})
+        mock.zadd('zset', 'a', 1.5, 'b', 2)
+        self.assertEquals(mock.execute_command('ZRANGE', 'zset', 0, -1, 'WITHSCORES',
+                                               withscores=True),
+                          [('a', 1.5), ('b', 2.0)])
+        self.assertEquals(mock.execute_command('ZSCORE', 'zset', 'a'), 1.5)
+        self.assertTrue('used_memory' in mock.execute_command('INFO'))
+        self.assertEquals(mock.execute_command('LASTSAVE'), None)
+        mock.set_response_callback('GET', lambda response: response and response.upper())
+        mock.set('key', 'value')
+        self.assertEquals(mock.execute_command('GET', 'key'), 'VALUE')
+
+    def test_helpers_without_overrides(self):
+        # redis.Redis helpers that aren't overridden go through
+        # execute_command as well.
+        self.mock.sadd('set', 'a')
+        self.assertEquals(redis.Redis.smembers(self.mock, 'set'), set(['a']))
+        self.assertEquals(redis.Redis.zadd(self.mock, 'zset', 'a', 1), 1)
+
+    def test_errors(self):
+        self.assertRaises(redis.ResponseError, self.mock.execute_command, 'NOSUCHCOMMAND')
+        self.assertRaises(redis.ResponseError, self.mock.execute_command, 'GET')
+        self.assertRaises(redis.ResponseError, self.mock.execute_command, 'LRANGE', 'l', 'a', 1)
+        self.mock.set('key', 'value')
+        self.assertRaises(redis.ResponseError, self.mock.execute_command, 'LPUSH', 'key', 'a')
+
+    def test_pipeline(self):
+        self.mock.hset('hash', 'field', 'value')
+        pipe = self.mock.pipeline()
+        pipe.execute_command('SET', 'key', 'value')
+        pipe.set('other', 'value')
+        pipe.execute_command('HGETALL', 'hash')
+        pipe.execute_command('LPUSH', 'key', 'value')
+        pipe.execute_command('GET', 'key')
+        results = pipe.execute()
+        self.assertEquals(results[:3], [True, True, {'field': 'value'}])
+        self.assertTrue(isinstance(results[3], redis.ResponseError))
+        self.assertEquals(results[4], 'value')
+        self.assertEquals(pipe.wire_replies, {})
+
+    def test_pipeline_watching(self):
+        self.mock.set('key', '1')
+        pipe = self.mock.pipeline()
+        pipe.watch('key')
+        self.assertEquals(pipe.execute_command('GET', 'key'), '1')
+        pipe.multi()
+        pipe.execute_command('INCR', 'key')
+        self.assertEquals(pipe.execute(), [2])
+
+class RedisSharedKeyspaceTest(TestCase):
+    host = 'shared-test'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'db0.shm')
+        self.clock = FakeClock()
+        self.mock = self.connect()
+
+    def tearDown(self):
+        self.forget()
+        shutil.rmtree(self.dir)
+
+    def connect(self, db=0, path=None):
+        return redis_mock.Redis(host=self.host, db=db, clock=self.clock,
+                                shared_file=path or self.path)
+
+    def forget(self):
+        # Simulates another process opening the file.
+        for name in list(redis_mock._caches):
+            if name.startswith(self.host + ':'):
+                redis_mock._caches.pop(name).close()
+                del redis_mock._locks[name]
+
+    def in_child(self, func):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                func(self.connect())
+                status = 0
+            finally:
+                os._exit(status)
+        self.assertEquals(os.waitpid(pid, 0)[1], 0)
+
+    def test_types(self):
+        self.mock.set('string', u"スパム".encode('utf-8'))
+        self.mock.rpush('list', 'a')
+        self.mock.rpush('list', 'b')
+        self.mock.sadd('set', 'a')
+        self.mock.hset('hash', 'field', 'value')
+        self.mock.zadd('zset', 'a', 2, 'b', 1.5)
+        self.forget()
+        mock = self.connect()
+        self.assertEquals(mock.get('string'), u"スパム".encode('utf-8'))
+        self.assertEquals(mock.lrange('list', 0, -1), ['a', 'b'])
+        self.assertEquals(mock.smembers('set'), set(['a']))
+        self.assertEquals(mock.hgetall('hash'), {'field': 'value'})
+        self.assertEquals(mock.zrange('zset', 0, -1, withscores=True),
+                          [('b', 1.5), ('a', 2.0)])
+
+    def test_other_process(self):
+        self.mock.set('parent', 'value')
+        self.mock.rpush('list', 'parent')
+        def child(mock):
+            assert mock.get('parent') == 'value'
+            mock.rpush('list', 'child')
+            mock.hset('hash', 'field', 'child')
+            mock.delete('parent')
+        self.in_child(child)
+        self.assertFalse(self.mock.exists('parent'))
+        self.assertEquals(self.mock.lrange('list', 0, -1), ['parent', 'child'])
+        self.assertEquals(self.mock.hget('hash', 'field'), 'child')
+
+    def test_concurrent_incr(self):
+        self.mock.set('counter', 0)
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    mock = self.connect()
+                    for j in range(200):
+                        mock.incr('counter')
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for j in range(200):
+            self.mock.incr('counter')
+        for pid in pids:
+            self.assertEquals(os.waitpid(pid, 0)[1], 0)
+        self.assertEquals(self.mock.get('counter'), '1000')
+        # Other processes read the counter back as a string.
+        def child(mock):
+            with mock._lock.reader():
+                assert mock._cache.get('counter') == '1000'
+            assert mock.incr('counter') == '1001'
+        self.in_child(child)
+        with self.mock._lock.reader():
+            self.assertEquals(self.mock._cache.get('counter'), '1001')
+
+    def test_grow_and_shrink(self):
+        for i in range(5000):
+            self.mock.set('key-%d' % i, 'x' * (i % 500))
+        self.assertEquals(len(self.mock._cache), 5000)
+        self.forget()
+        mock = self.connect()
+        self.assertEquals(mock.get('key-4999'), 'x' * 499)
+        for i in range(0, 5000, 2):
+            mock.delete('key-%d' % i)
+        self.assertEquals(len(mock._cache), 2500)
+        size = os.path.getsize(self.path)
+        for i in range(0, 5000, 2):
+            mock.set('key-%d' % i, 'y' * (i % 500))
+        self.assertEquals(os.path.getsize(self.path), size)
+        self.assertEquals(mock.get('key-10'), 'y' * 10)
+        self.assertEquals(mock.get('key-11'), 'x' * 11)
+        mock.flushdb()
+        self.assertEquals(len(mock._cache), 0)
+        self.assertEquals(mock.get('key-11'), None)
+
+    def test_expiry(self):
+        self.mock.setex('volatile', 'value', 10)
+        self.mock.set('other', 'value')
+        self.assertEquals(self.mock.ttl('volatile'), 10)
+        self.clock.now += 10
+        self.assertEquals(self.mock.get('volatile'), None)
+        self.assertFalse(self.mock.exists('volatile'))
+        self.mock.set('other', 'changed')
+        self.forget()
+        mock = self.connect()
+        self.assertFalse('volatile' in mock._cache)
+        self.assertFalse(mock._cache.expires)
+
+    def test_pipeline(self):
+        pipe = self.mock.pipeline()
+        pipe.rpush('list', 'a')
+        pipe.rpush('list', 'b')
+        pipe.lrange('list', 0, -1)
+        self.assertEquals(pipe.execute(), [1, 2, ['a', 'b']])
+        self.in_child(lambda mock: mock.lpop('list'))
+        self.assertEquals(self.mock.lrange('list', 0, -1), ['b'])
+
+    def test_bgsave(self):
+        self.mock.set('key', 'value')
+        path = os.path.join(self.dir, 'dump.rdb')
+        redis_mock.Redis(host=self.host, db=0, dbfilename=path).bgsave()
+        thread = redis_mock._bgsaves.get(self.host + ':6379')
+        if thread is not None:
+            thread.join()
+        databases = redis_mock._read_snapshot(path, 0)
+        self.assertEquals(databases['0'].items(), [('key', 'value')])
+
+    def test_scan(self):
+        for i in range(500):
+            self.mock.set('key-%d' % i, i)
+        cursor, seen = self.mock.scan(count=10)
+        i = 0
+        while cursor != 0:
+            self.in_child(lambda mock: mock.set('new-%d' % i, i))
+            self.mock.delete('key-%d' % (499 - i))
+            i += 1
+            cursor, keys = self.mock.scan(cursor, count=10)
+            seen.extend(keys)
+        expected = set('key-%d' % j for j in range(500 - i))
+        self.assertEquals(expected - set(seen), set())
+        self.assertEquals(sorted(self.mock.keys('key-1?')),
+                          sorted('key-1%d' % j for j in range(10)))
+
+    def test_counters(self):
+        self.mock.set('string', 'value')
+        self.mock.rpush('list', 'a')
+        self.in_child(lambda mock: mock.hset('hash', 'field', 'value'))
+        self.mock.set('list', 'now a string')
+        self.assertEquals(self.mock.type('hash'), 'hash')
+        self.assertEquals(self.mock.dbsize(), 3)
+        counts = self.mock.info('keyspace')['db0']
+        self.assertEquals((counts['string'], counts['list'], counts['hash']), (2, 0, 1))
+        self.mock.delete('hash')
+        self.assertEquals(self.mock._cache.type_counts()['hash'], 0)
+
+    def test_options(self):
+        self.assertRaises(redis.RedisError, redis_mock.Redis, host=self.host, db=1,
+                          shared_file=self.path + '1', maxmemory=100)
+        self.assertRaises(redis.RedisError, self.connect, 0, self.path + '1')
+        with open(self.path + '2', 'wb') as fp:
+            fp.write('garbage')
+        self.assertRaises(redis.RedisError, self.connect, 2, self.path + '2')
+
+class RedisScanTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.mock = redis_mock.Redis(db='scan-test', clock=self.clock)
+        self.mock.flushdb()
+        for i in range(100):
+            self.mock.set('key-%d' % i, i)
+
+    def scan_all(self, scan, *args, **kwargs):
+        items = []
+        cursor = 0
+        while True:
+            cursor, found = scan(cursor=cursor, *args, **kwargs)
+            items.extend(found)
+            if cursor == 0:
+                return items
+
+    def test_scan(self):
+        keys = self.scan_all(self.mock.scan, count=5)
+        self.assertEquals(set(keys), set('key-%d' % i for i in range(100)))
+        cursor, keys = self.mock.scan(count=5)
+        self.assertNotEquals(cursor, 0)
+        self.assertTrue(5 <= len(keys) < 100)
+
+    def test_scan_while_writing(self):
+        cursor, seen = self.mock.scan(count=10)
+        i = 0
+        while cursor != 0:
+            # Grows the index several times and deletes keys along the way.
+            for j in range(20):
+                self.mock.set('new-%d-%d' % (i, j), j)
+            self.mock.delete('key-%d' % (99 - i))
+            i += 1
+            cursor, keys = self.mock.scan(cursor, count=10)
+            seen.extend(keys)
+        expected = set('key-%d' % j for j in range(100 - i))
+        self.assertEquals(expected - set(seen), set())
+
+    def test_scan_iter(self):
+        self.mock.hset('hash', 'field', 'value')
+        self.assertEquals(sorted(self.mock.scan_iter('key-1?')),
+                          sorted('key-1%d' % i for i in range(10)))
+        self.assertEquals(list(self.mock.scan_iter(_type='hash')), ['hash'])
+        self.assertEquals(len(list(self.mock.scan_iter(count=1000))), 101)
+
+    def test_scan_skips_expired(self):
+        self.mock.expire('key-1', 10)
+        self.clock.now += 10
+        keys = self.scan_all(self.mock.scan)
+        self.assertEquals(len(keys), 99)
+        self.assertFalse('key-1' in keys)
+        self.assertFalse('key-1' in self.mock.keys())
+
+    def test_scan_errors(self):
+        self.assertRaises(redis.ResponseError, self.mock.scan, 'abc')
+        self.assertRaises(redis.ResponseError, self.mock.scan, -1)
+        self.assertRaises(redis.ResponseError, self.mock.scan, 0, None, 0)
+
+    def test_keys(self):
+        self.assertEquals(len(self.mock.keys()), 100)
+        self.assertEquals(sorted(self.mock.keys('key-[1-2]')), ['key-1', 'key-2'])
+        self.assertEquals(self.mock.keys('key-[^0-8]'), ['key-9'])
+        self.assertEquals(self.mock.keys('key-\\*'), [])
+        self.mock.set('key-*', 'star')
+        self.assertEquals(self.mock.keys('key-\\*'), ['key-*'])
+        self.assertEquals(self.mock.keys('nothing*'), [])
+
+    def test_sscan(self):
+        for i in range(200):
+            self.mock.sadd('set', 'member-%d' % i)
+        cursor, members = self.mock.sscan('set', count=10)
+        self.assertNotEquals(cursor, 0)
+        members = self.scan_all(self.mock.sscan, 'set', count=10)
+        self.assertEquals(set(members), set('member-%d' % i for i in range(200)))
+        self.assertEquals(self.mock.sscan('missing'), (0, []))
+        self.assertEquals(sorted(self.mock.sscan_iter('set', 'member-1?')),
+                          sorted('member-1%d' % i for i in range(10)))
+
+    def test_sscan_while_writing(self):
+        for i in range(200):
+            self.mock.sadd('set', 'member-%d' % i)
+        cursor, seen = self.mock.sscan('set', count=10)
+        i = 0
+        while cursor != 0:
+            self.mock.sadd('set', 'new-%d' % i)
+            self.mock.srem('set', 'member-%d' % (199 - i))
+            i += 1
+            cursor, members = self.mock.sscan('set', cursor, count=10)
+            seen.extend(members)
+        expected = set('member-%d' % j for j in range(200 - i))
+        self.assertEquals(expected - set(seen), set())
+
+    def test_hscan(self):
+        for i in range(50):
+            self.mock.hset('hash', 'field-%d' % i, i)
+        self.assertEquals(dict(self.mock.hscan_iter('hash', count=5)),
+                          dict(('field-%d' % i, str(i)) for i in range(50)))
+        self.assertEquals(dict(self.mock.hscan_iter('hash', 'field-4?')),
+                          dict(('field-4%d' % i, '4%d' % i) for i in range(10)))
+        self.assertRaises(redis.ResponseError, self.mock.hscan, 'key-1')
+
+    def test_zscan(self):
+        self.mock.zadd('zset', 'a', 1, 'b', 2.5)
+        self.assertEquals(sorted(self.mock.zscan_iter('zset')), [('a', 1.0), ('b', 2.5)])
+        self.assertEquals(self.mock.zscan('zset', match='b'), (0, [('b', 2.5)]))
+
+    def test_wire(self):
+        self.mock.zadd('zset', 'a', 1.5)
+        cursor, keys = self.mock.execute_command('SCAN', 0, 'MATCH', 'key-9*', 'COUNT', 1000)
+        self.assertEquals(cursor, 0)
+        self.assertEquals(len(keys), 11)
+        self.assertEquals(self.mock.execute_command('SCAN', 0, 'TYPE', 'zset', 'COUNT', 1000),
+                          (0, ['zset']))
+        self.assertEquals(self.mock._execute_wire(['ZSCAN', 'zset', '0']), ['0', ['a', '1.5']])
+        self.assertEquals(len(self.mock._execute_wire(['KEYS', '*'])), 101)
+        self.assertRaises(redis.ResponseError, self.mock._execute_wire,
+                          ['SCAN', '0', 'MATCH'])
+        self.assertRaises(redis.ResponseError, self.mock._execute_wire,
+                          ['SSCAN', 'set', '0', 'TYPE', 'set'])
+
+class RedisKeyspaceInfoTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.mock = redis_mock.Redis(host='keyspace-test', clock=self.clock)
+        self.mock.flushall()
+        self.mock.set('string', 'value')
+        self.mock.rpush('list', 'a')
+        self.mock.sadd('set', 'a')
+        self.mock.hset('hash', 'field', 'value')
+        self.mock.zadd('zset', 'a', 1)
+
+    def test_type(self):
+        for name in ('string', 'list', 'set', 'hash', 'zset'):
+            self.assertEquals(self.mock.type(name), name)
+        self.assertEquals(self.mock.type('missing'), 'none')
+        self.assertEquals(self.mock._execute_wire(['TYPE', 'hash']), 'hash')
+
+    def test_dbsize(self):
+        self.assertEquals(self.mock.dbsize(), 5)
+        self.mock.delete('string', 'list')
+        self.assertEquals(self.mock.dbsize(), 3)
+        self.assertEquals(self.mock.execute_command('DBSIZE'), 3)
+
+    def test_counters(self):
+        counts = self.mock._cache.type_counts()
+        self.assertEquals(counts, {'string': 1, 'list': 1, 'set': 1, 'hash': 1, 'zset': 1})
+        self.mock.delete('string')
+        self.mock.set('list', 'now a string')
+        self.mock.setex('volatile', 'value', 10)
+        counts = self.mock._cache.type_counts()
+        self.assertEquals(counts['string'], 2)
+        self.assertEquals(counts['list'], 0)
+        self.clock.now += 10
+        self.assertEquals(self.mock.get('volatile'), None)
+        self.assertEquals(self.mock._cache.type_counts()['string'], 1)
+        self.mock.flushdb()
+        self.assertEquals(sum(self.mock._cache.type_counts().values()), 0)
+
+    def test_info_keyspace(self):
+        self.mock.expire('string', 10)
+        redis_mock.Redis(host='keyspace-test', db=1).set('other', 'value')
+        info = self.mock.info('keyspace')
+        self.assertEquals(info['db0']['keys'], 5)
+        self.assertEquals(info['db0']['expires'], 1)
+        self.assertEquals(info['db0']['hash'], 1)
+        self.assertEquals(info['db1']['keys'], 1)
+        self.assertEquals(self.mock.execute_command('INFO', 'keyspace'), info)
+        self.assertEquals(self.mock.info()['db0'], info['db0'])
+        self.mock.flushdb()
+        self.assertFalse('db0' in self.mock.info('keyspace'))
+
+    def test_snapshot_counts(self):
+        path = tempfile.mktemp(suffix='.rdb')
+        try:
+            redis_mock.Redis(host='keyspace-test', dbfilename=path).save()
+            for name in list(redis_mock._caches):
+                if name.startswith('keyspace-test:'):
+                    del redis_mock._caches[name]
+            mock = redis_mock.Redis(host='keyspace-test', dbfilename=path)
+            self.assertEquals(mock._cache.type_counts(),
+                              {'string': 1, 'list': 1, 'set': 1, 'hash': 1, 'zset': 1})
+        finally:
+            os.unlink(path)
+
+class RedisCommandStatsTest(TestCase):
+    def setUp(self):
+        redis_mock._stats.pop('stats-test:6379', None)
+        self.mock = redis_mock.Redis(host='stats-test', latency_tracking=True)
+        self.mock.flushall()
+        self.mock.config_resetstat()
+        self.mock.slowlog_reset()
+
+    def tearDown(self):
+        self.mock.config_set('latency-tracking', 'no')
+
+    def test_commandstats(self):
+        self.mock.set('key', 'value')
+        self.mock.get('key')
+        self.mock.get('key')
+        self.assertRaises(redis.ResponseError, self.mock.lpush, 'key', 'a')
+        info = self.mock.info('commandstats')
+        self.assertEquals(info['cmdstat_get']['calls'], 2)
+        self.assertEquals(info['cmdstat_set']['calls'], 1)
+        self.assertEquals(info['cmdstat_lpush']['failed_calls'], 1)
+        self.assertTrue('cmdstat_get' in self.mock.info('all'))
+        self.assertFalse('cmdstat_get' in self.mock.info())
+        self.assertTrue(self.mock.execute_command('CONFIG RESETSTAT'))
+        self.assertFalse('cmdstat_get' in self.mock.info('commandstats'))
+
+    def test_pipeline(self):
+        self.mock.pipeline().set('key', 'value').get('key').execute()
+        info = self.mock.info('commandstats')
+        self.assertEquals(info['cmdstat_exec']['calls'], 1)
+        self.assertEquals(info['cmdstat_get']['calls'], 1)
+
+    def test_latencystats(self):
+        for _ in xrange(100):
+            self.mock.get('key')
+        latency = self.mock.info('latencystats')['latency_percentiles_usec_get']
+        self.assertEquals(sorted(latency), ['p50', 'p99', 'p99.9'])
+        self.assertTrue(latency['p50'] <= latency['p99'] <= latency['p99.9'])
+
+    def test_histogram(self):
+        histogram = redis_mock.LatencyHistogram()
+        for value in xrange(1, 10001):
+            histogram.add(value)
+        p50, p99, p100 = histogram.percentiles((50, 99, 100))
+        self.assertTrue(abs(p50 - 5000) <= 5000 / 32)
+        self.assertTrue(abs(p99 - 9900) <= 9900 / 32)
+        self.assertEquals(p100, histogram.highest_equivalent(max(histogram.counts)))
+        self.assertTrue(p100 >= 10000)
+        histogram = redis_mock.LatencyHistogram()
+        for value in xrange(64):
+            histogram.add(value)
+        self.assertEquals(histogram.percentiles((100,)), [63])
+
+    def test_histogram_merge(self):
+        histogram = redis_mock.LatencyHistogram()
+        other = redis_mock.LatencyHistogram()
+        for value in xrange(50):
+            histogram.add(value)
+            other.add(value + 50)
+        histogram.merge(other)
+        self.assertEquals(histogram.total, 100)
+        self.assertEquals(histogram.percentiles((50, 100)), [49, 99])
+
+    def test_slowlog(self):
+        self.mock.get('key')
+        self.assertEquals(self.mock.slowlog_len(), 0)
+        self.mock.config_set('slowlog-log-slower-than', 0)
+        self.mock.set('key', 'v' * 200)
+        self.mock.get('key')
+        entries = self.mock.slowlog_get(2)
+        self.assertEquals([entry['command'] for entry in entries],
+                          ['get key', 'set key %s... (72 more bytes)' % ('v' * 128)])
+        self.assertTrue(entries[0]['id'] > entries[1]['id'])
+        self.assertEquals(len(self.mock.execute_command('SLOWLOG GET', 1)), 1)
+        self.assertEquals(self.mock.execute_command('SLOWLOG', 'LEN'), 3)
+        self.mock.config_set('slowlog-max-len', 2)
+        self.assertEquals(self.mock.slowlog_len(), 2)
+        self.assertEquals(self.mock.config_get('slowlog-max-len'), {'slowlog-max-len': '2'})
+        self.assertTrue(self.mock.execute_command('SLOWLOG RESET'))
+        self.assertEquals(self.mock.slowlog_len(), 0)
+
+    def test_disabled(self):
+        other = redis_mock.Redis(host='stats-test', db=1)
+        self.assertTrue(other._cache.stats is not None)
+        self.mock.config_set('latency-tracking', 'no')
+        self.assertEquals(self.mock.config_get('latency-tracking'), {'latency-tracking': 'no'})
+        self.assertTrue(self.mock._cache.stats is None)
+        self.assertTrue(other._cache.stats is None)
+        self.mock.get('key')
+        self.assertFalse('cmdstat_get' in self.mock.info('commandstats'))
+        self.assertRaises(redis.ResponseError, self.mock.config_set, 'latency-tracking', 'maybe')
+
+class RedisTraceTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix='.trace')
+        for name in list(redis_mock._caches):
+            if name.startswith('trace-test:') or name.startswith('replay-test:'):
+                del redis_mock._caches[name]
+        self.mock = redis_mock.Redis(host='trace-test')
+
+    def tearDown(self):
+        self.mock.trace_stop()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def records(self):
+        return list(redis_mock._read_trace(self.path)[1])
+
+    def test_record(self):
+        self.mock.get('before')
+        self.mock.trace_start(self.path)
+        self.mock.set('key', 'value')
+        redis_mock.Redis(host='trace-test', db=1).zadd('zset', 'a', 1)
+        self.mock.pipeline().incr('counter').get('key').execute()
+        self.assertRaises(redis.ResponseError, self.mock.lpush, 'key', 'a')
+        self.assertEquals(self.mock.trace_stop(), 4)
+        self.mock.get('after')
+        records = self.records()
+        self.assertEquals([record[1:] for record in records], [
+            (0, '0', 'set', ('key', 'value', None, None, False, False)),
+            (0, '1', 'zadd', ('zset', [('a', 1)])),
+            (0, '0', 'exec', (('incr', ('counter', 1)), ('get', ('key',)))),
+            (0, '0', 'lpush', ('key', 'a')),
+        ])
+        offsets = [record[0] for record in records]
+        self.assertEquals(offsets, sorted(offsets))
+
+    def test_threads(self):
+        self.mock.trace_start(self.path)
+        self.mock.set('main', 'value')
+        def work():
+            self.mock.set('thread', 'value')
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.mock.trace_stop()
+        self.assertEquals([(record[1], record[4][0]) for record in self.records()],
+                          [(0, 'main'), (1, 'thread')])
+
+    def test_replay(self):
+        self.mock.trace_start(self.path)
+        self.mock.rpush('list', 'a')
+        self.mock.rpush('list', 'b')
+        self.mock.zadd('zset', a=1, b=2)
+        self.mock.zrange('zset', 0, -1, withscores=True, score_cast_func=int)
+        self.mock.pipeline().hset('hash', 'field', 'value').incr('counter').execute()
+        self.assertRaises(redis.ResponseError, self.mock.sadd, 'list', 'fails')
+        self.mock.trace_stop()
+        self.assertEquals(redis_mock.replay_trace(self.path, 'replay-test')[0], 6)
+        replayed = redis_mock.Redis(host='replay-test')
+        self.assertEquals(replayed.lrange('list', 0, -1), ['a', 'b'])
+        self.assertEquals(replayed.zrange('zset', 0, -1, withscores=True),
+                          [('a', 1.0), ('b', 2.0)])
+        self.assertEquals(replayed.hgetall('hash'), {'field': 'value'})
+        self.assertEquals(replayed.get('counter'), '1')
+
+    def test_replay_threads(self):
+        self.mock.trace_start(self.path)
+        def work(index):
+            for i in xrange(100):
+                self.mock.incr('counter')
+                self.mock.rpush('list-%d' % index, i)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.mock.trace_stop()
+        count, elapsed = redis_mock.replay_trace(self.path, 'replay-test', threads=2,
+                                                 speed=1000.0)
+        self.assertEquals(count, 800)
+        replayed = redis_mock.Redis(host='replay-test')
+        self.assertEquals(replayed.get('counter'), '400')
+        for i in range(4):
+            self.assertEquals(replayed.lrange('list-%d' % i, 0, -1), map(str, range(100)))
+
+    def test_not_a_trace(self):
+        with open(self.path, 'wb') as fp:
+            fp.write('not a trace')
+        self.assertRaises(redis.RedisError, redis_mock.replay_trace, self.path)
+
+class RedisBulkCommandTest(TestCase):
+    def setUp(self):
+        self.mock = redis_mock.Redis(host='bulk-test')
+        self.mock.flushdb()
+
+    def test_mget_mset(self):
+        self.assertTrue(self.mock.mset({'a': 1, 'b': u"ほげ"}))
+        self.assertTrue(self.mock.mset(c='3'))
+        self.mock.sadd('set', 'member')
+        self.assertEquals(self.mock.mget('a', 'b', 'c', 'set', 'missing'),
+                          ['1', u"ほげ".encode('utf-8'), '3', None, None])
+        self.assertEquals(self.mock.mget(['a', 'c']), ['1', '3'])
+        self.assertEquals(self.mock.type('a'), 'string')
+        self.assertRaises(redis.RedisError, self.mock.mset, {'a': 1}, {'b': 2})
+        self.assertRaises(redis.ResponseError, self.mock.mset)
+
+    def test_mset_clears_ttl(self):
+        self.mock.setex('a', 'value', 100)
+        self.mock.mset(a='other')
+        self.assertEquals(self.mock.ttl('a'), -1)
+
+    def test_msetnx(self):
+        self.mock.set('a', 'old')
+        self.assertFalse(self.mock.msetnx(a='new', b='new'))
+        self.assertEquals(self.mock.mget('a', 'b'), ['old', None])
+        self.assertTrue(self.mock.msetnx(b='new', c='new'))
+        self.assertEquals(self.mock.mget('b', 'c'), ['new', 'new'])
+
+    def test_hmset_hmget(self):
+        self.assertTrue(self.mock.hmset('hash', {'a': 1, 'b': 2}))
+        self.assertTrue(self.mock.hmset('hash', {'b': 3}))
+        self.assertEquals(self.mock.hmget('hash', 'a', 'b', 'c'), ['1', '3', None])
+        self.assertEquals(self.mock.hmget('hash', ['b']), ['3'])
+        self.assertEquals(self.mock.hmget('missing', 'a'), [None])
+        self.assertRaises(redis.DataError, self.mock.hmset, 'hash', {})
+        self.mock.set('string', 'value')
+        self.assertRaises(redis.ResponseError, self.mock.hmset, 'string', {'a': 1})
+
+    def test_push(self):
+        self.assertEquals(self.mock.rpush('list', 'a', 'b'), 2)
+        self.assertEquals(self.mock.lpush('list', 'c', 'd'), 4)
+        self.assertEquals(self.mock.lrange('list', 0, -1), ['d', 'c', 'a', 'b'])
+        self.assertRaises(redis.ResponseError, self.mock.rpush, 'list')
+
+    def test_sadd_srem(self):
+        self.assertEquals(self.mock.sadd('set', 'a', 'b', 'a'), 2)
+        self.assertEquals(self.mock.sadd('set', 'b', 'c'), 1)
+        self.assertEquals(self.mock.srem('set', 'a', 'c', 'missing'), 2)
+        self.assertEquals(self.mock.smembers('set'), set(['b']))
+
+    def test_hdel(self):
+        self.mock.hmset('hash', {'a': 1, 'b': 2, 'c': 3})
+        self.assertEquals(self.mock.hdel('hash', 'a', 'b', 'missing'), 2)
+        self.assertEquals(self.mock.hgetall('hash'), {'c': '3'})
+        self.assertRaises(redis.ResponseError, self.mock.hdel, 'hash')
+
+    def test_removing_last_member_deletes_key(self):
+        self.mock.sadd('set', 'a', 'b')
+        self.mock.hmset('hash', {'a': 1})
+        self.assertEquals(self.mock.srem('set', 'a', 'b'), 2)
+        self.assertEquals(self.mock.hdel('hash', 'a'), 1)
+        self.assertFalse(self.mock.exists('set'))
+        self.assertFalse(self.mock.exists('hash'))
+        self.assertEquals(self.mock.type('set'), 'none')
+        self.assertEquals(self.mock.dbsize(), 0)
+        self.assertFalse('db0' in self.mock.info('keyspace'))
+
+    def test_wrong_type_is_atomic(self):
+        self.mock.set('string', 'value')
+        self.assertRaises(redis.ResponseError, self.mock.sadd, 'string', 'a', 'b')
+        self.assertRaises(redis.ResponseError, self.mock.rpush, 'string', 'a', 'b')
+        self.assertEquals(self.mock.get('string'), 'value')
+
+    def test_execute_command(self):
+        self.assertTrue(self.mock.execute_command('MSET', 'a', '1', 'b', '2'))
+        self.assertEquals(self.mock.execute_command('MGET', 'a', 'b', 'c'), ['1', '2', None])
+        self.assertEquals(self.mock.execute_command('MSETNX', 'a', '3'), 0)
+        self.assertTrue(self.mock.execute_command('HMSET', 'hash', 'f', 'v', 'g', 'w'))
+        self.assertEquals(self.mock.execute_command('HMGET', 'hash', 'g', 'f'), ['w', 'v'])
+        self.assertEquals(self.mock.execute_command('RPUSH', 'list', 'a', 'b', 'c'), 3)
+        self.assertEquals(self.mock.execute_command('SADD', 'set', 'a', 'b'), 2)
+        self.assertEquals(self.mock.execute_command('SREM', 'set', 'a', 'b'), 2)
+        self.assertRaises(redis.ResponseError, self.mock.execute_command, 'MSET', 'a', '1', 'b')
+        self.assertRaises(redis.ResponseError, self.mock.execute_command, 'HMSET', 'hash', 'f')
+
+    def test_pipeline(self):
+        pipe = self.mock.pipeline()
+        pipe.mset(a='1').rpush('list', 'a', 'b').hmset('hash', {'f': 'v'}).mget('a', 'b')
+        self.assertEquals(pipe.execute(), [True, 2, True, ['1', None]])
+
+class RedisSetAlgebraTest(TestCase):
+    def setUp(self):
+        self.mock = redis_mock.Redis(host='set-algebra-test')
+        self.mock.flushdb()
+        self.mock.sadd('a', '1', '2', '3', '4')
+        self.mock.sadd('b', '3', '4', '5')
+        self.mock.sadd('c', '4', '5', '6')
+
+    def test_sinter(self):
+        self.assertEquals(self.mock.sinter('a', 'b', 'c'), set(['4']))
+        self.assertEquals(self.mock.sinter(['a', 'missing']), set())
+        result = self.mock.sinter('a')
+        result.add('new')
+        self.assertFalse('new' in self.mock.smembers('a'))
+
+    def test_intersection_smallest_first(self):
+        class CountingSet(set):
+            calls = 0
+            def intersection(self, *others):
+                CountingSet.calls += 1
+                return set.intersection(self, *others)
+        small = CountingSet(['4'])
+        result = redis_mock._intersection([set(map(str, range(100))), small, set(['5'])])
+        self.assertEquals(result, set())
+        self.assertEquals(CountingSet.calls, 1)
+
+    def test_sintercard(self):
+        self.assertEquals(self.mock.sintercard(2, ['a', 'b']), 2)
+        self.assertEquals(self.mock.sintercard(2, ['a', 'b'], limit=1), 1)
+        self.assertEquals(self.mock.sintercard(1, ['a'], limit=10), 4)
+        self.assertEquals(self.mock.sintercard(2, ['a', 'missing'], limit=1), 0)
+        self.assertRaises(redis.DataError, self.mock.sintercard, 3, ['a', 'b'])
+        self.assertEquals(self.mock.execute_command('SINTERCARD', 2, 'a', 'b', 'LIMIT', 1), 1)
+        self.assertEquals(self.mock.execute_command('SINTERCARD', 3, 'a', 'b', 'c'), 1)
+        self.assertRaises(redis.ResponseError, self.mock.execute_command,
+                          'SINTERCARD', 3, 'a', 'b')
+        self.assertRaises(redis.ResponseError, self.mock.execute_command,
+                          'SINTERCARD', 1, 'a', 'LIMIT', -1)
+
+    def test_sunion_sdiff(self):
+        self.assertEquals(self.mock.sunion('a', 'c'), set(['1', '2', '3', '4', '5', '6']))
+        self.assertEquals(self.mock.sdiff('a', 'b', 'c'), set(['1', '2']))
+        self.assertEquals(self.mock.sdiff('missing', 'a'), set())
+        self.assertEquals(self.mock.execute_command('SDIFF', 'b', 'a'), set(['5']))
+
+    def test_store(self):
+        self.assertEquals(self.mock.sinterstore('dest', 'a', 'b'), 2)
+        self.assertEquals(self.mock.smembers('dest'), set(['3', '4']))
+        self.assertEquals(self.mock.sunionstore('dest', ['b', 'c']), 4)
+        self.assertEquals(self.mock.smembers('dest'), set(['3', '4', '5', '6']))
+        self.assertEquals(self.mock.sdiffstore('dest', 'dest', 'a'), 2)
+        self.assertEquals(self.mock.smembers('dest'), set(['5', '6']))
+        self.assertEquals(self.mock.sinterstore('dest', 'a', 'missing'), 0)
+        self.assertFalse(self.mock.exists('dest'))
+        self.mock.set('string', 'value')
+        self.assertEquals(self.mock.sunionstore('string', 'a'), 4)
+        self.assertEquals(self.mock.type('string'), 'set')
+        self.assertEquals(self.mock.execute_command('SINTERSTORE', 'dest', 'a', 'c'), 1)
+
+    def test_smove(self):
+        self.assertTrue(self.mock.smove('a', 'b', '1'))
+        self.assertFalse(self.mock.smove('a', 'b', '1'))
+        self.assertEquals(self.mock.smembers('b'), set(['1', '3', '4', '5']))
+        self.mock.sadd('single', 'x')
+        self.assertTrue(self.mock.smove('single', 'new', 'x'))
+        self.assertFalse(self.mock.exists('single'))
+        self.assertEquals(self.mock.smembers('new'), set(['x']))
+        self.mock.set('string', 'value')
+        self.assertRaises(redis.ResponseError, self.mock.smove, 'a', 'string', '2')
+
+    def test_smove_member_is_not_a_key(self):
+        self.mock.set('2', 'value')
+        pipe = self.mock.pipeline()
+        pipe.watch('2')
+        self.mock.smove('a', 'b', '2')
+        pipe.multi()
+        pipe.get('2')
+        self.assertEquals(pipe.execute(), ['value'])
+
+    def test_spop(self):
+        members = set(['1', '2', '3', '4'])
+        popped = self.mock.spop('a')
+        self.assertTrue(popped in members)
+        rest = self.mock.spop('a', 2)
+        self.assertEquals(len(rest), 2)
+        self.assertEquals(set(rest) | self.mock.smembers('a') | set([popped]), members)
+        self.assertEquals(len(self.mock.spop('a', 10)), 1)
+        self.assertFalse(self.mock.exists('a'))
+        self.assertEquals(self.mock.spop('a'), None)
+        self.assertEquals(self.mock.spop('a', 1), [])
+
+    def test_srandmember(self):
+        self.assertTrue(self.mock.srandmember('a') in set(['1', '2', '3', '4']))
+        self.assertEquals(self.mock.srandmember('missing'), None)
+        self.assertEquals(sorted(self.mock.srandmember('a', 10)), ['1', '2', '3', '4'])
+        self.assertEquals(len(set(self.mock.srandmember('a', 3))), 3)
+        self.assertEquals(len(self.mock.srandmember('a', -10)), 10)
+        self.assertEquals(self.mock.scard('a'), 4)
+        self.assertEquals(len(self.mock.execute_command('SRANDMEMBER', 'a', 2)), 2)
+
+class RedisReadViewTest(TestCase):
+    def setUp(self):
+        self.mock = redis_mock.Redis(host='read-view-test', read_views=True)
+        self.mock.flushdb()
+        self.mock.sadd('set', 'a', 'b')
+        self.mock.hmset('hash', {'a': '1', 'b': '2'})
+        self.mock.rpush('list', 'a', 'b', 'c')
+
+    def test_smembers_copies_by_default(self):
+        members = redis_mock.Redis(host='read-view-test').smembers('set')
+        members.add('c')
+        self.assertEquals(self.mock.scard('set'), 2)
+
+    def test_set_view(self):
+        view = self.mock.smembers('set')
+        self.assertTrue(isinstance(view, redis_mock.SetView))
+        self.assertEquals(view, set(['a', 'b']))
+        self.assertEquals(set(['a', 'b']), view)
+        self.assertTrue('a' in view)
+        self.assertEquals(view | set(['c']), set(['a', 'b', 'c']))
+        self.assertRaises(AttributeError, getattr, view, 'add')
+        self.mock.sadd('set', 'c')
+        self.mock.srem('set', 'a')
+        self.assertEquals(view, set(['a', 'b']))
+        self.assertEquals(self.mock.smembers('set'), set(['b', 'c']))
+
+    def test_hash_view(self):
+        view = self.mock.hgetall('hash')
+        self.assertTrue(isinstance(view, redis_mock.HashView))
+        self.assertEquals(view, {'a': '1', 'b': '2'})
+        self.assertEquals(view.get('a'), '1')
+        self.assertEquals(sorted(view.iteritems()), [('a', '1'), ('b', '2')])
+        def assign():
+            view['c'] = '3'
+        self.assertRaises(TypeError, assign)
+        self.mock.hset('hash', 'a', 'changed')
+        self.mock.hdel('hash', 'b')
+        self.assertEquals(view, {'a': '1', 'b': '2'})
+        self.assertEquals(self.mock.hgetall('hash'), {'a': 'changed'})
+
+    def test_list_view(self):
+        view = self.mock.lrange('list', 1, -1)
+        self.assertTrue(isinstance(view, redis_mock.ListView))
+        self.assertEquals(view, ['b', 'c'])
+        self.assertEquals(['b', 'c'], view)
+        self.assertEquals((view[0], view[-1], view[:1], len(view)), ('b', 'c', ['b'], 2))
+        self.assertRaises(IndexError, view.__getitem__, 2)
+        self.mock.lpush('list', 'z')
+        self.mock.rpop('list')
+        self.assertEquals(view, ['b', 'c'])
+        self.assertEquals(self.mock.lrange('list', 0, -1), ['z', 'a', 'b'])
+        self.assertEquals(self.mock.lrange('list', 5, 10), [])
+
+    def test_copied_once(self):
+        view = self.mock.smembers('set')
+        stored = self.mock._cache['set']
+        self.mock.sadd('set', 'c')
+        copy = self.mock._cache['set']
+        self.assertTrue(copy is not stored)
+        self.mock.sadd('set', 'd')
+        self.assertTrue(self.mock._cache['set'] is copy)
+        self.assertEquals(len(view), 2)
+
+    def test_pipeline(self):
+        pipe = self.mock.pipeline()
+        pipe.smembers('set').sadd('set', 'c').smembers('set')
+        before, added, after = pipe.execute()
+        self.assertEquals(before, set(['a', 'b']))
+        self.assertEquals(after, set(['a', 'b', 'c']))
+
+    def test_missing_and_deleted_keys(self):
+        self.assertEquals(self.mock.smembers('missing'), set())
+        self.assertFalse('missing' in self.mock._cache.views)
+        self.mock.smembers('set')
+        self.mock.delete('set')
+        self.assertFalse('set' in self.mock._cache.views)
+
+    def test_execute_command(self):
+        self.assertEquals(self.mock.execute_command('HGETALL', 'hash'), {'a': '1', 'b': '2'})
+        self.assertEquals(self.mock.execute_command('SMEMBERS', 'set'), set(['a', 'b']))
+        self.assertEquals(self.mock.execute_command('LRANGE', 'list', 0, 1), ['a', 'b'])
+
+class RedisCompactEncodingTest(TestCase):
+    def setUp(self):
+        redis_mock._caches.pop('compact-test:6379:0', None)
+        self.mock = redis_mock.Redis(host='compact-test', compact_encodings=True)
+
+    def test_intset(self):
+        self.mock.sadd('set', '3', '1', '-2')
+        self.assertEquals(self.mock.object_encoding('set'), 'intset')
+        self.assertTrue(isinstance(self.mock._cache['set'], redis_mock.IntSet))
+        self.assertEquals(self.mock.type('set'), 'set')
+        self.assertEquals(self.mock.smembers('set'), set(['1', '3', '-2']))
+        self.assertTrue(self.mock.sismember('set', '3'))
+        self.assertFalse(self.mock.sismember('set', '03'))
+        self.assertEquals(self.mock.sinter('set', 'missing'), set())
+        self.assertEquals(self.mock.sdiff('set', 'missing'), set(['1', '3', '-2']))
+        self.mock.sadd('set', 'a')
+        self.assertEquals(self.mock.object_encoding('set'), 'hashtable')
+        self.mock.srem('set', 'a')
+        self.assertEquals(self.mock.object_encoding('set'), 'intset')
+        self.mock.sadd('set', '99999999999999999999')
+        self.assertEquals(self.mock.object_encoding('set'), 'hashtable')
+
+    def test_intset_item_size(self):
+        self.assertEquals(redis_mock.IntSet([1, -1]).packed_size(), 4)
+        self.assertEquals(redis_mock.IntSet([1 << 20]).packed_size(), 4)
+        self.assertEquals(redis_mock.IntSet([1, 1 << 40]).packed_size(), 16)
+        self.assertEquals(redis_mock.IntSet.from_members(['1', ' 2']), None)
+        self.assertEquals(redis_mock.IntSet.from_members([str(1 << 63)]), None)
+
+    def test_packed_hash(self):
+        self.mock.hmset('hash', {'a': '1', 'b': '2'})
+        self.assertEquals(self.mock.object_encoding('hash'), 'listpack')
+        self.assertEquals(self.mock.type('hash'), 'hash')
+        self.assertEquals(self.mock.hgetall('hash'), {'a': '1', 'b': '2'})
+        self.assertEquals(self.mock.hget('hash', 'a'), '1')
+        self.assertEquals(self.mock.hmget('hash', 'a', 'c'), ['1', None])
+        self.assertEquals((self.mock.hlen('hash'), self.mock.hexists('hash', 'b')), (2, True))
+        self.assertEquals(self.mock.hscan('hash'), (0, {'a': '1', 'b': '2'}))
+        self.mock.hset('hash', 'c', 'x' * 65)
+        self.assertEquals(self.mock.object_encoding('hash'), 'hashtable')
+        self.mock.hdel('hash', 'c')
+        self.assertEquals(self.mock.object_encoding('hash'), 'listpack')
+
+    def test_packed_list(self):
+        self.mock.rpush('list', 'a', 'b', 'c')
+        self.assertEquals(self.mock.object_encoding('list'), 'listpack')
+        self.assertEquals(self.mock.lrange('list', 0, -1), ['a', 'b', 'c'])
+        self.assertEquals(self.mock.lrange('list', -2, -1), ['b', 'c'])
+        self.assertEquals((self.mock.lindex('list', 1), self.mock.llen('list')), ('b', 3))
+        self.assertEquals(self.mock.lpop('list'), 'a')
+        self.assertEquals(self.mock.object_encoding('list'), 'listpack')
+        self.mock.rpush('list', *map(str, range(200)))
+        self.assertEquals(self.mock.object_encoding('list'), 'quicklist')
+        self.assertEquals(self.mock.llen('list'), 202)
+
+    def test_batch_reads_decode_once(self):
+        self.mock.hmset('hash', {'a': '1', 'b': '2', 'c': '3'})
+        self.mock.rpush('list', 'a', 'b', 'c')
+        loads = []
+        marshal = redis_mock.marshal
+
+        class CountingMarshal(object):
+            dumps = staticmethod(marshal.dumps)
+
+            @staticmethod
+            def loads(data):
+                loads.append(data)
+                return marshal.loads(data)
+        redis_mock.marshal = CountingMarshal
+        try:
+            for read in (lambda: self.mock.hmget('hash', 'a', 'b', 'd'),
+                         lambda: self.mock.hscan('hash'),
+                         lambda: self.mock.lrange('list', 0, -1)):
+                del loads[:]
+                read()
+                self.assertEquals(len(loads), 1)
+        finally:
+            redis_mock.marshal = marshal
+        self.assertEquals(self.mock.hmget('hash', 'a', 'b', 'd'), ['1', '2', None])
+        self.assertEquals(self.mock.hscan('hash'), (0, {'a': '1', 'b': '2', 'c': '3'}))
+        self.assertEquals(self.mock.lrange('list', 1, 5), ['b', 'c'])
+
+    def test_other_encodings(self):
+        self.mock.set('int', '12')
+        self.mock.set('short', 'value')
+        self.mock.set('long', 'x' * 45)
+        self.mock.zadd('zset', 'a', 1)
+        self.assertEquals([self.mock.object_encoding(name) for name in
+                           ('int', 'short', 'long', 'zset', 'missing')],
+                          ['int', 'embstr', 'raw', 'skiplist', None])
+        self.assertEquals(self.mock.object('encoding', 'int'), 'int')
+        self.assertRaises(redis.ResponseError,
+                          self.mock.execute_command, 'OBJECT', 'FREQ', 'int')
+
+    def test_thresholds(self):
+        plain = redis_mock.Redis(host='compact-test', db=1)
+        self.assertEquals(plain._cache.encodings, None)
+        self.assertEquals(plain.config_get('set-max-intset-entries'),
+                          {'set-max-intset-entries': '512'})
+        self.mock.config_set('hash-max-listpack-entries', 2)
+        self.assertEquals(self.mock.config_get('hash-max-listpack-entries'),
+                          {'hash-max-listpack-entries': '2'})
+        self.mock.hmset('hash', {'a': '1', 'b': '2'})
+        self.assertEquals(self.mock.object_encoding('hash'), 'listpack')
+        self.mock.hset('hash', 'c', '3')
+        self.assertEquals(self.mock.object_encoding('hash'), 'hashtable')
+        self.mock.config_set('set-max-intset-entries', 0)
+        self.mock.sadd('set', '1')
+        self.assertEquals(self.mock.object_encoding('set'), 'hashtable')
+        self.assertRaises(redis.ResponseError,
+                          self.mock.config_set, 'list-max-listpack-size', -1)
+
+    def test_pipeline_and_views(self):
+        pipe = self.mock.pipeline()
+        pipe.sadd('set', '1').sadd('set', '2').smembers('set')
+        self.assertEquals(pipe.execute(), [1, 1, set(['1', '2'])])
+        self.assertEquals(self.mock.object_encoding('set'), 'intset')
+        views = redis_mock.Redis(host='compact-test', read_views=True)
+        view = views.smembers('set')
+        self.mock.sadd('set', '3')
+        self.assertEquals(view, set(['1', '2']))
+        self.assertEquals(self.mock.smembers('set'), set(['1', '2', '3']))
+
+    def test_smaller(self):
+        size_of = redis_mock.MemoryLimit.size_of
+        mapping = dict(('field%d' % i, 'value%d' % i) for i in range(10))
+        self.assertTrue(size_of('hash', redis_mock.PackedHash(mapping)) <
+                        size_of('hash', mapping))
+
+    def test_save_load(self):
+        path = tempfile.mktemp(suffix='.rdb')
+        try:
+            self.mock.sadd('set', '1', '2')
+            self.mock.hset('hash', 'field', 'value')
+            self.mock.rpush('list', 'a', 'b')
+            redis_mock.Redis(host='compact-test', dbfilename=path).save()
+            redis_mock._caches.pop('compact-test:6379:0')
+            mock = redis_mock.Redis(host='compact-test', dbfilename=path)
+            self.assertEquals(mock.smembers('set'), set(['1', '2']))
+            self.assertEquals(mock.hgetall('hash'), {'field': 'value'})
+            self.assertEquals(mock.lrange('list', 0, -1), ['a', 'b'])
+        finally:
+            os.unlink(path)
+
+class RedisMockSortedSetTest(TestCase):
+    def setUp(self):
+        self.mock = redis_mock.Redis()
+        self.mock._cache.clear()
+        self.mock._cache['test-key'] = u"スパム".encode('utf-8')
+        self.mock.zadd('test-zset', 'a', 1, 'b', 2, 'c', 3, d=4, e=4.5)
+
+    def test_zadd(self):
+        self.assertEquals(self.mock.zadd('test-zset', 'a', 10, 'f', 6), 1)
+        self.assertEquals(self.mock.zscore('test-zset', 'a'), 10.0)
+        self.assertEquals(self.mock.zcard('test-zset'), 6)
+
+    def test_zadd_unicode(self):
+        self.assertEquals(self.mock.zadd('new-zset', u"ほげ", 1), 1)
+        self.assertEquals(self.mock.zrange('new-zset', 0, -1), [u"ほげ".encode('utf-8')])
+
+    def test_zadd_bad_val(self):
+        self.assertRaises(redis.ResponseError,
+            self.mock.zadd, 'test-key', 'a', 1)
+        self.assertRaises(redis.ResponseError,
+            self.mock.zadd, 'test-zset', 'f', 'not-a-float')
+        self.assertRaises(redis.RedisError,
+            self.mock.zadd, 'test-zset', 'f')
+        self.assertEquals(self.mock.zcard('test-zset'), 5)
+
+    def test_zrem(self):
+        self.assertEquals(self.mock.zrem('test-zset', 'a', 'b', 'x'), 2)
+        self.assertEquals(self.mock.zrange('test-zset', 0, -1), ['c', 'd', 'e'])
+        self.assertEquals(self.mock.zrem('test-zset', 'c', 'd', 'e'), 3)
+        self.assertFalse(self.mock.exists('test-zset'))
+        self.assertEquals(self.mock.zrem('test-not-exists', 'a'), 0)
+
+    def test_zscore(self):
+        self.assertEquals(self.mock.zscore('test-zset', 'e'), 4.5)
+        self.assertEquals(self.mock.zscore('test-zset', 'x'), None)
+        self.assertEquals(self.mock.zscore('test-not-exists', 'x'), None)
+
+    def test_zrank(self):
+        self.assertEquals(self.mock.zrank('test-zset', 'a'), 0)
+        self.assertEquals(self.mock.zrank('test-zset', 'e'), 4)
+        self.assertEquals(self.mock.zrevrank('test-zset', 'e'), 0)
+        self.assertEquals(self.mock.zrank('test-zset', 'x'), None)
+        self.assertEquals(self.mock.zrevrank('test-zset', 'x'), None)
+
+    def test_zrank_ties(self):
+        self.mock.zadd('tie-zset', 'b', 1, 'a', 1, 'c', 1)
+        self.assertEquals(self.mock.zrange('tie-zset', 0, -1), ['a', 'b', 'c'])
+        self.assertEquals(self.mock.zrank('tie-zset', 'c'), 2)
+
+    def test_zrange(self):
+        self.assertEquals(self.mock.zrange('test-zset', 0, -1), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEquals(self.mock.zrange('test-zset', 1, 2), ['b', 'c'])
+        self.assertEquals(self.mock.zrange('test-zset', -2, -1, withscores=True),
+            [('d', 4.0), ('e', 4.5)])
+        self.assertEquals(self.mock.zrange('test-zset', 0, 1, desc=True), ['e', 'd'])
+        self.assertEquals(self.mock.zrange('test-zset', 10, 20), [])
+        self.assertEquals(self.mock.zrange('test-not-exists', 0, -1), [])
+
+    def test_zrevrange(self):
+        self.assertEquals(self.mock.zrevrange('test-zset', 0, 2), ['e', 'd', 'c'])
+        self.assertEquals(self.mock.zrevrange('test-zset', -1, -1, withscores=True,
+            score_cast_func=int), [('a', 1)])
+
+    def test_zrangebyscore(self):
+        self.assertEquals(self.mock.zrangebyscore('test-zset', 2, 4), ['b', 'c', 'd'])
+        self.assertEquals(self.mock.zrangebyscore('test-zset', '(2', '(4'), ['c'])
+        self.assertEquals(self.mock.zrangebyscore('test-zset', '-inf', '+inf'),
+            ['a', 'b', 'c', 'd', 'e'])
+        self.assertEquals(self.mock.zrangebyscore('test-zset', 2, 'inf', start=1, num=2,
+            withscores=True), [('c', 3.0), ('d', 4.0)])
+        self.assertEquals(self.mock.zrangebyscore('test-zset', 2, 'inf', start=3, num=-1), ['e'])
+        self.assertEquals(self.mock.zrangebyscore('test-zset', 5, 10), [])
+        self.assertRaises(redis.RedisError,
+            self.mock.zrangebyscore, 'test-zset', 0, 1, start=1)
+
+    def test_zrevrangebyscore(self):
+        self.assertEquals(self.mock.zrevrangebyscore('test-zset', 4, 2), ['d', 'c', 'b'])
+        self.assertEquals(self.mock.zrevrangebyscore('test-zset', '+inf', '-inf', start=1, num=2),
+            ['d', 'c'])
+
+    def test_zincrby(self):
+        self.assertEquals(self.mock.zincrby('test-zset', 'a', 10), 11.0)
+        self.assertEquals(self.mock.zrange('test-zset', -1, -1), ['a'])
+        self.assertEquals(self.mock.zincrby('new-zset', 'a'), 1.0)
+
+    def test_zcount(self):
+        self.assertEquals(self.mock.zcount('test-zset', 2, 4), 3)
+        self.assertEquals(self.mock.zcount('test-zset', '(1', 4.5), 4)
+        self.assertEquals(self.mock.zcount('test-not-exists', 0, 1), 0)
+
+    def test_zremrangebyscore(self):
+        self.assertEquals(self.mock.zremrangebyscore('test-zset', 2, '(4.5'), 3)
+        self.assertEquals(self.mock.zrange('test-zset', 0, -1), ['a', 'e'])
+        self.assertEquals(self.mock.zremrangebyscore('test-zset', '-inf', 'inf'), 2)
+        self.assertFalse(self.mock.exists('test-zset'))
+
+    def test_sorted_set_blocks(self):
+        import random
+        rand = random.Random(42)
+        zset = redis_mock.SortedSet()
+        zset.LOAD = 4
+        reference = {}
+        for i in range(2000):
+            member = 'm%d' % rand.randint(0, 300)
+            if rand.random() < 0.3:
+                self.assertEquals(zset.discard(member), member in reference)
+                reference.pop(member, None)
+            else:
+                score = rand.randint(0, 50)
+                zset.add(member, score)
+                reference[member] = score
+        pairs = sorted((score, member) for member, score in reference.items())
+        self.assertEquals(list(zset.pairs(0, len(zset))), pairs)
+        for rank, (score, member) in enumerate(pairs):
+            self.assertEquals(zset.rank(member), rank)
+        self.assertEquals(list(zset.pairs(10, 20)), pairs[10:20])
+        self.assertEquals(zset.score_rank(25), len([p for p in pairs if p[0] < 25]))
+        self.assertEquals(zset.score_rank(25, True), len([p for p in pairs if p[0] <= 25]))